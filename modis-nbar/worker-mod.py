@@ -25,6 +25,7 @@ logging.basicConfig(format="%(asctime)s %(levelname)-8s %(name)s %(message)s", d
 
 host = os.getenv("REDIS_SERVICE_HOST", "redis-master")
 q = rediswq.RedisWQ(name="jobMOD", host=host)
+q.start_reaper()
 
 logger = logging.getLogger("worker")
 logger.info(f"Worker with sessionID: {q.sessionID()}")
@@ -37,7 +38,9 @@ while not q.empty():
         logger.info(f"Working on {itemstr}")
         start = datetime.datetime.now().replace(microsecond=0)
 
-        process_scene(itemstr)
+        # renew the lease while the scene runs, so the reaper doesn't requeue a long SNAP/sen2cor run
+        with rediswq.LeaseHeartbeat(q, item, lease_secs=1800):
+            process_scene(itemstr)
         q.complete(item)
 
         end = datetime.datetime.now().replace(microsecond=0)
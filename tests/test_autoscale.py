@@ -0,0 +1,44 @@
+import pytest
+
+pytest.importorskip("redis")
+
+from workflows import autoscale
+
+
+def _stats(depth=0, leased=0, workers=0, per_worker_per_hour=0, oldest_age_secs=None):
+    return dict(depth=depth, leased=leased, workers=workers, per_worker_per_hour=per_worker_per_hour,
+                oldest_age_secs=oldest_age_secs)
+
+
+def test_empty_queue_scales_to_the_minimum():
+    assert autoscale.desired_replicas(_stats(workers=3, per_worker_per_hour=10)) == 0
+    assert autoscale.desired_replicas(_stats(), min_replicas=2) == 2
+
+
+def test_backlog_is_drained_at_the_learnt_rate():
+    # 50 jobs at 10 a worker an hour, to clear in half an hour
+    stats = _stats(depth=40, leased=10, workers=2, per_worker_per_hour=10)
+    assert autoscale.desired_replicas(stats, drain_secs=1800) == 10
+    assert autoscale.desired_replicas(stats, drain_secs=3600) == 5
+
+
+def test_estimate_is_capped():
+    stats = _stats(depth=1000, per_worker_per_hour=1)
+    assert autoscale.desired_replicas(stats, max_replicas=4) == 4
+
+
+def test_without_a_rate_the_current_workers_are_kept():
+    assert autoscale.desired_replicas(_stats(depth=5)) == 1
+    assert autoscale.desired_replicas(_stats(depth=5, leased=3, workers=3)) == 3
+
+
+def test_jobs_waiting_longer_than_the_drain_time_add_a_worker():
+    stats = _stats(depth=1, workers=2, per_worker_per_hour=100, oldest_age_secs=7200)
+    assert autoscale.desired_replicas(stats, drain_secs=3600) == 3
+
+
+def test_estimator_settings_from_the_environment(monkeypatch):
+    monkeypatch.setenv("AUTOSCALE_DRAIN_SECS", "600")
+    monkeypatch.setenv("AUTOSCALE_MAX_REPLICAS", "")
+    monkeypatch.delenv("AUTOSCALE_MIN_REPLICAS", raising=False)
+    assert autoscale.estimator_settings() == dict(drain_secs=600, min_replicas=0, max_replicas=10)
@@ -0,0 +1,65 @@
+import os
+
+import pytest
+
+pytest.importorskip("numpy")
+pytest.importorskip("rasterio")
+
+from workflows.utils import bands, resources
+
+
+def _write(in_path, out_path, value, threads=1):
+    with open(out_path, "w") as f:
+        f.write(value)
+    return dict(value=value, threads=threads)
+
+
+def _fail_halfway(in_path, out_path, value, threads=1):
+    with open(out_path, "w") as f:
+        f.write("partial")
+    raise RuntimeError("boom")
+
+
+@pytest.fixture(params=[1, 3], ids=["in process", "pool"])
+def cpus(request, monkeypatch):
+    monkeypatch.setenv("COG_BAND_WORKERS", str(request.param))
+    monkeypatch.setattr(resources, "memory_available", lambda: 64 * resources.gb)
+    return request.param
+
+
+def _jobs(tmp_path, failing=()):
+    return [(_fail_halfway if n in failing else _write, str(tmp_path / f"B{n}.TIF"), str(tmp_path / f"B{n}.tif"), str(n))
+            for n in range(3)]
+
+
+def test_results_come_back_in_job_order(tmp_path, cpus):
+    done = []
+
+    results = bands.cog_bands(_jobs(tmp_path), done.append)
+
+    assert [result["value"] for result in results] == ["0", "1", "2"]
+    assert sorted(done) == [str(tmp_path / f"B{n}.tif") for n in range(3)]
+    assert all(result["threads"] == max(1, cpus // 3) for result in results)
+
+
+def test_failed_band_does_not_stop_the_others(tmp_path, cpus):
+    done = []
+
+    with pytest.raises(bands.BandError, match="1 of 3 bands failed"):
+        bands.cog_bands(_jobs(tmp_path, failing={1}), done.append)
+
+    assert sorted(done) == [str(tmp_path / "B0.tif"), str(tmp_path / "B2.tif")]
+    assert (tmp_path / "B2.tif").read_text() == "2"
+    # no partial COG left behind for a retry to skip as done
+    assert not os.path.exists(tmp_path / "B1.tif")
+
+
+def test_band_workers_are_bounded_by_cpus_memory_and_bands(monkeypatch):
+    monkeypatch.setenv("COG_BAND_WORKERS", "8")
+    monkeypatch.setattr(resources, "memory_available", lambda: 3 * resources.gb)
+
+    assert bands.band_workers(2) == 2
+    assert bands.band_workers(10) == 3
+    assert bands.band_workers(10, band_mem=4 * resources.gb) == 1
+    with resources.scene_cpus(2):
+        assert bands.band_workers(10) == 2
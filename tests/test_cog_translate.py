@@ -0,0 +1,69 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+rasterio = pytest.importorskip("rasterio")
+pytest.importorskip("osgeo")
+pytest.importorskip("boto3")
+
+from rasterio.transform import from_origin
+
+from workflows.utils import run_report
+from workflows.utils.prep_utils import COG_PROFILE, InvalidCOGError, cog_structure, cog_translate
+from workflows.utils.scaling import scaler, window_stats
+
+
+def _band(path, size=256):
+    with rasterio.open(path, "w", driver="GTiff", width=size, height=size, count=1, dtype="uint16",
+                       crs="EPSG:32760", transform=from_origin(600000, 8000000, 10, 10)) as dst:
+        dst.write(np.arange(size * size, dtype="uint16").reshape(1, size, size))
+
+
+def test_config_gdal_num_threads_overrides_threads(tmp_path):
+    src, dst = str(tmp_path / "band.tif"), str(tmp_path / "cog.tif")
+    _band(src)
+
+    cog_translate(src, dst, COG_PROFILE, overview_level=2, overview_resampling="average", threads=2,
+                  config={"GDAL_NUM_THREADS": "ALL_CPUS"})
+
+    with rasterio.open(dst) as cog:
+        assert cog.is_tiled
+        assert cog.read(1)[0, 1] == 1
+
+
+def test_written_header_is_checked(tmp_path):
+    src, dst = str(tmp_path / "band.tif"), str(tmp_path / "cog.tif")
+    _band(src, size=1024)
+
+    with run_report.activate(run_report.RunReport("test", "scene")):
+        cog_translate(src, dst, COG_PROFILE, nodata=0, overview_level=2, overview_resampling="average")
+        assert run_report.current().cogs["cog.tif"]["valid"]
+
+    errors, _, details = cog_structure(dst)
+    assert not errors
+    assert details["ifd_offsets"]["main"] in (8, 16)
+    assert details["data_offsets"]["main"] > details["data_offsets"]["overview_0"]
+
+
+def test_untiled_cog_is_refused(tmp_path):
+    src, dst = str(tmp_path / "band.tif"), str(tmp_path / "cog.tif")
+    _band(src, size=1024)
+
+    with pytest.raises(InvalidCOGError, match="not tiled"):
+        cog_translate(src, dst, dict(COG_PROFILE, tiled=False), overview_level=2, overview_resampling="average")
+
+
+def test_band_is_scaled_in_one_pass(tmp_path):
+    src, dst = str(tmp_path / "B02_10m.jp2.tif"), str(tmp_path / "B02_10m.tif")
+    _band(src)
+    stats = window_stats(nodata=0, divisor=10000)
+
+    cog_translate(src, dst, COG_PROFILE, overview_level=2, overview_resampling="average",
+                  transform=scaler(nodata=0, divisor=10000, stats=stats), dtype="float32", dst_nodata=0)
+
+    with rasterio.open(src) as band, rasterio.open(dst) as cog:
+        values = band.read(1)
+        expected = (values / 10000).astype("float32")
+        assert cog.dtypes[0] == "float32"
+        assert cog.nodata == 0
+        np.testing.assert_array_equal(cog.read(1), expected)
+    assert stats.to_dict()["count"] == values.size - 1
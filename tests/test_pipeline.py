@@ -0,0 +1,100 @@
+import threading
+
+from workflows.pipeline import ScenePipeline, Stage, run_stages
+from workflows.utils import run_report
+
+
+def _append(name):
+    def stage(ctx):
+        return dict(ctx, ran=ctx.get("ran", []) + [name])
+    return stage
+
+
+def _fail(ctx):
+    raise RuntimeError("boom")
+
+
+def _run(stages, ctxs):
+    """Push ctxs through a ScenePipeline; return {token: error} and the cleaned up contexts."""
+    done, cleaned, lock = {}, [], threading.Lock()
+
+    def on_done(token, error):
+        with lock:
+            done[token] = error
+
+    def cleanup(ctx):
+        with lock:
+            cleaned.append(ctx)
+
+    pipeline = ScenePipeline(stages, on_done, cleanup)
+    for token, ctx in ctxs.items():
+        pipeline.submit(token, ctx)
+    pipeline.close()
+    return done, cleaned
+
+
+def test_scenes_run_through_every_stage_in_order():
+    stages = [Stage("download", _append("download"), workers=2), Stage("process", _append("process")),
+              Stage("upload", _append("upload"), buffer=2)]
+
+    done, cleaned = _run(stages, {n: dict(scene=n) for n in range(5)})
+
+    assert done == {n: None for n in range(5)}
+    assert sorted(ctx["scene"] for ctx in cleaned) == list(range(5))
+    assert all(ctx["ran"] == ["download", "process", "upload"] for ctx in cleaned)
+
+
+def test_failed_stage_ends_only_its_scene():
+    def process(ctx):
+        if ctx["scene"] == 1:
+            raise RuntimeError("boom")
+        return _append("process")(ctx)
+
+    stages = [Stage("download", _append("download")), Stage("process", process), Stage("upload", _append("upload"))]
+
+    done, cleaned = _run(stages, {n: dict(scene=n) for n in range(3)})
+
+    assert isinstance(done[1], RuntimeError)
+    assert done[0] is None and done[2] is None
+    assert len(cleaned) == 3
+    assert [ctx["ran"] for ctx in cleaned if ctx["scene"] == 1] == [["download"]]
+
+
+def test_stage_returning_none_ends_the_scene_early():
+    uploaded = []
+    stages = [Stage("download", lambda ctx: None), Stage("upload", uploaded.append)]
+
+    done, cleaned = _run(stages, {"a": dict(scene="a")})
+
+    assert done == {"a": None}
+    assert cleaned == [dict(scene="a")]
+    assert uploaded == []
+
+
+def test_cleanup_errors_do_not_lose_the_result():
+    done = {}
+
+    def cleanup(ctx):
+        raise OSError("busy")
+
+    pipeline = ScenePipeline([Stage("download", _fail)], lambda token, error: done.update({token: error}), cleanup)
+    pipeline.submit("a", {})
+    pipeline.close()
+
+    assert isinstance(done["a"], RuntimeError)
+
+
+def test_stages_report_to_the_scenes_report():
+    reports = []
+    stage = Stage("process", lambda ctx: reports.append(run_report.current()) or ctx)
+    report = run_report.RunReport("landsat", "a")
+
+    _run([stage], {"a": dict(report=report)})
+
+    assert reports == [report]
+
+
+def test_run_stages():
+    stages = [Stage("download", _append("download")), Stage("process", _append("process"))]
+    assert run_stages(stages, {})["ran"] == ["download", "process"]
+    assert run_stages([Stage("download", lambda ctx: None), Stage("process", _fail)], {}) is None
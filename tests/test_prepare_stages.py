@@ -0,0 +1,43 @@
+import pytest
+
+pytest.importorskip("numpy")
+pytest.importorskip("rasterio")
+pytest.importorskip("osgeo")
+pytest.importorskip("boto3")
+pytest.importorskip("google.cloud.storage")
+pytest.importorskip("sentinelsat")
+
+from workflows.pipeline import Stage
+from workflows.utils import prepS2
+
+TITLE = "S2A_MSIL2A_20190124T221941_N0211_R029_T60KYF_20190124T234344"
+
+
+class _Uploads(object):
+    closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def test_failed_stage_still_closes_upload_queue(monkeypatch, tmp_path):
+    uploads = _Uploads()
+
+    def download(job):
+        # a new dict, as s2_download returns
+        return dict(job, scene_name="scene")
+
+    def process(scene):
+        scene["uploads"] = uploads
+        return scene
+
+    def upload(scene):
+        raise RuntimeError("upload failed")
+
+    monkeypatch.setattr(prepS2, "S2_STAGES", [Stage("download", download), Stage("process", process),
+                                              Stage("upload", upload)])
+
+    with pytest.raises(RuntimeError):
+        prepS2.prepareS2(TITLE, inter_dir=str(tmp_path) + "/")
+
+    assert uploads.closed
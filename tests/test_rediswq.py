@@ -0,0 +1,153 @@
+import json
+import time
+
+import pytest
+
+fakeredis = pytest.importorskip("fakeredis")
+pytest.importorskip("lupa")
+
+from workflows import rediswq
+from workflows.rediswq import LeaseHeartbeat, RedisWQ
+
+
+@pytest.fixture
+def queue(monkeypatch):
+    """A factory of RedisWQs (one per worker session) on a shared fake redis."""
+    server = fakeredis.FakeServer()
+    monkeypatch.setattr(rediswq.redis, "StrictRedis", lambda **kwargs: fakeredis.FakeStrictRedis(server=server))
+    return lambda **kwargs: RedisWQ("jobLS", **kwargs)
+
+
+def _job(scene, **fields):
+    return dict(in_scene=scene, **fields)
+
+
+def test_lease_and_complete(queue):
+    q = queue()
+    q.enqueue(_job("a"))
+
+    item = q.lease(lease_secs=60, block=False)
+    assert json.loads(item) == _job("a")
+    assert q.lease(lease_secs=60, block=False) is None
+    assert not q.empty()
+
+    assert q.complete(item)
+    assert q.empty()
+    assert q.stats()["completed"] == 1
+
+
+def test_expired_lease_is_requeued_then_dead_lettered(queue):
+    q = queue(max_attempts=2)
+    q.enqueue(_job("a"))
+
+    item = q.lease(lease_secs=0, block=False)
+    assert q.check_expired_leases() == 1
+    assert q.lease(lease_secs=0, block=False) == item
+
+    # the second expiry is its last attempt
+    assert q.check_expired_leases() == 0
+    assert q.lease(lease_secs=60, block=False) is None
+    assert q.stats()["dead"] == 1
+
+
+def test_lost_lease_is_not_renewed_or_completed(queue):
+    q, other = queue(), queue()
+    q.enqueue(_job("a"))
+    item = q.lease(lease_secs=0, block=False)
+    q.check_expired_leases()
+    assert other.lease(lease_secs=60, block=False) == item
+
+    assert not q.renew(item, 60)
+    assert not q.complete(item)
+    assert other.complete(item)
+
+
+def test_heartbeat_keeps_the_lease(queue):
+    q = queue()
+    q.enqueue(_job("a"))
+    item = q.lease(lease_secs=1, block=False)
+
+    with LeaseHeartbeat(q, item, lease_secs=1, interval=0.2) as heartbeat:
+        time.sleep(1.3)
+        assert q.check_expired_leases() == 0
+    assert not heartbeat.lost
+
+
+def test_release_returns_items_to_the_head_without_an_attempt(queue):
+    q = queue(max_attempts=2)
+    q.enqueue(_job("a"))
+    q.enqueue(_job("b"))
+    items = q.lease_many(2, lease_secs=60)
+
+    assert q.release(items[:1]) == 1
+    assert q.lease(lease_secs=0, block=False) == items[0]
+    # released, not expired, so this expiry is its first attempt and it is retried
+    assert q.check_expired_leases() == 1
+    assert q.stats()["dead"] == 0
+
+
+def test_duplicate_jobs_coalesce_while_waiting(queue):
+    q = queue()
+
+    assert q.enqueue(_job("a", s3_dir="x/")) == "queued"
+    assert q.enqueue(_job("a", s3_dir="x/")) == "duplicate"
+    assert q.enqueue(_job("a", s3_dir="y/")) == "merged"
+
+    assert json.loads(q.lease(lease_secs=60, block=False)) == _job("a", s3_dir=["x/", "y/"])
+    assert q.lease(lease_secs=60, block=False) is None
+
+
+def test_job_identical_to_a_leased_one_is_not_requeued(queue):
+    q = queue()
+    q.enqueue(_job("a"))
+    item = q.lease(lease_secs=60, block=False)
+
+    assert q.enqueue(_job("a")) == "duplicate"
+    q.complete(item)
+    assert q.enqueue(_job("a")) == "queued"
+
+
+def test_scene_leased_with_other_targets_is_queued_again(queue):
+    q = queue()
+    q.enqueue(_job("a", s3_dir="x/"))
+    q.lease(lease_secs=60, block=False)
+
+    assert q.enqueue(_job("a", s3_dir="y/")) == "queued"
+
+
+def test_job_is_queued_again_once_dead_lettered(queue):
+    q = queue(max_attempts=1)
+    q.enqueue(_job("a"))
+    q.lease(lease_secs=0, block=False)
+    q.check_expired_leases()
+
+    assert q.enqueue(_job("a")) == "queued"
+
+
+def test_lanes_are_taken_by_weight(queue):
+    q = queue()
+    for lane in ("high", "normal", "bulk"):
+        for n in range(10):
+            q.enqueue(_job(f"{lane}{n}"), lane=lane)
+
+    leased = [json.loads(q.lease(lease_secs=60, block=False))["in_scene"] for _ in range(10)]
+
+    assert sorted(scene.rstrip("0123456789") for scene in leased) == ["bulk"] + ["high"] * 6 + ["normal"] * 3
+
+
+def test_job_is_promoted_to_a_higher_lane(queue):
+    q = queue()
+    q.enqueue(_job("a"), lane="bulk")
+
+    assert q.enqueue(_job("a"), lane="high") == "promoted"
+    assert q.stats()["queued"] == {"high": 1, "normal": 0, "bulk": 0}
+
+
+def test_rate_limit_is_shared_by_workers(queue):
+    q, other = queue(rate_limit=3), queue(rate_limit=3)
+    for n in range(5):
+        q.enqueue(_job(str(n)))
+
+    assert len(q.lease_many(2, lease_secs=60)) == 2
+    assert len(other.lease_many(2, lease_secs=60)) == 1
+    assert q.lease_many(1, lease_secs=60) == []
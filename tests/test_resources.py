@@ -0,0 +1,74 @@
+import pytest
+
+from workflows.utils import resources
+from workflows.utils.resources import gb
+
+
+@pytest.fixture
+def cgroup(monkeypatch):
+    """Serve cgroup files from a dict and give the process 8 CPUs."""
+    files = {}
+    monkeypatch.setattr(resources, "_read_first_line", files.get)
+    monkeypatch.setattr(resources.os, "sched_getaffinity", lambda pid: set(range(8)), raising=False)
+    return files
+
+
+def test_cpu_count_without_a_quota(cgroup):
+    assert resources.cpu_count() == 8
+    cgroup["/sys/fs/cgroup/cpu.max"] = "max 100000"
+    assert resources.cpu_count() == 8
+
+
+def test_cpu_count_honours_the_v2_quota(cgroup):
+    cgroup["/sys/fs/cgroup/cpu.max"] = "250000 100000"
+    assert resources.cpu_count() == 2
+    cgroup["/sys/fs/cgroup/cpu.max"] = "50000 100000"
+    assert resources.cpu_count() == 1
+
+
+def test_cpu_count_honours_the_v1_quota(cgroup):
+    cgroup["/sys/fs/cgroup/cpu/cpu.cfs_period_us"] = "100000"
+    cgroup["/sys/fs/cgroup/cpu/cpu.cfs_quota_us"] = "-1"
+    assert resources.cpu_count() == 8
+    cgroup["/sys/fs/cgroup/cpu/cpu.cfs_quota_us"] = "400000"
+    assert resources.cpu_count() == 4
+
+
+def test_quota_never_raises_the_affinity(cgroup):
+    cgroup["/sys/fs/cgroup/cpu.max"] = "1600000 100000"
+    assert resources.cpu_count() == 8
+
+
+def test_cgroup_memory_v2(cgroup):
+    cgroup["/sys/fs/cgroup/memory.max"] = str(8 * gb)
+    cgroup["/sys/fs/cgroup/memory.current"] = str(3 * gb)
+    assert resources.memory_limit() == 8 * gb
+    assert resources.memory_available() == 5 * gb
+
+
+def test_cgroup_memory_v1(cgroup):
+    cgroup["/sys/fs/cgroup/memory/memory.limit_in_bytes"] = str(4 * gb)
+    cgroup["/sys/fs/cgroup/memory/memory.usage_in_bytes"] = str(5 * gb)
+    assert resources.memory_limit() == 4 * gb
+    assert resources.memory_available() == 0
+
+
+@pytest.mark.parametrize("files", [
+    {"/sys/fs/cgroup/memory.max": "max"},
+    {"/sys/fs/cgroup/memory/memory.limit_in_bytes": str(2 ** 63 - 4096)},
+    {},
+])
+def test_unlimited_memory_falls_back_to_meminfo(cgroup, monkeypatch, files):
+    cgroup.update(files)
+    monkeypatch.setattr(resources, "_meminfo", lambda: {"MemTotal": 64 * gb, "MemAvailable": 60 * gb})
+    assert resources.memory_limit() == 64 * gb
+    assert resources.memory_available() == 60 * gb
+
+
+def test_scene_cpus_is_scoped_to_the_block():
+    assert resources.scene_cpu_budget() is None
+    with resources.scene_cpus(2):
+        with resources.scene_cpus(3):
+            assert resources.scene_cpu_budget() == 3
+        assert resources.scene_cpu_budget() == 2
+    assert resources.scene_cpu_budget() is None
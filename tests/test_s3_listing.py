@@ -0,0 +1,123 @@
+import datetime
+
+import pytest
+
+from workflows.utils import s3_listing
+from workflows.utils.s3_listing import ListingCache, list_objects
+
+MODIFIED = datetime.datetime(2020, 1, 1)
+
+
+class _Paginator(object):
+    def __init__(self, client):
+        self.client = client
+
+    def paginate(self, Bucket, Prefix, Delimiter=None):
+        self.client.calls.append((Prefix, Delimiter))
+        objects, prefixes = [], set()
+        for key in sorted(k for k in self.client.objects if k.startswith(Prefix)):
+            rest = key[len(Prefix):]
+            if Delimiter and Delimiter in rest:
+                prefixes.add(Prefix + rest.split(Delimiter)[0] + Delimiter)
+            else:
+                etag, modified = self.client.objects[key]
+                objects.append({"Key": key, "Size": 1, "ETag": etag, "LastModified": modified, "StorageClass": "x"})
+        # small pages, so every listing has to follow the continuation
+        size = self.client.page_size
+        for start in range(0, max(len(objects), 1), size):
+            page = {"Contents": objects[start:start + size]}
+            if start == 0:
+                page["CommonPrefixes"] = [{"Prefix": p} for p in sorted(prefixes)]
+            yield page
+
+
+class _Client(object):
+    def __init__(self, keys, page_size=2):
+        self.objects = {key: ('"etag"', MODIFIED) for key in keys}
+        self.page_size = page_size
+        self.calls = []
+
+    def get_paginator(self, name):
+        assert name == "list_objects_v2"
+        return _Paginator(self)
+
+
+KEYS = ["cs/readme.txt"] + [f"cs/s{s}/scene{n}/band{b}.tif" for s in range(3) for n in range(3) for b in range(3)]
+
+
+def _keys(objects):
+    return sorted(obj["Key"] for obj in objects)
+
+
+def test_lists_every_key_across_shards_and_pages():
+    objects = list(list_objects(_Client(KEYS), "bucket", "cs/", depth=2, threads=4))
+
+    assert _keys(objects) == sorted(KEYS)
+    assert set(objects[0]) == set(s3_listing.FIELDS)
+
+
+def test_non_recursive_lists_only_the_top_level():
+    assert _keys(list_objects(_Client(KEYS), "bucket", "cs/", recursive=False)) == ["cs/readme.txt"]
+
+
+def test_shard_error_is_raised(monkeypatch):
+    paginate = _Paginator.paginate
+
+    def failing(self, Bucket, Prefix, Delimiter=None):
+        if Prefix == "cs/s1/":
+            raise IOError("listing failed")
+        return paginate(self, Bucket, Prefix, Delimiter)
+
+    monkeypatch.setattr(_Paginator, "paginate", failing)
+    with pytest.raises(IOError, match="listing failed"):
+        list(list_objects(_Client(KEYS), "bucket", "cs/", threads=2))
+
+
+def test_cache_answers_while_the_top_level_is_unchanged():
+    client, cache = _Client(KEYS), ListingCache(60)
+    first = _keys(list_objects(client, "bucket", "cs/", cache=cache))
+    client.calls = []
+
+    assert _keys(list_objects(client, "bucket", "cs/", cache=cache)) == first
+    # only the check of the top level
+    assert client.calls == [("cs/", "/")]
+
+
+def test_cache_sees_a_new_sub_prefix():
+    client, cache = _Client(KEYS), ListingCache(60)
+    list(list_objects(client, "bucket", "cs/", cache=cache))
+
+    client.objects["cs/s9/scene0/band0.tif"] = ('"etag"', MODIFIED)
+
+    assert "cs/s9/scene0/band0.tif" in _keys(list_objects(client, "bucket", "cs/", cache=cache))
+
+
+def test_cache_sees_a_rewritten_top_level_object():
+    client, cache = _Client(["scene/band0.tif", "scene/band1.tif"]), ListingCache(60)
+    list(list_objects(client, "bucket", "scene/", cache=cache))
+
+    client.objects["scene/band1.tif"] = ('"other"', MODIFIED + datetime.timedelta(seconds=1))
+
+    objects = {obj["Key"]: obj for obj in list_objects(client, "bucket", "scene/", cache=cache)}
+    assert objects["scene/band1.tif"]["ETag"] == '"other"'
+
+
+def test_cache_expires_and_invalidates(monkeypatch):
+    cache = ListingCache(60)
+    marker = s3_listing.level_marker([], [])
+    cache.put("bucket", "cs/", [{"Key": "cs/a"}], marker)
+    assert cache.get("bucket", "cs/", marker) == [{"Key": "cs/a"}]
+
+    cache.invalidate("bucket", "cs/s0/new.tif")
+    assert cache.get("bucket", "cs/", marker) is None
+
+    cache.put("bucket", "cs/", [{"Key": "cs/a"}], marker)
+    now = s3_listing.time.monotonic()
+    monkeypatch.setattr(s3_listing.time, "monotonic", lambda: now + 61)
+    assert cache.get("bucket", "cs/", marker) is None
+
+
+def test_cache_off_with_no_ttl():
+    cache = ListingCache(0)
+    cache.put("bucket", "cs/", [], s3_listing.level_marker([], []))
+    assert cache.get("bucket", "cs/", s3_listing.level_marker([], [])) is None
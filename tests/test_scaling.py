@@ -0,0 +1,85 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from workflows.utils import scaling
+
+# Landsat Collection 2 surface reflectance and Sentinel-2 L2A BOA
+LANDSAT_SR = dict(scale_factor=0.0000275, add_offset=-0.2, nodata=0)
+S2_BOA = dict(add_offset=0, nodata=0, divisor=10000)
+
+
+def _arithmetic(values, scale_factor=1.0, add_offset=0.0, nodata=None, dtype="float32", divisor=None):
+    scaled = ((values / divisor if divisor else values * scale_factor) + add_offset).astype(dtype)
+    if nodata is not None:
+        scaled[values == nodata] = nodata
+    return scaled
+
+
+@pytest.mark.parametrize("kwargs", [LANDSAT_SR, S2_BOA, dict(scale_factor=0.00341802, add_offset=149.0, nodata=0),
+                                    dict(scale_factor=0.1, nodata=-9999)], ids=["landsat", "s2", "st", "nodata-out"])
+def test_lut_matches_the_arithmetic(kwargs):
+    values = np.arange(scaling.LUT_SIZE, dtype=np.uint16)
+
+    np.testing.assert_array_equal(scaling.lut(**kwargs), _arithmetic(values, **kwargs))
+
+
+def test_lut_is_shared_and_read_only():
+    table = scaling.lut(**LANDSAT_SR)
+
+    assert scaling.lut(**LANDSAT_SR) is table
+    with pytest.raises(ValueError):
+        table[1] = 0
+
+
+def test_scaler_matches_the_arithmetic_for_any_block_type():
+    block = np.array([[0, 1, 7500], [10000, 65535, 0]], dtype=np.uint16)
+    rescale = scaling.scaler(dtype="float32", **S2_BOA)
+
+    scaled = rescale(block)
+    assert scaled.dtype == np.float32
+    np.testing.assert_array_equal(scaled, _arithmetic(block, **S2_BOA))
+    np.testing.assert_array_equal(rescale(block.astype(np.int32)), scaled)
+
+
+def test_window_stats_match_numpy_over_the_whole_band():
+    rng = np.random.default_rng(0)
+    band = rng.integers(0, 20000, size=(64, 64), dtype=np.uint16)
+    band[:8] = 0
+    stats = scaling.WindowStats()
+    rescale = scaling.scaler(stats=stats, **LANDSAT_SR)
+
+    for rows in np.split(band, 4):
+        rescale(rows)
+
+    valid = _arithmetic(band, **LANDSAT_SR)[band != 0]
+    summary = stats.to_dict()
+    assert summary["count"] == valid.size
+    assert summary["nodata"] == 8 * 64
+    assert summary["min"] == valid.min() and summary["max"] == valid.max()
+    assert summary["mean"] == pytest.approx(valid.mean(dtype=np.float64))
+
+
+def test_window_stats_of_an_empty_band():
+    stats = scaling.WindowStats()
+    scaling.scaler(stats=stats, **S2_BOA)(np.zeros((4, 4), dtype=np.uint16))
+
+    assert stats.to_dict() == dict(count=0, nodata=16, min=None, max=None, mean=None)
+
+
+def test_histogram_covers_every_scaled_value(monkeypatch):
+    monkeypatch.setenv("BAND_STATS_BINS", "10")
+    stats = scaling.window_stats(**S2_BOA)
+    block = np.array([0, 1, 5000, 65535], dtype=np.uint16)
+
+    scaling.scaler(stats=stats, **S2_BOA)(block)
+
+    histogram = stats.to_dict()["histogram"]
+    assert histogram["range"] == [pytest.approx(0.0001), pytest.approx(6.5535)]
+    assert sum(histogram["counts"]) == 3
+    assert histogram["counts"][0] == 2 and histogram["counts"][-1] == 1
+
+
+def test_no_histogram_by_default(monkeypatch):
+    monkeypatch.delenv("BAND_STATS_BINS", raising=False)
+    assert "histogram" not in scaling.window_stats(**LANDSAT_SR).to_dict()
@@ -0,0 +1,53 @@
+import pytest
+
+pytest.importorskip("redis")
+
+from workflows import worker
+from workflows.utils.resources import gb
+
+
+@pytest.fixture
+def pod(monkeypatch):
+    """A pod with 8 CPUs, 16 GB of memory and 100 GB of free disk."""
+    budget = dict(cpus=8, memory=16 * gb, disk=100 * gb)
+    monkeypatch.setattr(worker.resources, "cpu_count", lambda: budget["cpus"])
+    monkeypatch.setattr(worker.resources, "memory_limit", lambda: budget["memory"])
+    monkeypatch.setattr(worker.resources, "disk_free", lambda path: budget["disk"])
+    return budget
+
+
+def _worker(**kwargs):
+    return worker.Worker("jobLS", handler=None, **kwargs)
+
+
+def test_slots_are_bounded_by_the_scarcest_budget(pod):
+    assert _worker(scene_cpus=2, scene_mem_gb=2, scene_disk_gb=10).slots() == 4
+    assert _worker(scene_cpus=1, scene_mem_gb=5, scene_disk_gb=10).slots() == 3
+    assert _worker(scene_cpus=1, scene_mem_gb=1, scene_disk_gb=40).slots() == 2
+
+
+def test_slots_are_bounded_by_the_concurrency(pod):
+    assert _worker(concurrency=2, scene_cpus=1, scene_mem_gb=1, scene_disk_gb=1).slots() == 2
+
+
+def test_there_is_always_one_slot(pod):
+    pod["memory"] = gb
+    assert _worker(scene_mem_gb=4).slots() == 1
+
+
+def test_running_scenes_disk_counts_towards_the_budget(pod):
+    w = _worker(scene_cpus=1, scene_mem_gb=1, scene_disk_gb=20)
+    pod["disk"] = 20 * gb
+    w._running = [object(), object()]
+    assert w.slots() == 3
+
+
+def test_pipeline_stages_run_with_the_scene_cpus():
+    seen = []
+    stages = [worker.Stage("process", lambda ctx: seen.append(worker.resources.scene_cpu_budget()) or ctx)]
+
+    w = _worker(stages=stages, scene_cpus=3)
+    w.stages[0].func({})
+
+    assert seen == [3]
+    assert worker.resources.scene_cpu_budget() is None
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+
+"""
+Estimate how many worker replicas a queue needs.
+
+The estimate is the number of workers that, at the rate each has recently
+been completing jobs, would clear the jobs waiting and in flight within
+AUTOSCALE_DRAIN_SECS. It is published by every worker as the
+ard_desired_replicas gauge (see workflows/metrics.py), for an autoscaler
+such as KEDA or an HPA on the Prometheus adapter to act on.
+
+Workers can't report anything while scaled to zero, so this module can also
+run on its own, printing the queue stats and estimate as JSON:
+
+    python -m workflows.autoscale --queue jobLS --host redis-master
+
+or serving them as Prometheus gauges with --serve PORT.
+"""
+
+import argparse
+import json
+import logging
+import math
+import os
+import time
+
+from workflows.rediswq import RedisWQ
+
+logger = logging.getLogger("autoscale")
+
+
+def _env_number(name, default, cast=int):
+    value = os.getenv(name)
+    return cast(value) if value else default
+
+
+def estimator_settings():
+    """desired_replicas() keyword arguments from AUTOSCALE_DRAIN_SECS, AUTOSCALE_MIN_REPLICAS and AUTOSCALE_MAX_REPLICAS."""
+    return {
+        'drain_secs': _env_number("AUTOSCALE_DRAIN_SECS", 3600),
+        'min_replicas': _env_number("AUTOSCALE_MIN_REPLICAS", 0),
+        'max_replicas': _env_number("AUTOSCALE_MAX_REPLICAS", 10),
+    }
+
+
+def desired_replicas(stats, drain_secs=3600, min_replicas=0, max_replicas=10):
+    """
+    Replicas needed to clear the backlog in 'stats' (from RedisWQ.stats())
+    within drain_secs, between min_replicas and max_replicas.
+    """
+    backlog = stats["depth"] + stats["leased"]
+    rate = stats["per_worker_per_hour"]
+    if backlog == 0:
+        wanted = 0
+    elif rate:
+        wanted = math.ceil(backlog / (rate * drain_secs / 3600))
+    else:
+        # nobody has finished a job lately to learn a rate from: keep who is working, or start one
+        wanted = max(stats["workers"], 1)
+
+    # the oldest job has already waited longer than the backlog should take, so we're behind
+    if stats["depth"] and (stats["oldest_age_secs"] or 0) > drain_secs:
+        wanted = max(wanted, stats["workers"] + 1)
+
+    return max(min_replicas, min(max_replicas, wanted))
+
+
+def _lanes(names):
+    # stats() only needs the lane names
+    return [(lane, 1) for lane in names.split(",")]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Estimate the worker replicas a queue needs.")
+    parser.add_argument("--queue", required=True, help="redis list the workers take jobs from, e.g. jobLS")
+    parser.add_argument("--host", default=os.getenv("REDIS_HOST", "localhost"))
+    parser.add_argument("--port", type=int, default=_env_number("REDIS_PORT", 6379))
+    parser.add_argument("--lanes", default=",".join(lane for lane, _ in RedisWQ.DEFAULT_LANES))
+    parser.add_argument("--serve", type=int, default=None, help="serve Prometheus gauges on this port instead")
+    parser.add_argument("--interval", type=int, default=30, help="seconds between updates with --serve")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    q = RedisWQ(name=args.queue, lanes=_lanes(args.lanes), host=args.host, port=args.port)
+    settings = estimator_settings()
+
+    if args.serve is None:
+        stats = q.stats()
+        print(json.dumps(dict(stats, desired_replicas=desired_replicas(stats, **settings)), indent=2))
+    else:
+        from workflows import metrics
+        metrics.init()
+        metrics.start_metrics_server(args.queue, args.serve)
+        while True:
+            try:
+                stats = q.stats()
+                metrics.queue_stats(stats, desired_replicas(stats, **settings))
+            except Exception:
+                logger.exception(f"Could not read stats for {args.queue}")
+            time.sleep(args.interval)
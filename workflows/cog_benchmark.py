@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+
+"""
+Compare the COG compression profiles (prep_utils.COG_PROFILES) on sample
+bands: encode time, time to decode the whole COG again, and size.
+
+    python -m workflows.cog_benchmark LC08_..._SR_B4.TIF T60KYF_..._B04_10m.jp2 S1A_..._Gamma0_VV_db.img
+
+Bands are COG'd as they are, or scaled to float32 on the way like the
+Landsat and Sentinel-2 bands are with --scale/--offset/--nodata, e.g.
+--scale 0.0000275 --offset -0.2 for Landsat surface reflectance.
+"""
+
+import argparse
+import logging
+import os
+import tempfile
+import time
+
+import rasterio
+
+from workflows.utils.prep_utils import COG_PROFILES, cog_translate
+
+mb = 1024 ** 2
+
+
+def _scaler(scale, offset, nodata):
+    def rescale(block):
+        scaled = (block * scale + offset).astype("float32")
+        scaled[block == nodata] = nodata
+        return scaled
+    return rescale
+
+
+def benchmark(path, profiles, out_dir, threads=1, repeat=1, scale=None, offset=0, nodata=0):
+    """[(profile, encode seconds, decode seconds, bytes)] for one band, best of 'repeat' runs."""
+    kwargs = {}
+    if scale is not None:
+        kwargs = dict(transform=_scaler(scale, offset, nodata), dtype="float32", dst_nodata=nodata)
+
+    results = []
+    for name in profiles:
+        out_path = os.path.join(out_dir, f"{name}.tif")
+        encode, decode = [], []
+        for _ in range(repeat):
+            if os.path.exists(out_path):
+                os.remove(out_path)
+            start = time.perf_counter()
+            cog_translate(path, out_path, COG_PROFILES[name], overview_level=5, overview_resampling="average",
+                          threads=threads, **kwargs)
+            encode.append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            with rasterio.open(out_path) as src:
+                src.read()
+            decode.append(time.perf_counter() - start)
+        results.append((name, min(encode), min(decode), os.path.getsize(out_path)))
+        os.remove(out_path)
+    return results
+
+
+def results_table(path, results):
+    base = results[0][3]
+    lines = [os.path.basename(path),
+             f"  {'profile':<12} {'encode s':>9} {'decode s':>9} {'MB':>8} {'size':>6}"]
+    for name, encode, decode, size in results:
+        lines.append(f"  {name:<12} {encode:>9.2f} {decode:>9.2f} {size / mb:>8.1f} {size / base:>6.2f}")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare COG compression profiles on sample bands.")
+    parser.add_argument("bands", nargs="+", help="input bands (anything GDAL reads)")
+    parser.add_argument("--profiles", default=",".join(COG_PROFILES),
+                        help="comma separated profiles to compare, the first is the size baseline")
+    parser.add_argument("--threads", type=int, default=1, help="GDAL threads per encode")
+    parser.add_argument("--repeat", type=int, default=1, help="runs per profile, the fastest is reported")
+    parser.add_argument("--scale", type=float, default=None, help="scale bands to float32 by this factor")
+    parser.add_argument("--offset", type=float, default=0)
+    parser.add_argument("--nodata", type=float, default=0)
+    parser.add_argument("--tmp", default=None, help="directory to write the COGs in")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    profiles = args.profiles.split(",")
+    for band in args.bands:
+        with tempfile.TemporaryDirectory(dir=args.tmp) as out_dir:
+            results = benchmark(band, profiles, out_dir, args.threads, args.repeat, args.scale, args.offset,
+                                args.nodata)
+        print(results_table(band, results))
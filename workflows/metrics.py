@@ -0,0 +1,191 @@
+"""
+Prometheus metrics for the ARD workers.
+
+The worker serves /metrics on WORKER_METRICS_PORT (default 8000). Scenes run
+in child processes (see worker.py), so prometheus_client runs in
+multiprocess mode: every process writes its samples to files under
+PROMETHEUS_MULTIPROC_DIR and the endpoint in the worker process adds them up.
+Nothing is set up on import: the worker calls init() before starting scenes,
+each scene process attach()es to the same directory, and until then the
+recording functions do nothing.
+
+The prepare functions time their stages with
+
+    with timed_stage("scale_cog"):
+        scale_cog_landsat_l2(untar_dir, cog_dir)
+
+(timed_stage lives in prep_utils, which also counts bytes moved to and from
+S3 and the web).
+
+Workers also publish the state of their queue and the replica count
+workflows/autoscale.py estimates from it, for an external autoscaler.
+"""
+
+import contextlib
+import glob
+import os
+import time
+
+# scenes take minutes to hours, stages seconds to an hour
+_STAGE_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 600, 1200, 1800, 3600, 7200, float("inf"))
+
+# set up by init(); until then (e.g. a prepare function run on its own) recording is a no-op
+_metrics = None
+_multiproc_dir = None
+
+# label for everything recorded by this process and the scenes it starts
+_queue = os.getenv("WORKER_QUEUE", "unknown")
+_tmp_disk_high_water = 0
+
+
+class _Metrics(object):
+    def __init__(self):
+        from prometheus_client import Counter, Gauge, Histogram
+
+        self.stage_seconds = Histogram("ard_stage_seconds", "Time spent in each scene processing stage",
+                                       ["queue", "stage"], buckets=_STAGE_BUCKETS)
+        self.stage_failures = Counter("ard_stage_failures_total", "Stages that raised", ["queue", "stage"])
+        self.scene_seconds = Histogram("ard_scene_seconds", "Lease to ack time of a scene", ["queue", "outcome"],
+                                       buckets=_STAGE_BUCKETS)
+        self.queue_wait_seconds = Histogram("ard_queue_wait_seconds", "Time jobs spent queued before being leased",
+                                            ["queue"],
+                                            buckets=_STAGE_BUCKETS[:-1] + (14400, 43200, 86400, float("inf")))
+        self.bytes = Counter("ard_bytes_total", "Bytes downloaded and uploaded", ["queue", "direction"])
+        self.in_flight = Gauge("ard_scenes_in_flight", "Scenes being processed", ["queue"],
+                               multiprocess_mode="livesum")
+        self.tmp_disk_high_water = Gauge("ard_tmp_disk_high_water_bytes", "Most intermediate disk used at once",
+                                         ["queue"], multiprocess_mode="max")
+
+        # queue-wide, so every worker reports the same values; only the live ones count
+        self.queue_depth = Gauge("ard_queue_depth", "Jobs waiting", ["queue", "lane"], multiprocess_mode="livemax")
+        self.queue_leased = Gauge("ard_queue_leased", "Jobs being worked on", ["queue"],
+                                  multiprocess_mode="livemax")
+        self.queue_oldest_age = Gauge("ard_queue_oldest_age_seconds", "Wait of the oldest queued job", ["queue"],
+                                      multiprocess_mode="livemax")
+        self.worker_throughput = Gauge("ard_worker_jobs_per_hour", "Recent jobs completed per worker per hour",
+                                       ["queue"], multiprocess_mode="livemax")
+        self.desired_replicas = Gauge("ard_desired_replicas", "Worker replicas needed to keep up with the queue",
+                                      ["queue"], multiprocess_mode="livemax")
+
+
+def init(multiproc_dir=None):
+    """
+    Set up multiprocess metrics in PROMETHEUS_MULTIPROC_DIR (default
+    /tmp/ard_metrics), clearing samples a previous container run left in it.
+
+    The worker calls this before starting any scene. prometheus_client picks
+    its value store when first imported, so that import happens here, after
+    the directory is set.
+    """
+    global _metrics, _multiproc_dir
+    if _metrics is not None:
+        return
+    _multiproc_dir = multiproc_dir or os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", "/tmp/ard_metrics")
+    os.environ["PROMETHEUS_MULTIPROC_DIR"] = _multiproc_dir
+    os.makedirs(_multiproc_dir, exist_ok=True)
+    # samples left by a previous container run in the same (emptyDir) volume
+    for stale in glob.glob(os.path.join(_multiproc_dir, "*.db")):
+        os.remove(stale)
+    _metrics = _Metrics()
+
+
+def child_settings():
+    """(directory, queue label) for a scene process to attach() with."""
+    return _multiproc_dir, _queue
+
+
+def attach(multiproc_dir, queue):
+    """
+    Record into the worker's metrics from a scene process it started, which
+    doesn't inherit init(): the same directory, with nothing cleared. A no-op
+    if the worker has no metrics (multiproc_dir None).
+    """
+    global _metrics, _multiproc_dir, _queue
+    if _metrics is not None or multiproc_dir is None:
+        return
+    os.environ["PROMETHEUS_MULTIPROC_DIR"] = _multiproc_dir = multiproc_dir
+    _queue = queue
+    _metrics = _Metrics()
+
+
+def start_metrics_server(queue, port=8000):
+    """Serve /metrics for this worker and the scene processes it starts (call init() first)."""
+    from prometheus_client import CollectorRegistry, multiprocess, start_http_server
+
+    global _queue
+    if _metrics is None:
+        raise RuntimeError("metrics.init() must be called before serving metrics")
+    _queue = queue
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    start_http_server(port, registry=registry)
+
+
+def process_dead(pid):
+    """
+    Drop the live gauges of a scene process the worker has joined, so
+    ard_scenes_in_flight and the queue gauges stop counting it. Its counter
+    and histogram files stay, as they hold its share of the totals.
+    """
+    if _metrics is None:
+        return
+    from prometheus_client import multiprocess
+
+    multiprocess.mark_process_dead(pid, _multiproc_dir)
+
+
+@contextlib.contextmanager
+def stage(name):
+    """Time a stage into ard_stage_seconds, counting it in ard_stage_failures_total if it raises."""
+    if _metrics is None:
+        yield
+        return
+    start = time.monotonic()
+    try:
+        yield
+    except Exception:
+        _metrics.stage_failures.labels(_queue, name).inc()
+        raise
+    finally:
+        _metrics.stage_seconds.labels(_queue, name).observe(time.monotonic() - start)
+
+
+def count_bytes(direction, n):
+    """direction is "downloaded" or "uploaded"."""
+    if _metrics is not None:
+        _metrics.bytes.labels(_queue, direction).inc(n)
+
+
+def scene_done(seconds, outcome):
+    if _metrics is not None:
+        _metrics.scene_seconds.labels(_queue, outcome).observe(seconds)
+
+
+def queue_wait(seconds):
+    if _metrics is not None:
+        _metrics.queue_wait_seconds.labels(_queue).observe(seconds)
+
+
+def in_flight(n):
+    if _metrics is not None:
+        _metrics.in_flight.labels(_queue).set(n)
+
+
+def queue_stats(stats, desired_replicas):
+    """Publish RedisWQ.stats() and the replica estimate made from them."""
+    if _metrics is None:
+        return
+    for lane, n in stats["queued"].items():
+        _metrics.queue_depth.labels(_queue, lane).set(n)
+    _metrics.queue_leased.labels(_queue).set(stats["leased"])
+    _metrics.queue_oldest_age.labels(_queue).set(stats["oldest_age_secs"] or 0)
+    _metrics.worker_throughput.labels(_queue).set(stats["per_worker_per_hour"] or 0)
+    _metrics.desired_replicas.labels(_queue).set(desired_replicas)
+
+
+def tmp_disk_used(n):
+    """Record intermediate disk use, keeping the highest seen."""
+    global _tmp_disk_high_water
+    if _metrics is not None and n > _tmp_disk_high_water:
+        _tmp_disk_high_water = n
+        _metrics.tmp_disk_high_water.labels(_queue).set(n)
@@ -0,0 +1,132 @@
+"""
+Stage-pipelined scene processing.
+
+A scene normally runs download -> process -> upload back to back, so the NIC
+idles while COGs are built and the CPUs idle while tarballs download. In
+pipeline mode each stage has its own worker threads, fed through a bounded
+queue, so scene N+1 downloads while scene N is COG'd and scene N-1 uploads.
+
+A stage is a function taking and returning the scene's context dict (the job
+fields plus whatever earlier stages added, e.g. working directories), or
+None when there is nothing left to do (e.g. the scene is already published). The
+buffers bound how many finished-but-not-yet-consumed scenes sit on disk
+between stages; a full buffer blocks the stage before it (back pressure).
+
+GDAL, numpy and boto release the GIL for the heavy lifting, so threads are
+enough to overlap the stages.
+
+A context may carry the scene's run report under "report"; it is made
+current around each stage so the stage's timings land in it (see
+workflows/utils/run_report.py).
+"""
+
+import logging
+import queue
+import threading
+
+from workflows.utils import run_report
+
+logger = logging.getLogger(__name__)
+
+_DONE = object()
+
+
+class Stage(object):
+    """
+    One step of a scene pipeline.
+
+    :param name: used for logging and the per-stage knobs (e.g. "download")
+    :param func: func(ctx) -> ctx, or None to end the scene early
+    :param workers: scenes this stage works on at once
+    :param buffer: scenes allowed to wait in front of this stage
+    """
+
+    def __init__(self, name, func, workers=1, buffer=1):
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.buffer = buffer
+
+    def configured(self, workers=None, buffer=None):
+        """Copy of this stage with its knobs overridden."""
+        return Stage(self.name, self.func, workers or self.workers, buffer or self.buffer)
+
+
+class ScenePipeline(object):
+    """
+    Run scenes through a list of Stages.
+
+    on_done(token, error) is called once per submitted scene, from a stage
+    thread, with error None on success. cleanup(ctx), if given, runs for
+    every scene that leaves the pipeline, whether it failed or not.
+    """
+
+    def __init__(self, stages, on_done, cleanup=None):
+        self._stages = stages
+        self._on_done = on_done
+        self._cleanup = cleanup
+        self._queues = [queue.Queue(maxsize=stage.buffer) for stage in stages]
+        self._threads = []
+        for i, stage in enumerate(stages):
+            for n in range(stage.workers):
+                thread = threading.Thread(target=self._work, args=(i,), name=f"{stage.name}-{n}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def has_room(self):
+        """Whether submit() would return without blocking."""
+        return not self._queues[0].full()
+
+    def submit(self, token, ctx):
+        """Queue a scene for the first stage, blocking while its buffer is full."""
+        self._queues[0].put((token, ctx))
+
+    def close(self):
+        """Let every scene already submitted finish, then stop the stage threads."""
+        for i, stage in enumerate(self._stages):
+            for _ in range(stage.workers):
+                self._queues[i].put(_DONE)
+            for thread in self._threads:
+                if thread.name.startswith(f"{stage.name}-"):
+                    thread.join()
+
+    def _finish(self, token, ctx, error):
+        if self._cleanup is not None:
+            try:
+                self._cleanup(ctx)
+            except Exception:
+                logger.exception(f"Clean up failed for {token!r}")
+        self._on_done(token, error)
+
+    def _work(self, i):
+        stage = self._stages[i]
+        last = i == len(self._stages) - 1
+        while True:
+            job = self._queues[i].get()
+            if job is _DONE:
+                return
+            token, ctx = job
+            try:
+                with run_report.activate(ctx.get("report")):
+                    out = stage.func(ctx)
+            except Exception as e:
+                logger.exception(f"Stage {stage.name} failed for {token!r}")
+                self._finish(token, ctx, e)
+                continue
+            if out is None or last:
+                self._finish(token, ctx if out is None else out, None)
+            else:
+                self._queues[i + 1].put((token, out))
+
+
+def run_stages(stages, ctx):
+    """
+    Run the stages one after another in this thread, as the prepare* functions
+    do. Returns the final context, or None if a stage ended the scene early.
+    """
+    for stage in stages:
+        with run_report.activate(ctx.get("report")):
+            ctx = stage.func(ctx)
+        if ctx is None:
+            return None
+    return ctx
@@ -1,14 +1,209 @@
 #!/usr/bin/env python
 
-# Based on http://peter-hoffmann.com/2012/python-simple-queue-redis-queue.html 
-# and the suggestion in the redis documentation for RPOPLPUSH, at 
+# Based on http://peter-hoffmann.com/2012/python-simple-queue-redis-queue.html
+# and the suggestion in the redis documentation for RPOPLPUSH, at
 # http://redis.io/commands/rpoplpush, which suggests how to implement a work-queue.
 
- 
+
+import json
+import logging
+import threading
+import time
 import redis
 import uuid
 import hashlib
 
+
+logger = logging.getLogger(__name__)
+
+
+# All scripts read the clock from the redis server so that leases granted by one
+# pod and reaped by another are compared against the same time source.
+_LUA_NOW = """
+if redis.replicate_commands then redis.replicate_commands() end
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+"""
+
+# KEYS: processing, leases, owners, pending, pending items, pending lanes, item lanes, rate,
+#       then the lanes in the order to take from
+# ARGV: session, lease_secs, rate_limit, rate_window, count
+_LEASE_SCRIPT = _LUA_NOW + """
+local limit = tonumber(ARGV[3])
+local wanted = tonumber(ARGV[5])
+if limit > 0 then
+    -- sliding window of lease times shared by every worker on the queue
+    redis.call('ZREMRANGEBYSCORE', KEYS[8], '-inf', now - tonumber(ARGV[4]))
+    local room = limit - redis.call('ZCARD', KEYS[8])
+    if room <= 0 then
+        return -1
+    end
+    wanted = math.min(wanted, room)
+end
+local leased = {}
+for i = 9, #KEYS do
+    local lane = KEYS[i]
+    while #leased < wanted do
+        local item = redis.call('LPOP', lane)
+        if not item then
+            break
+        end
+        if limit > 0 then
+            redis.call('ZADD', KEYS[8], now, ARGV[1] .. ':' .. now .. ':' .. #leased)
+        end
+        -- once a job is being worked on, new jobs for the scene queue up separately;
+        -- the item stays in pending items until it completes, so an identical job isn't queued twice
+        local key = redis.call('HGET', KEYS[5], item)
+        if key and redis.call('HGET', KEYS[4], key) == item then
+            redis.call('HDEL', KEYS[4], key)
+            redis.call('HDEL', KEYS[6], key)
+        end
+        redis.call('HSET', KEYS[7], item, lane)
+        redis.call('RPUSH', KEYS[1], item)
+        redis.call('ZADD', KEYS[2], now + tonumber(ARGV[2]), item)
+        redis.call('HSET', KEYS[3], item, ARGV[1])
+        leased[#leased + 1] = item
+    end
+end
+if limit > 0 and #leased > 0 then
+    redis.call('EXPIRE', KEYS[8], math.ceil(tonumber(ARGV[4])) + 1)
+end
+return leased
+"""
+
+# KEYS: pending, pending items, pending lanes, enqueued, every lane from highest priority to lowest
+# ARGV: scene key, payload the caller merged into ('' for none), payload, lane
+_ENQUEUE_SCRIPT = _LUA_NOW + """
+local current = redis.call('HGET', KEYS[1], ARGV[1])
+if (current or '') ~= ARGV[2] then
+    -- another producer or a lease got there first, the caller re-reads and retries
+    return -1
+end
+local function rank(lane)
+    for i = 5, #KEYS do
+        if KEYS[i] == lane then
+            return i
+        end
+    end
+    return #KEYS + 1
+end
+local lane = ARGV[4]
+local result = 1
+local enqueued = now
+if not current and redis.call('HEXISTS', KEYS[2], ARGV[3]) == 1 then
+    -- the very same job is leased (or requeued after its lease expired) and not yet complete
+    return 0
+end
+if not current then
+    redis.call('RPUSH', lane, ARGV[3])
+else
+    enqueued = redis.call('HGET', KEYS[4], current) or now
+    local queued_lane = redis.call('HGET', KEYS[3], ARGV[1]) or lane
+    if rank(lane) < rank(queued_lane) then
+        -- asked for a higher priority lane, move the job there
+        redis.call('LREM', queued_lane, 1, current)
+        redis.call('RPUSH', lane, ARGV[3])
+        result = 3
+    elseif current == ARGV[3] then
+        return 0
+    else
+        -- swap the merged job in where the old one was, so it keeps its place in the queue
+        lane = queued_lane
+        if redis.call('LINSERT', lane, 'BEFORE', current, ARGV[3]) == -1 then
+            redis.call('RPUSH', lane, ARGV[3])
+        end
+        redis.call('LREM', lane, 1, current)
+        result = 2
+    end
+    redis.call('HDEL', KEYS[2], current)
+    redis.call('HDEL', KEYS[4], current)
+end
+redis.call('HSET', KEYS[4], ARGV[3], enqueued)
+redis.call('HSET', KEYS[1], ARGV[1], ARGV[3])
+redis.call('HSET', KEYS[2], ARGV[3], ARGV[1])
+redis.call('HSET', KEYS[3], ARGV[1], lane)
+return result
+"""
+
+# KEYS: leases, owners
+# ARGV: item, session, lease_secs
+_RENEW_SCRIPT = _LUA_NOW + """
+if redis.call('HGET', KEYS[2], ARGV[1]) ~= ARGV[2] then
+    return 0
+end
+redis.call('ZADD', KEYS[1], now + tonumber(ARGV[3]), ARGV[1])
+return 1
+"""
+
+# KEYS: main, processing, leases, owners, attempts, item lanes, enqueued, completed, pending items
+# ARGV: item, session, throughput window
+_COMPLETE_SCRIPT = _LUA_NOW + """
+local owner = redis.call('HGET', KEYS[4], ARGV[1])
+if owner and owner ~= ARGV[2] then
+    return 0
+end
+if not owner then
+    -- lease expired and the item was requeued, but nobody picked it up yet
+    redis.call('LREM', redis.call('HGET', KEYS[6], ARGV[1]) or KEYS[1], 1, ARGV[1])
+end
+redis.call('LREM', KEYS[2], 1, ARGV[1])
+redis.call('ZREM', KEYS[3], ARGV[1])
+redis.call('HDEL', KEYS[4], ARGV[1])
+redis.call('HDEL', KEYS[5], ARGV[1])
+redis.call('HDEL', KEYS[6], ARGV[1])
+redis.call('HDEL', KEYS[7], ARGV[1])
+redis.call('HDEL', KEYS[9], ARGV[1])
+-- recent completions by session, for stats()
+redis.call('ZREMRANGEBYSCORE', KEYS[8], '-inf', now - tonumber(ARGV[3]))
+redis.call('ZADD', KEYS[8], now, ARGV[2] .. '|' .. now)
+return 1
+"""
+
+# KEYS: main, processing, leases, owners, item lanes
+# ARGV: session, items in the order they were leased
+_RELEASE_SCRIPT = """
+local released = 0
+for i = #ARGV, 2, -1 do
+    local item = ARGV[i]
+    if redis.call('HGET', KEYS[4], item) == ARGV[1] and redis.call('LREM', KEYS[2], 1, item) > 0 then
+        redis.call('ZREM', KEYS[3], item)
+        redis.call('HDEL', KEYS[4], item)
+        -- back to the head of its lane without using up an attempt
+        redis.call('LPUSH', redis.call('HGET', KEYS[5], item) or KEYS[1], item)
+        redis.call('HDEL', KEYS[5], item)
+        released = released + 1
+    end
+end
+return released
+"""
+
+# KEYS: main, processing, leases, owners, attempts, dead, item lanes, enqueued, pending items
+# ARGV: max_attempts
+_REAP_SCRIPT = _LUA_NOW + """
+local expired = redis.call('ZRANGEBYSCORE', KEYS[3], '-inf', now)
+local requeued = 0
+for _, item in ipairs(expired) do
+    redis.call('ZREM', KEYS[3], item)
+    redis.call('HDEL', KEYS[4], item)
+    if redis.call('LREM', KEYS[2], 1, item) > 0 then
+        local attempts = redis.call('HINCRBY', KEYS[5], item, 1)
+        if attempts >= tonumber(ARGV[1]) then
+            redis.call('HDEL', KEYS[5], item)
+            redis.call('HDEL', KEYS[7], item)
+            redis.call('HDEL', KEYS[8], item)
+            redis.call('HDEL', KEYS[9], item)
+            redis.call('RPUSH', KEYS[6], item)
+        else
+            -- back to the head of its lane, it has waited long enough
+            redis.call('LPUSH', redis.call('HGET', KEYS[7], item) or KEYS[1], item)
+            requeued = requeued + 1
+        end
+    end
+end
+return requeued
+"""
+
+
 class RedisWQ(object):
     """Simple Finite Work Queue with Redis Backend
 
@@ -18,31 +213,98 @@ class RedisWQ(object):
 
     The items in the work queue are assumed to have unique values.
 
-    This object is not intended to be used by multiple threads
-    concurrently.
+    Items are taken from the head of the main list, so producers should
+    RPUSH (the same order the old blpop workers consumed in). Taking an item,
+    moving it onto the processing list and recording its lease happen in one
+    Lua script, so a worker dying at any point leaves either an untouched
+    item or a lease that will expire. Expired leases are put back on the
+    queue by check_expired_leases(), which any worker may run (see
+    start_reaper()). An item whose lease expires max_attempts times - e.g. a
+    scene that OOM-kills every pod that picks it up - is parked on the
+    "<name>:dead" list instead.
+
+    Producers that may push the same scene more than once (overlapping AOI
+    searches) should use enqueue(), which coalesces jobs for a scene that is
+    still waiting into one.
+
+    A queue has priority lanes, by default "<name>:high", "<name>" (normal)
+    and "<name>:bulk", so urgent near-real-time scenes are not stuck behind a
+    backfill. lease() visits the lanes by smooth weighted round robin: with
+    weights 6/3/1 a worker takes 6 high, 3 normal and 1 bulk job in every 10
+    while all three have work, and whatever there is otherwise. rate_limit
+    caps the leases per rate_window seconds across every worker on the queue,
+    for upstreams such as ESA and ASF that answer bursts with 429s.
+
+    The underlying redis client is thread safe, so one RedisWQ may be shared
+    between the main loop, lease heartbeats and the reaper thread.
     """
-    def __init__(self, name, **redis_kwargs):
+    DEFAULT_LANES = (("high", 6), ("normal", 3), ("bulk", 1))
+    # completions older than this are forgotten; stats() can't look back further
+    THROUGHPUT_WINDOW = 3600
+
+    def __init__(self, name, max_attempts=3, lanes=DEFAULT_LANES, rate_limit=0, rate_window=60, **redis_kwargs):
        """The default connection parameters are: host='localhost', port=6379, db=0
 
        The work queue is identified by "name".  The library may create other
-       keys with "name" as a prefix. 
+       keys with "name" as a prefix.
+
+       lanes is a sequence of (lane, weight) from highest priority to lowest;
+       the "normal" lane is the plain "name" list producers have always used.
        """
        self._db = redis.StrictRedis(**redis_kwargs)
        # The session ID will uniquely identify this "worker".
        self._session = str(uuid.uuid4())
+       self._max_attempts = max_attempts
        # Work queue is implemented as two queues: main, and processing.
        # Work is initially in main, and moved to processing when a client picks it up.
        self._main_q_key = name
        self._processing_q_key = name + ":processing"
-       self._lease_key_prefix = name + ":leased_by_session:"
+       # Lease expiry times (sorted set) and the session holding each lease (hash).
+       self._leases_key = name + ":leases"
+       self._owners_key = name + ":owners"
+       self._attempts_key = name + ":attempts"
+       self._dead_q_key = name + ":dead"
+       # Waiting jobs by scene key, for enqueue() to coalesce into, and the reverse, which
+       # also keeps leased jobs until they complete so an identical job isn't queued twice.
+       self._pending_key = name + ":pending"
+       self._pending_items_key = name + ":pending:items"
+       self._pending_lanes_key = name + ":pending:lanes"
+       # When each job was enqueue()d (server time), for queue_wait().
+       self._enqueued_key = name + ":enqueued"
+       # The lane each leased item came from, to requeue it there.
+       self._item_lanes_key = name + ":lanes"
+       # Completion times by session over the last THROUGHPUT_WINDOW, for stats().
+       self._completed_key = name + ":completed"
+       # Lease times within the last rate_window, when rate_limit is set.
+       self._rate_key = name + ":rate"
+       self._rate_limit = rate_limit
+       self._rate_window = rate_window
+
+       self._lane_names = [lane for lane, _ in lanes]
+       self._lanes = [(self.lane_key(lane), weight) for lane, weight in lanes]
+       self._lane_credit = {key: 0 for key, _ in self._lanes}
+
+       self._lease_script = self._db.register_script(_LEASE_SCRIPT)
+       self._enqueue_script = self._db.register_script(_ENQUEUE_SCRIPT)
+       self._renew_script = self._db.register_script(_RENEW_SCRIPT)
+       self._complete_script = self._db.register_script(_COMPLETE_SCRIPT)
+       self._reap_script = self._db.register_script(_REAP_SCRIPT)
+       self._release_script = self._db.register_script(_RELEASE_SCRIPT)
 
     def sessionID(self):
         """Return the ID for this session."""
         return self._session
 
+    def lane_key(self, lane):
+        """Name of the redis list holding a lane's jobs."""
+        return self._main_q_key if lane == "normal" else f"{self._main_q_key}:{lane}"
+
     def _main_qsize(self):
-        """Return the size of the main queue."""
-        return self._db.llen(self._main_q_key)
+        """Return the number of jobs waiting, over all lanes."""
+        pipe = self._db.pipeline(transaction=False)
+        for key, _ in self._lanes:
+            pipe.llen(key)
+        return sum(pipe.execute())
 
     def _processing_qsize(self):
         """Return the size of the main queue."""
@@ -55,20 +317,36 @@ class RedisWQ(object):
         """
         return self._main_qsize() == 0 and self._processing_qsize() == 0
 
-# TODO: implement this
-#    def check_expired_leases(self):
-#        """Return to the work queueReturn True if the queue is empty, False otherwise."""
-#        # Processing list should not be _too_ long since it is approximately as long
-#        # as the number of active and recently active workers.
-#        processing = self._db.lrange(self._processing_q_key, 0, -1)
-#        for item in processing:
-#          # If the lease key is not present for an item (it expired or was 
-#          # never created because the client crashed before creating it)
-#          # then move the item back to the main queue so others can work on it.
-#          if not self._lease_exists(item):
-#            TODO: transactionally move the key from processing queue to
-#            to main queue, while detecting if a new lease is created
-#            or if either queue is modified.
+    def check_expired_leases(self):
+        """Return items whose lease has expired to the work queue.
+
+        Returns the number of items requeued. Safe to call from any number of
+        workers at once: the whole scan runs as a single Lua script.
+        """
+        requeued = self._reap_script(
+            keys=[self._main_q_key, self._processing_q_key, self._leases_key,
+                  self._owners_key, self._attempts_key, self._dead_q_key, self._item_lanes_key,
+                  self._enqueued_key, self._pending_items_key],
+            args=[self._max_attempts])
+        if requeued:
+            logger.warning(f"Requeued {requeued} item(s) with expired leases on {self._main_q_key}")
+        return requeued
+
+    def start_reaper(self, interval=60):
+        """Run check_expired_leases every 'interval' seconds in a daemon thread."""
+        stop = threading.Event()
+
+        def reap():
+            while not stop.wait(interval):
+                try:
+                    self.check_expired_leases()
+                except redis.RedisError:
+                    logger.exception("Could not check for expired leases")
+
+        thread = threading.Thread(target=reap, name=f"{self._main_q_key}-reaper", daemon=True)
+        thread.stop = stop.set
+        thread.start()
+        return thread
 
     def _itemkey(self, item):
         """Returns a string that uniquely identifies an item (bytes)."""
@@ -76,42 +354,255 @@ class RedisWQ(object):
 
     def _lease_exists(self, item):
         """True if a lease on 'item' exists."""
-        return self._db.exists(self._lease_key_prefix + self._itemkey(item))
+        return self._db.zscore(self._leases_key, item) is not None
 
-    def lease(self, lease_secs=60, block=True, timeout=None):
-        """Begin working on an item the work queue. 
+    def lease(self, lease_secs=60, block=True, timeout=None, poll_secs=1):
+        """Begin working on an item the work queue.
 
         Lease the item for lease_secs.  After that time, other
         workers may consider this client to have crashed or stalled
         and pick up the item instead.
 
         If optional args block is true and timeout is None (the default), block
-        if necessary until an item is available."""
-        if block:
-            item = self._db.brpoplpush(self._main_q_key, self._processing_q_key, timeout=timeout)
-        else:
-            item = self._db.rpoplpush(self._main_q_key, self._processing_q_key)
-        if item:
-            # Record that we (this session id) are working on a key.  Expire that
-            # note after the lease timeout.
-            # Note: if we crash at this line of the program, then GC will see no lease
-            # for this item a later return it to the main queue.
-            itemkey = self._itemkey(item)
-            self._db.setex(self._lease_key_prefix + itemkey, lease_secs, self._session)
-        return item
+        if necessary until an item is available. Blocking polls every
+        poll_secs, as there is no blocking pop that can also record the lease."""
+        item = self._try_lease(lease_secs)
+        if item is not None or not block:
+            return item
+        waited = 0
+        while timeout is None or waited < timeout:
+            time.sleep(poll_secs)
+            waited += poll_secs
+            item = self._try_lease(lease_secs)
+            if item is not None:
+                return item
+        return None
+
+    def _lane_order(self):
+        """Lanes to try, in smooth weighted round robin order (as nginx balances upstreams)."""
+        total = sum(weight for _, weight in self._lanes)
+        for key, weight in self._lanes:
+            self._lane_credit[key] += weight
+        order = sorted(self._lane_credit, key=self._lane_credit.get, reverse=True)
+        self._lane_credit[order[0]] -= total
+        return order
+
+    def _try_lease(self, lease_secs):
+        items = self.lease_many(1, lease_secs)
+        return items[0] if items else None
+
+    def lease_many(self, count, lease_secs=60):
+        """Lease up to 'count' items in one round trip, without blocking.
+
+        Items come from the lanes in weighted round robin order, filling from
+        the first lane before moving on to the next. Returns a list, which is
+        empty if there is no work or the rate limit is reached.
+        """
+        items = self._lease_script(
+            keys=[self._processing_q_key, self._leases_key, self._owners_key, self._pending_key,
+                  self._pending_items_key, self._pending_lanes_key, self._item_lanes_key, self._rate_key] +
+                 self._lane_order(),
+            args=[self._session, lease_secs, self._rate_limit, self._rate_window, count])
+        if items == -1:
+            logger.debug(f"{self._main_q_key} is at its rate limit of {self._rate_limit} per {self._rate_window}s")
+            return []
+        return items
+
+    def enqueue(self, job, merge_fields=('s3_dir',), lane="normal"):
+        """Add a job (a dict of prepare function arguments) to the queue.
+
+        Jobs for the same scene are identified by all their fields except
+        merge_fields. If one is already waiting, the new job is dropped, or,
+        if it brings new merge_fields values (e.g. another s3_dir), those are
+        merged into the waiting job as a list so the scene is downloaded and
+        processed once and uploaded to every target.
+
+        A scene already leased by a worker is queued again: the prepare
+        functions skip it if it turns out to be published by then. The very
+        same job is not, until the leased one completes or is dead-lettered,
+        as both copies would share one lease. A scene waiting in a lower
+        priority lane is moved to 'lane'.
+
+        Returns "queued", "merged", "promoted" or "duplicate".
+        """
+        identity = {k: v for k, v in job.items() if k not in merge_fields}
+        key = self._itemkey(json.dumps(identity, sort_keys=True).encode("utf-8"))
+        while True:
+            current = self._db.hget(self._pending_key, key)
+            merged = job if current is None else _merge_jobs(json.loads(current), job, merge_fields)
+            payload = json.dumps(merged, sort_keys=True)
+            result = self._enqueue_script(
+                keys=[self._pending_key, self._pending_items_key, self._pending_lanes_key, self._enqueued_key] +
+                     [key for key, _ in self._lanes],
+                args=[key, current or '', payload, self.lane_key(lane)])
+            if result >= 0:
+                return ("duplicate", "queued", "merged", "promoted")[result]
+
+    def enqueue_many(self, jobs, merge_fields=('s3_dir',), lane="normal"):
+        """enqueue() each job; returns how many were queued, merged, promoted and dropped as duplicates."""
+        counts = {"queued": 0, "merged": 0, "promoted": 0, "duplicate": 0}
+        for job in jobs:
+            counts[self.enqueue(job, merge_fields, lane)] += 1
+        logger.info(f"Enqueued on {self._main_q_key}: {counts}")
+        return counts
+
+    def renew(self, item, lease_secs=60):
+        """Extend the lease on 'item' to lease_secs from now.
+
+        Returns False if this session no longer holds the lease, in which case
+        another worker may already be processing the item.
+        """
+        return bool(self._renew_script(
+            keys=[self._leases_key, self._owners_key],
+            args=[item, self._session, lease_secs]))
 
     def complete(self, value):
         """Complete working on the item with 'value'.
 
-        If the lease expired, the item may not have completed, and some
-        other worker may have picked it up.  There is no indication
-        of what happened.
+        If the lease expired and some other worker has picked the item up,
+        their copy is left alone and False is returned.
         """
-        self._db.lrem(self._processing_q_key, 0, value)
-        # If we crash here, then the GC code will try to move the value, but it will
-        # not be here, which is fine.  So this does not need to be a transaction.
-        itemkey = self._itemkey(value)
-        self._db.delete(self._lease_key_prefix + itemkey, self._session)
+        return bool(self._complete_script(
+            keys=[self._main_q_key, self._processing_q_key, self._leases_key,
+                  self._owners_key, self._attempts_key, self._item_lanes_key, self._enqueued_key,
+                  self._completed_key, self._pending_items_key],
+            args=[value, self._session, self.THROUGHPUT_WINDOW]))
+
+    def complete_many(self, items):
+        """complete() each of 'items' in one round trip; returns a list of the results."""
+        pipe = self._db.pipeline(transaction=False)
+        for item in items:
+            self._complete_script(
+                keys=[self._main_q_key, self._processing_q_key, self._leases_key,
+                      self._owners_key, self._attempts_key, self._item_lanes_key, self._enqueued_key,
+                      self._completed_key, self._pending_items_key],
+                args=[item, self._session, self.THROUGHPUT_WINDOW], client=pipe)
+        return [bool(done) for done in pipe.execute()]
+
+    def release(self, items):
+        """Give back leased items this session won't start, to the head of their lanes.
+
+        Unlike an expired lease, this doesn't count as an attempt. Returns the
+        number of items released.
+        """
+        if not items:
+            return 0
+        return self._release_script(
+            keys=[self._main_q_key, self._processing_q_key, self._leases_key, self._owners_key,
+                  self._item_lanes_key],
+            args=[self._session] + list(items))
+
+    def queue_wait(self, item):
+        """Seconds since 'item' was enqueue()d, or None for items pushed some other way."""
+        pipe = self._db.pipeline(transaction=False)
+        pipe.hget(self._enqueued_key, item)
+        pipe.time()
+        enqueued, (secs, usecs) = pipe.execute()
+        if enqueued is None:
+            return None
+        return secs + usecs / 1e6 - float(enqueued)
+
+    def stats(self, window=900):
+        """Queue depth, leases, backlog age and recent throughput, as a dict.
+
+        "oldest_age_secs" is the wait of the oldest job at the head of a lane
+        (None if no head job was enqueue()d). "workers" counts sessions holding
+        a lease or that completed a job in the last 'window' seconds, and
+        "per_worker_per_hour" is the hourly rate of those that completed any
+        (None until one has).
+        """
+        window = min(window, self.THROUGHPUT_WINDOW)
+        pipe = self._db.pipeline(transaction=False)
+        for key, _ in self._lanes:
+            pipe.llen(key)
+            pipe.lindex(key, 0)
+        pipe.zcard(self._leases_key)
+        pipe.llen(self._dead_q_key)
+        pipe.hvals(self._owners_key)
+        pipe.time()
+        results = pipe.execute()
+        lanes, heads = results[:-4:2], results[1:-4:2]
+        leased, dead, owners, (secs, usecs) = results[-4:]
+        now = secs + usecs / 1e6
+
+        completed = self._db.zrangebyscore(self._completed_key, now - window, "+inf")
+        heads = [head for head in heads if head is not None]
+        enqueued = [float(t) for t in self._db.hmget(self._enqueued_key, heads) if t is not None] if heads else []
+        workers = set(owners) | {c.split(b"|")[0] for c in completed}
+        finished_by = {c.split(b"|")[0] for c in completed}
+
+        return {
+            "queued": dict(zip(self._lane_names, lanes)),
+            "depth": sum(lanes),
+            "leased": leased,
+            "dead": dead,
+            "oldest_age_secs": now - min(enqueued) if enqueued else None,
+            "completed": len(completed),
+            "workers": len(workers),
+            "per_worker_per_hour": len(completed) / len(finished_by) * 3600 / window if completed else None,
+        }
+
+
+def _as_list(value):
+    if value is None:
+        return []
+    return list(value) if isinstance(value, (list, tuple)) else [value]
+
+
+def _merge_jobs(queued, job, merge_fields):
+    """Union job's merge_fields values into the queued job, keeping single values unwrapped."""
+    merged = dict(queued)
+    for field in merge_fields:
+        if field not in job:
+            continue
+        values = _as_list(queued.get(field))
+        values += [v for v in _as_list(job[field]) if v not in values]
+        merged[field] = values[0] if len(values) == 1 else values
+    return merged
+
+
+class LeaseHeartbeat(object):
+    """Keep renewing the lease on an item while a long stage runs.
+
+    with LeaseHeartbeat(q, item, lease_secs=600):
+        prepareS2(**job)
+
+    The lease is renewed every lease_secs / 3, so a live worker never loses
+    it, while a dead one loses it within lease_secs.
+    """
+    def __init__(self, queue, item, lease_secs=60, interval=None):
+        self._queue = queue
+        self._item = item
+        self._lease_secs = lease_secs
+        self._interval = interval or max(lease_secs / 3, 1)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._beat, daemon=True)
+        self.lost = False
+
+    def _beat(self):
+        while not self._stop.wait(self._interval):
+            try:
+                if not self._queue.renew(self._item, self._lease_secs):
+                    logger.warning(f"Lost lease on {self._item!r}, another worker may pick it up")
+                    self.lost = True
+                    return
+            except redis.RedisError:
+                logger.exception("Could not renew lease, will retry")
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+        return False
 
 # TODO: add functions to clean up all keys associated with "name" when
 # processing is complete.
@@ -124,7 +615,3 @@ class RedisWQ(object):
 # TODO(etune): move to my own github for hosting, e.g. github.com/erictune/rediswq-py and
 # make it so it can be pip installed by anyone (see
 # http://stackoverflow.com/questions/8247605/configuring-so-that-pip-install-can-work-from-github)
-
-# TODO(etune): finish code to GC expired leases, and call periodically
-#  e.g. each time lease times out.
-
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+
+"""
+Summarise the run-report.json files under a bucket prefix (see
+workflows/utils/run_report.py) into throughput and percentile tables, e.g.
+to compare scenes processed before and after an image upgrade:
+
+    python -m workflows.report_summary --bucket public-eo-data --prefix common_sensing/sentinel_2/ --by gdal
+
+Scenes are grouped by sensor, plus the tool versions named with --by.
+"""
+
+import argparse
+import json
+import logging
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import numpy as np
+
+from workflows.utils.prep_utils import s3_create_client, s3_list
+from workflows.utils.run_report import REPORT_NAME
+
+PERCENTILES = (50, 90, 99)
+
+mb = 1024 ** 2
+
+
+def load_reports(s3_bucket, prefix, threads=16):
+    """Every run report under s3_bucket/prefix."""
+    client, _ = s3_create_client(s3_bucket)
+    keys = [obj['Key'] for obj in s3_list(s3_bucket, prefix, depth=2) if obj['Key'].endswith('/' + REPORT_NAME)]
+    logging.info(f"Found {len(keys)} run reports under {s3_bucket}/{prefix}")
+
+    def load(key):
+        try:
+            return json.load(client.get_object(Bucket=s3_bucket, Key=key)['Body'])
+        except Exception:
+            logging.exception(f"Could not read {key}")
+            return None
+
+    with ThreadPoolExecutor(threads) as pool:
+        return [r for r in pool.map(load, keys) if r is not None]
+
+
+def _time(value):
+    return datetime.fromisoformat(value.rstrip('Z'))
+
+
+def _percentiles(values):
+    if not values:
+        return ['-'] * len(PERCENTILES)
+    return [f"{v:.1f}" for v in np.percentile(values, PERCENTILES)]
+
+
+def _table(header, rows):
+    widths = [max(len(str(c)) for c in column) for column in zip(header, *rows)]
+    lines = ['  '.join(str(c).ljust(w) for c, w in zip(row, widths)) for row in [header] + rows]
+    lines.insert(1, '  '.join('-' * w for w in widths))
+    return '\n'.join(lines)
+
+
+def group_reports(reports, by=()):
+    groups = defaultdict(list)
+    for report in reports:
+        key = (report['sensor'],) + tuple(report.get('tools', {}).get(tool, '?') for tool in by)
+        groups[key].append(report)
+    return dict(sorted(groups.items()))
+
+
+def throughput_table(groups, by=()):
+    """Scenes, scenes/hour over the span they were processed in, download rate and scene percentiles."""
+    pct = [f"p{p}" for p in PERCENTILES]
+    header = ['sensor', *by, 'scenes', 'scenes/h', 'dl MB/s p50',
+              *[f"wall s {p}" for p in pct], 'cpu s p50', 'peak RSS MB p90']
+    rows = []
+    for key, reports in groups.items():
+        span = (max(_time(r['finished']) for r in reports) - min(_time(r['started']) for r in reports))
+        hours = span.total_seconds() / 3600
+        rates = [r['bytes']['downloaded'] / mb / r['stages']['download']['wall_seconds'] for r in reports
+                 if r['bytes'].get('downloaded') and r['stages'].get('download', {}).get('wall_seconds')]
+        rss = [max(r['peak_rss_bytes'], r['peak_child_rss_bytes']) / mb for r in reports]
+        rows.append([*key, len(reports), f"{len(reports) / hours:.1f}" if hours else '-',
+                     f"{np.median(rates):.1f}" if rates else '-',
+                     *_percentiles([r['wall_seconds'] for r in reports]),
+                     f"{np.median([r['cpu_seconds'] for r in reports]):.1f}",
+                     f"{np.percentile(rss, 90):.0f}"])
+    return _table(header, rows)
+
+
+def stage_table(groups, by=()):
+    """Wall time percentiles and CPU/wall per stage."""
+    header = ['sensor', *by, 'stage', 'scenes', *[f"wall s p{p}" for p in PERCENTILES], 'cpu/wall']
+    rows = []
+    for key, reports in groups.items():
+        stages = defaultdict(list)
+        for report in reports:
+            for name, stage in report['stages'].items():
+                stages[name].append(stage)
+        for name, runs in sorted(stages.items()):
+            wall = sum(s['wall_seconds'] for s in runs)
+            cpu = sum(s['cpu_seconds'] for s in runs)
+            rows.append([*key, name, len(runs), *_percentiles([s['wall_seconds'] for s in runs]),
+                         f"{cpu / wall:.2f}" if wall else '-'])
+    return _table(header, rows)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Summarise the ARD run reports under a bucket prefix.")
+    parser.add_argument("--bucket", required=True, help="bucket the scenes were uploaded to")
+    parser.add_argument("--prefix", required=True, help="e.g. common_sensing/sentinel_2/")
+    parser.add_argument("--by", default="", help="tool versions to split by as well as sensor, e.g. gdal,sen2cor")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    by = tuple(filter(None, args.by.split(',')))
+    groups = group_reports(load_reports(args.bucket, args.prefix), by)
+    print(throughput_table(groups, by))
+    print()
+    print(stage_table(groups, by))
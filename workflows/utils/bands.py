@@ -0,0 +1,173 @@
+"""
+Convert a scene's bands to COGs in parallel.
+
+A DEFLATE zlevel 9 band keeps a single core busy, so the conv_*scene_cogs
+functions hand their bands to cog_bands(), which runs them in a process pool
+sized to the CPUs this scene may use and to the memory left for them (see
+resources).
+
+A worker running several scenes at once gives each its WORKER_SCENE_CPUS
+(resources.scene_cpus), so the scenes' pools don't each take every CPU.
+CPUs the pool can't use (fewer bands than CPUs, or too little memory for
+more processes) become GDAL decode and compression threads in each band,
+passed to each band's func as threads=.
+
+Forking a process that runs other threads (pipeline stages, background
+uploads) can copy a lock some thread holds, so the pool's processes are
+started by a forkserver whenever this process has more than one thread.
+"""
+
+import logging
+import multiprocessing
+import os
+import threading
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import rasterio
+
+from . import resources, run_report
+
+mb = 1024 ** 2
+
+# used for a band whose size can't be read up front
+DEFAULT_BAND_MEM = resources.gb
+
+
+class BandError(Exception):
+    """One or more of a scene's bands could not be converted."""
+
+
+def cog_memory_limit():
+    """Bytes up to which cog_translate builds a raster in memory rather than in a temp file."""
+    return int(float(os.getenv("COG_MEMORY_LIMIT_MB") or 512) * mb)
+
+
+def raster_bytes(width, height, count, dtype):
+    """Uncompressed size of a raster with its overviews (1/4 + 1/16 + ... < 1/3 more)."""
+    return int(width * height * count * np.dtype(dtype).itemsize * 4 / 3)
+
+
+def band_memory(path):
+    """
+    Rough peak bytes to COG 'path': cog_translate holds the whole band and
+    its overviews in memory, at float32 if the band is scaled, unless that's
+    over cog_memory_limit() and it goes to a temp file instead.
+    """
+    try:
+        with rasterio.open(path) as src:
+            dtype = max(np.dtype(src.dtypes[0]), np.dtype("float32"), key=lambda d: d.itemsize)
+            size = raster_bytes(src.width, src.height, src.count, dtype)
+    except Exception:
+        logging.debug(f"Could not size {path}, assuming {DEFAULT_BAND_MEM} bytes")
+        return DEFAULT_BAND_MEM
+    return min(size, cog_memory_limit())
+
+
+def band_cpus():
+    """CPUs a scene converts its bands with: its worker's budget, COG_BAND_WORKERS or the pod's quota."""
+    return resources.scene_cpu_budget() or int(os.getenv("COG_BAND_WORKERS") or 0) or resources.cpu_count()
+
+
+def band_workers(bands, band_mem=DEFAULT_BAND_MEM):
+    """Processes to convert 'bands' bands of up to band_mem bytes each with."""
+    by_memory = resources.memory_available() // band_mem
+    return max(1, min(band_cpus(), by_memory, bands))
+
+
+def cog_threads():
+    """
+    Threads cog_translate has GDAL decode and compress with when not given
+    any: COG_THREADS, or 1. cog_bands gives each band its share of the CPUs.
+    """
+    return int(os.getenv("COG_THREADS") or 0) or 1
+
+
+def _pool_context():
+    """How to start band processes: fork, unless other threads are running here."""
+    if threading.active_count() > 1:
+        return multiprocessing.get_context("forkserver")
+    return multiprocessing.get_context()
+
+
+def _convert(func, args, threads):
+    try:
+        return func(*args, threads=threads), None
+    except Exception:
+        return None, traceback.format_exc()
+
+
+def _convert_in_pool(func, args, threads):
+    # the scene's report stays in the parent, so collect what the band adds to it and send that back
+    collector = run_report.RunReport(None)
+    with run_report.activate(collector):
+        result, error = _convert(func, args, threads)
+    return result, error, collector.cogs
+
+
+def _finished(done, args, error):
+    if done is not None and error is None:
+        done(args[1])
+
+
+def cog_bands(jobs, done=None):
+    """
+    Run func(in_path, out_path, *args, threads=n) for every (func, in_path, out_path, *args) in jobs.
+
+    Each band writes only its own out_path, so the COGs don't depend on how
+    many processes ran them. A band that fails doesn't stop the others and
+    its partial output is removed, so a retry doesn't skip it as done; once
+    every band has been tried, BandError names the ones that failed.
+
+    done(out_path), if given, is called for each band as soon as it is
+    converted (e.g. S3UploadQueue.put, to upload it while the rest convert).
+
+    Returns what each func returned (e.g. band stats), in the order of jobs.
+    """
+    jobs = [(job[0], tuple(job[1:])) for job in jobs]
+    if not jobs:
+        return []
+
+    workers = band_workers(len(jobs), max(band_memory(args[0]) for _, args in jobs))
+    # CPUs the pool leaves idle (fewer bands, or memory-capped) go to GDAL's threads
+    threads = max(1, band_cpus() // workers)
+    logging.info(f"Converting {len(jobs)} bands in {workers} processes of {threads} threads")
+
+    if workers == 1:
+        outcomes = []
+        for func, args in jobs:
+            outcomes.append(_convert(func, args, threads))
+            _finished(done, args, outcomes[-1][1])
+    else:
+        with ProcessPoolExecutor(workers, mp_context=_pool_context()) as pool:
+            futures = {pool.submit(_convert_in_pool, func, args, threads): n
+                       for n, (func, args) in enumerate(jobs)}
+            outcomes = [None] * len(jobs)
+            report = run_report.current()
+            for future in as_completed(futures):
+                n = futures[future]
+                try:
+                    result, error, cogs = future.result()
+                except Exception:
+                    # the band's process died, e.g. OOM killed
+                    result, error, cogs = None, traceback.format_exc(), {}
+                if report is not None:
+                    for name, check in cogs.items():
+                        report.add_cog(name, check['errors'], check['warnings'])
+                outcomes[n] = (result, error)
+                _finished(done, jobs[n][1], error)
+
+    failed = []
+    for (func, args), (_, error) in zip(jobs, outcomes):
+        if error is None:
+            continue
+        out_path = args[1]
+        logging.error(f"Could not convert {args[0]} to {out_path}:\n{error}")
+        if os.path.exists(out_path):
+            os.remove(out_path)
+        failed.append(out_path)
+
+    if failed:
+        raise BandError(f"{len(failed)} of {len(jobs)} bands failed: {failed}")
+    return [result for result, _ in outcomes]
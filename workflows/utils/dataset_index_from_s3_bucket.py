@@ -18,6 +18,12 @@ from ruamel.yaml import YAML
 from multiprocessing import Process, current_process, Queue, Manager, cpu_count
 from queue import Empty
 
+try:
+    from workflows.utils.s3_listing import list_objects
+except ImportError:
+    # run as a script from this directory
+    from s3_listing import list_objects
+
 GUARDIAN = "GUARDIAN_QUEUE_EMPTY"
 
 def get_s3_url(bucket_name, obj_key):
@@ -107,9 +113,8 @@ def iterate_datasets(bucket_name, config, prefix, start_date, end_date, func, un
         resource_config = None
 
     session=boto3.session.Session(profile_name=profile_name)
-    s3 = session.resource('s3', endpoint_url=endpoint_url, config=resource_config)
+    client = session.client('s3', endpoint_url=endpoint_url, config=resource_config)
 
-    bucket = s3.Bucket(bucket_name)
     logging.info("Bucket : %s prefix: %s ", bucket_name, str(prefix))
     worker_count = cpu_count() * 2
 
@@ -119,9 +124,10 @@ def iterate_datasets(bucket_name, config, prefix, start_date, end_date, func, un
         processess.append(proc)
         proc.start()
 
-    for obj in bucket.objects.filter(Prefix = str(prefix)):
-        if (obj.key.endswith(".yaml")):
-            queue.put(obj.key)
+    # scene dirs are listed concurrently, so workers start on yamls while the rest of the tree is listed
+    for obj in list_objects(client, bucket_name, str(prefix or ''), depth=2):
+        if (obj['Key'].endswith(".yaml")):
+            queue.put(obj['Key'])
 
     # Insert as many sentinels as workers, so each of them will pick one and finish processing
     for i in range(worker_count):
@@ -2,6 +2,7 @@ import yaml
 import glob
 import rasterio
 from rasterio.crs import CRS
+from rasterio.io import MemoryFile
 from affine import Affine
 import rioxarray
 import xarray as xr
@@ -28,6 +29,7 @@ import rioxarray as rxr
 from sklearn_xarray import wrap
 from sklearn.ensemble import RandomForestClassifier
 
+from workflows.utils import prep_utils
 from workflows.utils.prep_utils import *
 from workflows.utils.dc_import_export import export_xarray_to_geotiff
 
@@ -129,9 +131,11 @@ def band_name_water(prod_path):
     layer_name = prod_map[prod_name]
     return layer_name
 
-def yaml_prep_water(scene_dir, original_yml):
+def yaml_prep_water(scene_dir, original_yml, prod_paths=None, geometry=None):
     """
     Prepare individual wofs directory containing L8/S2/S1 cog water products.
+    For products streamed to S3 rather than written to scene_dir, pass their
+    prod_paths and their (projection, extent) geometry, see get_geometry.
     """
     # scene_name = scene_dir.split('/')[-2][:26]
     scene_name = scene_dir.split('/')[-2]
@@ -139,7 +143,7 @@ def yaml_prep_water(scene_dir, original_yml):
     print ( "Scene path {}".format(scene_dir) )
     
     # find all cog prods
-    prod_paths = glob.glob(scene_dir + '*water*.tif')
+    prod_paths = prod_paths or glob.glob(scene_dir + '*water*.tif')
     # print ( 'paths: {}'.format(prod_paths) )
     # for i in prod_paths: print ( i )
     
@@ -159,7 +163,7 @@ def yaml_prep_water(scene_dir, original_yml):
     print ( images )
 
     # trusting bands coaligned, use one to generate spatial bounds for all
-    projection, extent = get_geometry(os.path.join(str(scene_dir), images['watermask']['path']))
+    projection, extent = geometry or get_geometry(os.path.join(str(scene_dir), images['watermask']['path']))
 #     extent = 
     print(projection, extent)
     
@@ -200,13 +204,21 @@ def yaml_prep_water(scene_dir, original_yml):
 def genprepmlwater(img_yml_path, lab_yml_path,
                    inter_dir='../tmp/data/intermediate/',
                    s3_bucket='',
-                   s3_dir='common_sensing/fiji/mlwater_test/'):
+                   s3_dir='common_sensing/fiji/mlwater_test/',
+                   cog_profile=None):
     """
     optical_yaml_path: dc yml metadata of single image within S3 bucket
     summary_yaml_path: dc yml metadata of wofs-like summary product within S3 bucket
+    cog_profile: the job's COG profile choice, for products "water_mask" and "water_prob" (see prep_utils.cog_profile)
     """
 
     scene_name = os.path.dirname(img_yml_path).split('/')[-1]
+    profiles = {prod: prep_utils.cog_profile(prod, cog_profile) for prod in ('water_mask', 'water_prob')}
+
+    # products are uploaded to s3_dir/<scene_name>_mlwater/
+    published, s3_objects = s3_check_published(s3_bucket, s3_dir, scene_name, [scene_name + '_mlwater'])
+    if published:
+        return
 
     inter_dir = f"{inter_dir}{scene_name}_tmp/"
     os.makedirs(inter_dir, exist_ok=True)
@@ -225,6 +237,7 @@ def genprepmlwater(img_yml_path, lab_yml_path,
     root = setup_logging()
 
     root.info(f"{scene_name} Starting")
+    report = start_report('mlwater', scene_name)
 
     try: 
 
@@ -498,7 +511,8 @@ def genprepmlwater(img_yml_path, lab_yml_path,
                                            n_jobs=n_jobs,
                                            verbose=2
                                           ))
-            wrapper.estimator.fit(X, Y) # do training
+            with timed_stage('train'):
+                wrapper.estimator.fit(X, Y) # do training
         except:
             root.exception(f"{scene_name} Training failed")
             raise Exception('Model training error')
@@ -514,9 +528,10 @@ def genprepmlwater(img_yml_path, lab_yml_path,
 
             # PREDICT + ASSIGN CONFIDENCE
             X = xr_data.stack(z=['x','y']).to_array().transpose() # stack into transposed 2-d arr
-            pred = wrapper.estimator.predict(X) # gen class predictions
-            pred[pred==100] = 1
-            prob = wrapper.estimator.predict_proba(X)[:,1]*100 # gen confidence in assigned labels as int
+            with timed_stage('predict'):
+                pred = wrapper.estimator.predict(X) # gen class predictions
+                pred[pred==100] = 1
+                prob = wrapper.estimator.predict_proba(X)[:,1]*100 # gen confidence in assigned labels as int
 
             # RESHAPE OUTPUTS INTO IMAGE
             vars_0 = [i for i in X.transpose().to_dataset(dim='variable').data_vars] # get list of vars within img
@@ -543,8 +558,17 @@ def genprepmlwater(img_yml_path, lab_yml_path,
             out_prob_prod = inter_prodir + scene_name + '_waterprob.tif'
             output_crs = xr_data.rio.crs
 
-            export_xarray_to_geotiff(X_t, out_mask_prod, bands=['water_mask'], crs=output_crs, x_coord='x', y_coord='y', no_data=-9999)
-            export_xarray_to_geotiff(X_t, out_prob_prod, bands=['water_prob'], crs=output_crs, x_coord='x', y_coord='y', no_data=-9999)
+            # the GeoTIFFs stay in memory, and so do the COGs unless over COG_MEMORY_LIMIT_MB (see s3_stream_cog)
+            with MemoryFile(filename='watermask.tif') as mask_tif, MemoryFile(filename='waterprob.tif') as prob_tif:
+                with timed_stage('export'):
+                    export_xarray_to_geotiff(X_t, mask_tif.name, bands=['water_mask'], crs=output_crs, x_coord='x', y_coord='y', no_data=-9999)
+                    export_xarray_to_geotiff(X_t, prob_tif.name, bands=['water_prob'], crs=output_crs, x_coord='x', y_coord='y', no_data=-9999)
+                with timed_stage('cog'):
+                    for tif, out_prod, prod in ((mask_tif, out_mask_prod, 'water_mask'),
+                                                (prob_tif, out_prob_prod, 'water_prob')):
+                        s3_stream_cog(tif.name, out_prod, s3_bucket, s3_dir, profiles[prod], overview_level=5,
+                                      overview_resampling='nearest', dst_nodata=-9999)
+                water_geometry = get_geometry(mask_tif.name)
         except:
             root.exception(f"{scene_name} Water product export failed")
             raise Exception('Export error')
@@ -552,7 +576,9 @@ def genprepmlwater(img_yml_path, lab_yml_path,
         try:
             root.info(f"{scene_name} Creating yaml")
             # CREATE YML
-            create_yaml(inter_prodir, yaml_prep_water(inter_prodir, img_yml)) # assumes majority of meta copied from original product yml
+            with timed_stage('yaml'):
+                create_yaml(inter_prodir, yaml_prep_water(inter_prodir, img_yml, [out_mask_prod, out_prob_prod],
+                                                          water_geometry)) # assumes majority of meta copied from original product yml
         except:
             root.exception(f"{scene_name} yam not created")
             raise Exception('Yaml error')
@@ -560,10 +586,12 @@ def genprepmlwater(img_yml_path, lab_yml_path,
         try:
             root.info(f"{scene_name} Uploading to S3 Bucket")
             # UPLOAD
-            s3_upload_cogs(glob.glob(f'{inter_prodir}*'), s3_bucket, s3_dir)
+            with timed_stage('upload'):
+                s3_upload_cogs(glob.glob(f'{inter_prodir}*'), s3_bucket, s3_dir, s3_objects)
         except:
             root.exception(f"{scene_name} Upload to S3 Failed")
             raise Exception('S3  upload error')
+        s3_upload_run_report(inter_prodir, s3_bucket, s3_dir, report)
 
         img_yml = None
         lab_yml = None
@@ -15,10 +15,12 @@ import uuid
 import geopandas as gpd
 import rasterio
 import rasterio.features
+from rasterio.io import MemoryFile
 from osgeo import gdal
 
 from workflows.utils.dc_water_classifier import wofs_classify
 from workflows.utils.dc_clean_mask import landsat_qa_clean_mask
+from workflows.utils import prep_utils
 from workflows.utils.prep_utils import *
 from workflows.utils.dc_import_export import export_xarray_to_geotiff
 
@@ -30,32 +32,22 @@ def rename_bands(in_xr, des_bands, position):
     return in_xr
     
     
-def conv_sgl_wofs_cog(in_path, out_path, nodata=-9999):
+def conv_sgl_wofs_cog(in_path, out_path, nodata=-9999, profile=None):
     """
     Convert a single input file to COG format. Default settings via cogeo repository (funcs within prep_utils). 
     COG val TBC
     
     :param in_path: path to non-cog file
     :param out_path: path to new cog file
+    :param profile: creation options (default: cog_profile('water'))
     :return: 
     """
     print (in_path, out_path)    
-    # set default cog profile (as recommended by alex leith)
-    cog_profile = {
-        'driver': 'GTiff',
-        'interleave': 'pixel',
-        'tiled': True,
-        'blockxsize': 512,
-        'blockysize': 512,
-        'compress': 'DEFLATE',
-        'predictor': 2,
-        'zlevel': 9
-    }    
         
     cog_translate(
         in_path,
         out_path,
-        cog_profile,
+        profile or cog_profile('water'),
         overview_level=5,
         overview_resampling='average'
     )
@@ -71,9 +63,10 @@ def conv_sgl_wofs_cog(in_path, out_path, nodata=-9999):
 #         print ('not updated nodata')
 
 
-def yaml_prep_wofs(scene_dir, original_yml):
+def yaml_prep_wofs(scene_dir, original_yml, prod_paths=None):
     """
     Prepare individual wofs directory containing L8/S2/S1 cog water products.
+    Pass prod_paths for products streamed to S3 rather than written to scene_dir.
     """
     # scene_name = scene_dir.split('/')[-2][:26]
     scene_name = scene_dir.split('/')[-2]
@@ -81,7 +74,7 @@ def yaml_prep_wofs(scene_dir, original_yml):
     print ( "Scene path {}".format(scene_dir) )
     
     # find all cog prods
-    prod_paths = glob.glob(scene_dir + '*water.tif')
+    prod_paths = prod_paths or glob.glob(scene_dir + '*water.tif')
     # print ( 'paths: {}'.format(prod_paths) )
     # for i in prod_paths: print ( i )
     
@@ -183,10 +176,11 @@ def scale_and_clip_dataarray(dataarray: xr.DataArray, *, scale_factor=1, add_off
     return dataarray
     
     
-def per_scene_wofs(optical_yaml_path, s3_source=True, s3_bucket='', s3_dir='common_sensing/fiji/wofsdefault/', inter_dir='../tmp/data/intermediate/', aoi_mask=False, **kwargs):
+def per_scene_wofs(optical_yaml_path, s3_source=True, s3_bucket='', s3_dir='common_sensing/fiji/wofsdefault/', inter_dir='../tmp/data/intermediate/', aoi_mask=False, cog_profile=None, **kwargs):
     """
     Generate and prepare wofs (and wofs-like) products for .
     Assumes all data can be found and downoaded using relative locations within yaml & dir name contains unique scene_name.
+    The COG's compression is the job's cog_profile for product "water" (see prep_utils.cog_profile).
     
     To do:
     - inc. wofl as opposed to just wofs
@@ -196,6 +190,11 @@ def per_scene_wofs(optical_yaml_path, s3_source=True, s3_bucket='', s3_dir='comm
     """
     # Assume dirname of yml references name of the scene - should hold true for all ard-workflows prepared scenes
     scene_name = os.path.dirname(optical_yaml_path).split('/')[-1]
+    profile = prep_utils.cog_profile('water', cog_profile)
+
+    published, s3_objects = s3_check_published(s3_bucket, s3_dir, scene_name)
+    if published:
+        return
     
     inter_dir = f"{inter_dir}{scene_name}_tmp/"
     os.makedirs(inter_dir, exist_ok=True)
@@ -205,6 +204,7 @@ def per_scene_wofs(optical_yaml_path, s3_source=True, s3_bucket='', s3_dir='comm
     root = setup_logging()
 
     root.info(f"{scene_name} Starting")
+    report = start_report('wofs', scene_name)
         
     yml = f'{inter_dir}datacube-metadata.yaml'
     aoi = f'{inter_dir}mask_aoi.geojson'
@@ -221,29 +221,31 @@ def per_scene_wofs(optical_yaml_path, s3_source=True, s3_bucket='', s3_dir='comm
         
         try:
             root.info(f"{scene_name} Finding & Downloading yml & data")
-            # load yml plus download any needed files
-            if (s3_source) & (not os.path.exists(yml)):
-                s3_download(s3_bucket, optical_yaml_path, yml)
-                with open (yml) as stream: yml_meta = yaml.safe_load(stream)
-                satellite = yml_meta['platform']['code'] # helper to generalise masking 
-                des_bands = des_band_refs[satellite]
-                print(satellite, des_bands)
-                band_paths_s3 = [os.path.dirname(optical_yaml_path)+'/'+yml_meta['image']['bands'][b]['path'] for b in des_bands ]
-                band_paths_local = [inter_dir+os.path.basename(i) for i in band_paths_s3]
-                for s3, loc in zip(band_paths_s3, band_paths_local): 
-                    if not os.path.exists(loc):
-                        s3_download(s3_bucket, s3, loc)
-            elif os.path.exists(yml):
-                with open (yml) as stream: yml_meta = yaml.safe_load(stream)
-                satellite = yml_meta['platform']['code'] # helper to generalise masking 
-                des_bands = des_band_refs[satellite]
-            else:
-                print('boo')
-            if aoi_mask:
-                s3_download(s3_bucket, aoi_mask, aoi)
-            else:
-                aoi = False 
+            with timed_stage('download'):
+                # load yml plus download any needed files
+                if (s3_source) & (not os.path.exists(yml)):
+                    s3_download(s3_bucket, optical_yaml_path, yml)
+                    with open (yml) as stream: yml_meta = yaml.safe_load(stream)
+                    satellite = yml_meta['platform']['code'] # helper to generalise masking 
+                    des_bands = des_band_refs[satellite]
+                    print(satellite, des_bands)
+                    band_paths_s3 = [os.path.dirname(optical_yaml_path)+'/'+yml_meta['image']['bands'][b]['path'] for b in des_bands ]
+                    band_paths_local = [inter_dir+os.path.basename(i) for i in band_paths_s3]
+                    for s3, loc in zip(band_paths_s3, band_paths_local): 
+                        if not os.path.exists(loc):
+                            s3_download(s3_bucket, s3, loc)
+                elif os.path.exists(yml):
+                    with open (yml) as stream: yml_meta = yaml.safe_load(stream)
+                    satellite = yml_meta['platform']['code'] # helper to generalise masking 
+                    des_bands = des_band_refs[satellite]
+                else:
+                    print('boo')
+                if aoi_mask:
+                    s3_download(s3_bucket, aoi_mask, aoi)
+                else:
+                    aoi = False 
             root.info(f"{scene_name} Found & Downloaded yml & data")
+            report.add_inputs(f'{inter_dir}*.tif')
         except:
             root.exception(f"{scene_name} Yaml or band files can't be found")
             raise Exception('Download Error')
@@ -303,7 +305,8 @@ def per_scene_wofs(optical_yaml_path, s3_source=True, s3_bucket='', s3_dir='comm
 
         try:
             root.info(f"{scene_name} Water classification")
-            water_classes = wofs_classify(clearsky_scenes, no_data = np.nan , x_coord='x', y_coord = "y") # will work for s2 if eqv bands formatted
+            with timed_stage('classify'):
+                water_classes = wofs_classify(clearsky_scenes, no_data = np.nan , x_coord='x', y_coord = "y") # will work for s2 if eqv bands formatted
 #             water_classes = woffles(clearsky_scenes) # will work for s2 if eqv bands formatted
             
             # TO DO - add extra line to apply S1 classifier 
@@ -337,16 +340,16 @@ def per_scene_wofs(optical_yaml_path, s3_source=True, s3_bucket='', s3_dir='comm
         try:
             root.info(f"{scene_name} Exporting water product")            
             dataset_to_output = water_classes
-            if 'MSIL2A' in inter_dir:
-                output_file_name = f'{inter_dir}{"_".join(yml_meta["image"]["bands"]["blue"]["path"].split("_")[:4])}_waternc.tif' # can't
-            else:
-                output_file_name = f'{inter_dir}{"_".join(yml_meta["image"]["bands"]["blue"]["path"].split("_")[:7])}_waternc.tif' # can't write directly to cog...(?)
-            export_xarray_to_geotiff(dataset_to_output, output_file_name, x_coord='x', y_coord='y', crs=bands_data.attrs['crs'])
             if 'MSIL2A' in inter_dir:
                 output_cog_name = f'{cog_dir}{"_".join(yml_meta["image"]["bands"]["blue"]["path"].split("_")[:4])}_water.tif'
             else:
                 output_cog_name = f'{cog_dir}{"_".join(yml_meta["image"]["bands"]["blue"]["path"].split("_")[:7])}_water.tif'
-            conv_sgl_wofs_cog(output_file_name, output_cog_name)
+            # the GeoTIFF stays in memory, and so does the COG unless it is over COG_MEMORY_LIMIT_MB (see s3_stream_cog)
+            with MemoryFile(filename='waternc.tif') as water_nc:
+                export_xarray_to_geotiff(dataset_to_output, water_nc.name, x_coord='x', y_coord='y', crs=bands_data.attrs['crs'])
+                with timed_stage('cog'):
+                    s3_stream_cog(water_nc.name, output_cog_name, s3_bucket, s3_dir, profile,
+                                  overview_level=5, overview_resampling='average')
             root.info(f"{scene_name} Exported COG water product")
         except:
             root.exception(f"{scene_name} Water product export failed")
@@ -354,7 +357,8 @@ def per_scene_wofs(optical_yaml_path, s3_source=True, s3_bucket='', s3_dir='comm
             
         try:
             root.info(f"{scene_name} Creating yaml")
-            create_yaml(cog_dir, yaml_prep_wofs(cog_dir, yml_meta)) # assumes majority of meta copied from original product yml
+            with timed_stage('yaml'):
+                create_yaml(cog_dir, yaml_prep_wofs(cog_dir, yml_meta, [output_cog_name])) # assumes majority of meta copied from original product yml
             root.info(f"{scene_name} Created yaml")
         except:
             root.exception(f"{scene_name} yam not created")
@@ -362,7 +366,8 @@ def per_scene_wofs(optical_yaml_path, s3_source=True, s3_bucket='', s3_dir='comm
 
         try:
             root.info(f"{scene_name} Uploading to S3 Bucket")
-            s3_upload_cogs(glob.glob(f'{cog_dir}*'), s3_bucket, s3_dir)
+            with timed_stage('upload'):
+                s3_upload_cogs(glob.glob(f'{cog_dir}*'), s3_bucket, s3_dir, s3_objects)
             root.info(f"{scene_name} Uploaded to S3 Bucket")
         except:
             root.exception(f"{scene_name} Upload to S3 Failed")
@@ -378,6 +383,7 @@ def per_scene_wofs(optical_yaml_path, s3_source=True, s3_bucket='', s3_dir='comm
         # Tidy up log file to ensure upload
         shutil.move(log_file, cog_dir + 'log_file.txt')
         s3_upload_cogs(glob.glob(cog_dir + '*log_file.txt'), s3_bucket, s3_dir)
+        s3_upload_run_report(cog_dir, s3_bucket, s3_dir, report)
                 
         # DELETE ANYTHING WITIN TEH TEMP DIRECTORY
         cmd = 'rm -frv {}'.format(inter_dir)
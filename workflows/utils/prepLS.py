@@ -1,3 +1,4 @@
+import re
 import uuid
 import requests
 import glob
@@ -6,9 +7,10 @@ import logging
 from dateutil.parser import parse
 import tarfile
 from workflows.utils.prep_utils import *
+from workflows.utils.scaling import scaler, window_stats
 from typing import List
 import shutil
-import rioxarray as rxr
+from workflows.pipeline import Stage, run_stages
 
 
 def download_scene(
@@ -226,182 +228,96 @@ def band_name_l8(prod_path):
     return layer_name
 
 
-def scale_landsat_l2(untar_dir, scale_dir, new_dtype="float32"):
-    """
-    Apply scale factor to Landsat Level-2 Surface Reflectance + Surface Temperature Data
-    Surface Reflectance: Scale factor of 0.0000275 + offset of -0.2
-    Surface Temperature: Scale factor of 0.00341802 + offset of 149.0
-    https://www.usgs.gov/faqs/why-are-fill-values-and-scaling-factors-landsat-collection-2-level-2-products-different-those
-
-    Typical values for landsat surface reflectance should be between 0 and 1 with some values over 1.
+# Variable scale factors for supplementary ST bands
+LS_ST_SCALE_FACTORS = {
+    "st_trad": 0.001,
+    "st_urad": 0.001,
+    "st_drad": 0.001,
+    "st_atran": 0.0001,
+    "st_emis": 0.0001,
+    "st_emsd": 0.0001,
+    "st_cdist": 0.01,
+    "st_qa": 0.01,
+}
 
-    Note: Check on assigning new data type of float32 and converting to COG multiple times.
+def landsat_l2_scaling(prod_name):
     """
-    # All files in the directory (includes QA bands and xml file) but avoids any files in subdirectories
-    filenames = [f for f in glob.glob(f"{untar_dir}/*") if os.path.isfile(f)]
-
-    # Variable scale factors for supplementary ST bands
-    scale_factor_map = {
-        "st_trad": 0.001,
-        "st_urad": 0.001,
-        "st_drad": 0.001,
-        "st_atran": 0.0001,
-        "st_emis": 0.0001,
-        "st_emsd": 0.0001,
-        "st_cdist": 0.01,
-        "st_qa": 0.01,
-    }
+    (scale factor, offset, nodata) for a Collection 2 Level-2 product, e.g.
+    "sr_b4", or None for products that are not rescaled (QA bands).
+    """
+    # Surface reflectance bands
+    if prod_name.startswith("sr_b"):
+        return 0.0000275, -0.2, 0
+    # Surface temperature bands
+    if prod_name.startswith("st_b"):
+        return 0.00341802, 149.0, 0
+    # Supplementary ST bands
+    if prod_name in LS_ST_SCALE_FACTORS:
+        return LS_ST_SCALE_FACTORS[prod_name], 0, -9999
+    return None
+
+
+def scale_cog_landsat_l2(untar_dir, cog_dir, new_dtype="float32", overwrite=False, cog_profiles=None,
+                         storage="float", done=None):
+    """
+    Rescale the Level-2 bands in untar_dir straight into COGs in cog_dir, one
+    read and one encode per band (see conv_sgl_scaled_cog). Bands without a
+    scale factor (QA) are COG'd as they are.
+
+    Non-tif files are left for copy_l8_metadata. cog_profiles picks each
+    band's compression, see prep_utils.cog_profile. With storage
+    "scaled-int" the bands keep their integer DNs and are tagged with the
+    scale factor instead (see prep_utils.conv_sgl_scale_tagged_cog).
+    done(out_path) is called as each COG is finished, see cog_bands.
+    """
+    os.makedirs(cog_dir, exist_ok=True)
 
-    for f in filenames:
-        f_name = f.split("/")[-1]
-        out_path = f"{scale_dir}{f_name}"
+    jobs = []
+    for in_path in glob.glob(f"{untar_dir}*.tif"):
+        f_name = os.path.basename(in_path)
+        out_path = f"{cog_dir}{f_name}"
+        if os.path.exists(out_path) and not overwrite:
+            logging.info(f"cog already exists: {out_path}")
+            continue
 
-        # Split the file name to figure out the product
         file_parts = f_name.split("_")
         prod_name = f"{file_parts[-2]}_{file_parts[-1][:-4]}".lower()
 
-        # Apply scaling for surface reflectance bands
-        if prod_name.startswith("sr_b"):
-            scale_factor = 0.0000275
-            add_offset = -0.2
-            nodata = 0
-            apply_scale_factor_landsat(
-                f, scale_factor, add_offset, nodata, out_path, new_dtype
-            )
-            logging.info(
-                f"Prod name {prod_name} scaled with scale factor {scale_factor}, offset {add_offset}"
-            )
-
-        # Apply scaling for surface temperature bands
-        elif prod_name.startswith("st_b"):
-            scale_factor = 0.00341802
-            add_offset = 149.0
-            nodata = 0
-            apply_scale_factor_landsat(
-                f, scale_factor, add_offset, nodata, out_path, new_dtype
-            )
-            logging.info(
-                f"Prod name {prod_name} scaled with scale factor {scale_factor}, offset {add_offset}"
-            )
-
-        # Apply scaling for supplementary ST bands
-        elif prod_name in list(scale_factor_map.keys()):
-            scale_factor = scale_factor_map[prod_name]
-            add_offset = 0
-            nodata = -9999
-            apply_scale_factor_landsat(
-                f, scale_factor, add_offset, nodata, out_path, new_dtype
-            )
+        profile = cog_profile(prod_name, cog_profiles)
+        scaling = landsat_l2_scaling(prod_name)
+        if scaling is not None:
+            scale_factor, add_offset, nodata = scaling
+            if storage == "scaled-int":
+                jobs.append((conv_sgl_scale_tagged_cog, in_path, out_path, scale_factor, add_offset, nodata,
+                             profile))
+            else:
+                jobs.append((conv_sgl_scaled_cog, in_path, out_path, scale_factor, add_offset, nodata, new_dtype,
+                             profile))
             logging.info(
-                f"Prod name {prod_name} scaled with scale factor {scale_factor}, offset {add_offset}"
+                f"Prod name {prod_name} to scale with scale factor {scale_factor}, offset {add_offset}"
             )
-
-        # For any remaining files (QA band, xml, etc.), just copy into new directory
         else:
-            shutil.copy(f, out_path)
-            logging.info(f"Prod name {prod_name} copied to new directory")
+            jobs.append((conv_sgl_cog, in_path, out_path, 0, profile))
 
+    record_band_stats({job[2]: stats for job, stats in zip(jobs, cog_bands(jobs, done))})
 
-def apply_scale_factor_landsat(
-    input_data, scale_factor, add_offset, nodata, out_path, new_dtype="float32"
-):
-    """
-    Apply the scale factor to a tif of a landsat product.
-    """
 
-    # Open the tif as xarray to apply scale factor + offset
-    logging.info(f"Scaling {input_data}")
-    img_arr = rxr.open_rasterio(input_data)
-
-    # Nodata mask (nodata value of 0 for Landsat Collection 2)
-    mask = img_arr.data == nodata
-
-    # Apply the scale factor and offset
-    img_arr_rescaled = img_arr * scale_factor + add_offset
-
-    # New datatype of float32 because new values are often less than 1
-    img_arr_rescaled = img_arr_rescaled.astype(new_dtype)
-
-    # Making sure any original nodata is still nodata (I think?)
-    img_arr_rescaled.data[mask] = nodata
-
-    # Convert xarray to COG
-    img_arr_rescaled.rio.to_raster(raster_path=out_path, driver="COG")
-
-
-def conv_lsscene_cogs(untar_dir, cog_dir, overwrite=False):
-    """
-    Convert products to cogs [+ validate TBC].
-
-    :param untar_dir: Downloaded S2 product directory (i.e. via ESA or GCloud; assumes .SAFE structure)
-    :param cog_dir: directory in which to create the output COGs
-    :param overwrite: Binary for whether to overwrite or skip existing COG files)
-    :return:
-    """
-
-    if not os.path.exists(untar_dir):
-        logging.warning("Cannot find original scene directory: {}".format(untar_dir))
-
-    # create cog scene directory
-    if not os.path.exists(cog_dir):
-        logging.info("Creating scene cog directory: {}".format(cog_dir))
-        os.mkdir(cog_dir)
-    prod_paths = glob.glob(f"{untar_dir}/*.tif")
-
-    # iterate over prods to create parellel processing list
-    for prod in prod_paths:
-        in_filename = prod
-        out_filename = f"{cog_dir}{os.path.basename(in_filename)[:-4]}.tif"
-
-        # ensure input file exists
-        if os.path.exists(in_filename):
-            # ensure output cog doesn't already exist
-            if not os.path.exists(out_filename):
-                conv_sgl_cog(in_filename, out_filename)
-
-            else:
-                logging.info("cog already exists: {}".format(out_filename))
-        else:
-            logging.warning("cannot find product: {}".format(in_filename))
-
-
-def conv_sgl_cog(in_path, out_path):
+def conv_sgl_scaled_cog(in_path, out_path, scale_factor, add_offset, nodata, new_dtype="float32", profile=None,
+                        threads=None):
     """
-    Convert a single input file to COG format. Default settings via cogeo repository (funcs within prep_utils).
-    COG val TBC
+    Rescale a Level-2 band as it is COG'd: each block is scaled (through a
+    lookup table, see scaling.py) between being read and written, original
+    nodata stays nodata, and the output is tagged with it.
 
-    :param in_path: path to non-cog file
-    :param out_path: path to new cog file
-    :return:
+    Returns the scaled band's stats, gathered in the same pass.
     """
-    logging.debug(f"in: {in_path}, out: {out_path}")
-    # set default cog profile (as recommended by alex leith)
-    cog_profile = {
-        "driver": "GTiff",
-        "interleave": "pixel",
-        "tiled": True,
-        "blockxsize": 512,
-        "blockysize": 512,
-        "compress": "DEFLATE",
-        "predictor": 2,
-        "zlevel": 9,
-    }
-
+    stats = window_stats(scale_factor, add_offset, nodata, new_dtype)
     cog_translate(
-        in_path, out_path, cog_profile, overview_level=5, overview_resampling="average"
+        in_path, out_path, profile or COG_PROFILE, overview_level=5, overview_resampling="average",
+        transform=scaler(scale_factor, add_offset, nodata, new_dtype, stats=stats), dtype=new_dtype,
+        dst_nodata=nodata, threads=threads,
     )
-
-    ds = gdal.Open(in_path, gdal.GA_Update)
-    if ds is not None:
-        b = ds.GetRasterBand(1)
-        b.SetNoDataValue(0)
-        b.FlushCache()
-        b = None
-        ds = None
-    else:
-        logging.info("not updated nodata")
-
-    # should inc. cog val...
+    return stats.to_dict()
 
 
 def copy_l8_metadata(untar_dir, cog_dir):
@@ -475,7 +391,7 @@ def yaml_prep_landsat(scene_dir):
     for prod_path in prod_paths:
         name = band_name_landsat(prod_path)
         if name is not "unknown":
-            images[name] = {"path": str(split_all(prod_path)[-1])}
+            images[name] = dict(path=str(split_all(prod_path)[-1]), **band_scaling(prod_path))
 
     logging.info(images)
 
@@ -530,11 +446,43 @@ def yaml_prep_landsat(scene_dir):
     }
 
 
-def prepareLS(in_scene, s3_bucket="", s3_dir="", prodlevel="", item=""):
+def ls_scene_name_candidates(ls_url):
+    """
+    Scene names an ESPA order can produce, worked out from its URL before downloading.
+
+    "LC080790742021120702T1-SC20230922144241.tar.gz" -> LC08_L2SP_079074_20211207 or
+    LC08_L2SR_079074_20211207; whether the order has surface temperature (L2SP)
+    is only known from the tarball. Returns [] for URLs in any other form.
+    """
+    match = re.match(r"(L[COTE]0\d)(\d{6})(\d{8})\d{2}T\w", os.path.basename(ls_url))
+    if not match:
+        return []
+    sensor, pathrow, date = match.groups()
+    return [f"{sensor}_{level}_{pathrow}_{date}" for level in ("L2SP", "L2SR")]
+
+
+def ls_download(job):
+    """
+    Pipeline stage: download the scene tarball and lay out its working directories.
+
+    Returns the job dict extended with the scene name and directories used by
+    the later stages, or None if the scene is already published.
+    """
     root = setup_logging()
+    report = start_report("landsat")
     inter_dir = "/tmp/data/intermediate/"
-    ls_url = in_scene
-    downloaded_file_path, filenames = download_scene(ls_url, inter_dir + "download/")
+    ls_url = job["in_scene"]
+
+    candidates = ls_scene_name_candidates(ls_url)
+    published = {}
+    for candidate in candidates:
+        done, objects = s3_check_published(job["s3_bucket"], job["s3_dir"], candidate)
+        if done:
+            return None
+        published.update(objects)
+
+    with timed_stage("download"):
+        downloaded_file_path, filenames = download_scene(ls_url, inter_dir + "download/")
     logging.info(f"Downloaded {filenames}")
     filenames = [f for f in filenames if f.endswith((".tif", ".tiff", ".TIF", ".TIFF"))]
     logging.info(f"Filtered {filenames}")
@@ -542,6 +490,15 @@ def prepareLS(in_scene, s3_bucket="", s3_dir="", prodlevel="", item=""):
     first_file = filenames[0]
     tokens = first_file.split("_")
     scene_name = "_".join(tokens[:4])
+    report.scene = scene_name
+    report.add_input(downloaded_file_path)
+
+    if scene_name not in candidates:
+        # URL not in the usual ESPA form, so the check has to wait for the tarball
+        done, published = s3_check_published(job["s3_bucket"], job["s3_dir"], scene_name)
+        if done:
+            os.remove(downloaded_file_path)
+            return None
 
     # Tmp directory to hold everything for scene
     inter_dir = f"{inter_dir}{scene_name}_tmp/"
@@ -551,82 +508,130 @@ def prepareLS(in_scene, s3_bucket="", s3_dir="", prodlevel="", item=""):
     untar_dir = f"{inter_dir}{scene_name}_untar/"
     os.makedirs(untar_dir, exist_ok=True)
 
-    # Scale directory holds the tifs after they are scaled
-    scale_dir = f"{inter_dir}{scene_name}_scale/"
-    os.makedirs(scale_dir, exist_ok=True)
-
-    # COG directory holds the final COGS (after scaling, re-cogging)
+    # COG directory holds the final COGS (scaled as they are cogged)
     cog_dir = f"{inter_dir}{scene_name}/"
     os.makedirs(cog_dir, exist_ok=True)
 
     logging.info(f"scene: {scene_name}\nuntar: {untar_dir}\ncog_dir: {cog_dir}")
     root.info(f"{scene_name} Starting")
 
+    return dict(job, scene_name=scene_name, tar_path=downloaded_file_path, inter_dir=inter_dir,
+                untar_dir=untar_dir, cog_dir=cog_dir, published=published, report=report)
+
+
+def ls_process(scene):
+    """Pipeline stage: extract, scale and COG the scene and write its yaml."""
+    root = setup_logging()
+    scene_name = scene["scene_name"]
+    untar_dir, cog_dir = scene["untar_dir"], scene["cog_dir"]
+
+    try:
+        root.info(f"{scene_name} DOWNLOADING via ESPA")
+        with timed_stage("extract"):
+            extract_scene(scene["tar_path"], untar_dir)
+        root.info(f"{scene_name} DOWNLOADed + EXTRACTED")
+    except Exception as e:
+        root.exception(f"{scene_name} CANNOT BE FOUND")
+        raise Exception("Download Error", e)
+
+    # each COG starts uploading as soon as it's written, while the rest are still being made
+    uploads = scene["uploads"] = S3UploadQueue(scene["s3_bucket"], scene["s3_dir"], scene["published"])
+
+    def cogged(out_path):
+        # the band's extracted input isn't read again, so the scene isn't held on disk twice
+        in_path = os.path.join(untar_dir, os.path.basename(out_path))
+        if os.path.exists(in_path):
+            os.remove(in_path)
+        uploads.put(out_path)
+
+    # Scale the data using landsat scale factors as it is converted to COGs
+    try:
+        root.info(f"{scene_name} Rescaling Values and Converting COGs")
+        with timed_stage("scale_cog"):
+            scale_cog_landsat_l2(untar_dir, cog_dir, new_dtype="float32", cog_profiles=scene.get("cog_profile"),
+                                 storage=storage_mode(scene.get("storage")), done=cogged)
+        root.info(f"{scene_name} SCALED + COGGED")
+    except Exception as e:
+        root.exception(f"{scene_name} CANNOT BE SCALED/COGGED")
+        raise Exception("COG Error", e)
+
     try:
-        try:
-            root.info(f"{scene_name} DOWNLOADING via ESPA")
-            extract_scene(downloaded_file_path, untar_dir)
-            root.info(f"{scene_name} DOWNLOADed + EXTRACTED")
-        except Exception as e:
-            root.exception(f"{scene_name} CANNOT BE FOUND")
-            raise Exception("Download Error", e)
-
-        # Scale the data using landsat scale factors
-        try:
-            root.info(f"{scene_name} Rescaling Values")
-            scale_landsat_l2(untar_dir, scale_dir, new_dtype="float32")
-            root.info(f"{scene_name} SCALED")
-        except:
-            root.exception(f"{scene_name} CANNOT BE SCALED")
-            raise Exception("Scaling error", e)
-
-        # Convert the scaled (cogs) to cogs again
-        try:
-            root.info(f"{scene_name} Converting COGs")
-            conv_lsscene_cogs(scale_dir, cog_dir)
-            root.info(f"{scene_name} COGGED")
-        except Exception as e:
-            root.exception(f"{scene_name} CANNOT BE COGGED")
-            raise Exception("COG Error", e)
-
-        try:
-            root.info(f"{scene_name} Copying metadata")
+        root.info(f"{scene_name} Copying metadata")
+        with timed_stage("metadata"):
             copy_l8_metadata(untar_dir, cog_dir)
-            root.info(f"{scene_name} Copied metadata")
-        except Exception as e:
-            root.exception(f"{scene_name} metadata not copied")
-            raise Exception("Metadata copy error", e)
+        root.info(f"{scene_name} Copied metadata")
+    except Exception as e:
+        root.exception(f"{scene_name} metadata not copied")
+        raise Exception("Metadata copy error", e)
 
-        try:
-            root.info(f"{scene_name} Creating yaml")
+    try:
+        root.info(f"{scene_name} Creating yaml")
+        with timed_stage("yaml"):
             create_yaml(cog_dir, yaml_prep_landsat(cog_dir))
-            root.info(f"{scene_name} Created yaml")
-        except Exception as e:
-            root.exception(f"{scene_name} yaml not created {e}")
-            raise Exception("Yaml error", e)
-
-        try:
-            root.info(f"{scene_name} Uploading to S3 Bucket")
-            s3_upload_cogs(glob.glob(cog_dir + "*"), s3_bucket, s3_dir)
-            root.info(f"{scene_name} Uploaded to S3 Bucket")
-        except Exception as e:
-            root.exception(f"{scene_name} Upload to S3 Failed")
-            raise Exception("S3  upload error", e)
+        root.info(f"{scene_name} Created yaml")
+    except Exception as e:
+        root.exception(f"{scene_name} yaml not created {e}")
+        raise Exception("Yaml error", e)
+
+    # the yaml was the last thing to read the COGs, so uploaded ones can go
+    uploads.release_local()
+    return scene
+
+
+def ls_upload(scene):
+    """Pipeline stage: wait for the COGs' background uploads, then upload the metadata and yaml."""
+    root = setup_logging()
+    scene_name = scene["scene_name"]
+    try:
+        root.info(f"{scene_name} Uploading to S3 Bucket")
+        with timed_stage("upload"):
+            scene["uploads"].commit(glob.glob(scene["cog_dir"] + "*"))
+        root.info(f"{scene_name} Uploaded to S3 Bucket")
     except Exception as e:
-        logging.error(f"Could not process {scene_name}, {e}")
+        root.exception(f"{scene_name} Upload to S3 Failed")
+        raise Exception("S3  upload error", e)
+    s3_upload_run_report(scene["cog_dir"], scene["s3_bucket"], scene["s3_dir"], scene.get("report"))
+    return scene
+
+
+def ls_clean_up(scene):
+    """Remove a scene's working directory once it has left the last stage (or failed)."""
+    if scene.get("uploads") is not None:
+        scene["uploads"].close()
+    inter_dir = scene.get("inter_dir")
+    if inter_dir is None:
+        # download never got as far as naming the scene
+        return
+    test_env = os.getenv("TEST_ENV", False)
+    # preserving the tmp directory contents for testing (set TEST_ENV env var to anything)
+    if test_env:
+        logging.info(f"finished without clean up")
+    else:
+        logging.info(f"cleaning up {inter_dir}")
+        clean_up(inter_dir)
 
-    # finally:
-    # clean_up(inter_dir + "download/")
-    # clean_up(inter_dir)
 
+# The worker's pipeline mode runs these concurrently across scenes (see workflows/pipeline.py)
+LS_STAGES = [
+    Stage("download", ls_download),
+    Stage("process", ls_process),
+    Stage("upload", ls_upload),
+]
+
+
+def prepareLS(in_scene, s3_bucket="", s3_dir="", prodlevel="", item="", cog_profile=None, storage=None):
+    scene = ls_download(dict(in_scene=in_scene, s3_bucket=s3_bucket, s3_dir=s3_dir, prodlevel=prodlevel,
+                             cog_profile=cog_profile, storage=storage))
+    if scene is None:
+        return
+    try:
+        run_stages(LS_STAGES[1:], scene)
+    except Exception as e:
+        # raised on, so the worker leaves the job's lease to expire and it is retried
+        logging.error(f"Could not process {scene['scene_name']}, {e}")
+        raise
     finally:
-        test_env = os.getenv("TEST_ENV", False)
-        # preserving the tmp directory contents for testing (set TEST_ENV env var to anything)
-        if test_env:
-            logging.info(f"finished without clean up")
-        else:
-            logging.info(f"cleaning up {inter_dir}")
-            clean_up(inter_dir)
+        ls_clean_up(scene)
 
 
 if __name__ == "__main__":
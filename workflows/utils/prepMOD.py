@@ -39,7 +39,7 @@ def download_modis(scene_id, down_path):
         logging.info(f"Scene already downloaded: {down_path}")
 
         
-def modis_hdf2cogs(hdf_path, cog_dir):
+def modis_hdf2cogs(hdf_path, cog_dir, cog_profiles=None):
     """
     Convert MCD43A4 HDF if subdatasets into individual COGs.
     """
@@ -49,9 +49,11 @@ def modis_hdf2cogs(hdf_path, cog_dir):
         prod_paths = src.subdatasets
     prod_names = [i.split(':')[-1] for i in prod_paths]
 
-    for non_cog, prod_name in zip(prod_paths, prod_names):
-        cog = os.path.join(cog_dir,f"{scene_name}_{prod_name}.tif")
-        conv_sgl_cog(non_cog, cog)
+    jobs = [(conv_sgl_cog, non_cog, os.path.join(cog_dir, f"{scene_name}_{prod_name}.tif"), 0,
+             cog_profile(prod_name, cog_profiles))
+            for non_cog, prod_name in zip(prod_paths, prod_names)]
+    cog_bands(jobs)
+    for _, non_cog, cog, _, _ in jobs:
         logging.info(f'cogged: {non_cog} {cog}')
         
 def band_name_MCD43A4(prod_path):
@@ -162,11 +164,17 @@ def yaml_prep_MCD43A4(scene_dir):
 def prepareMOD(in_scene, 
                s3_bucket='', 
                s3_dir='common_sensing/fiji/default',
-               inter_dir='/tmp/data/intermediate/'):
+               inter_dir='/tmp/data/intermediate/',
+               cog_profile=None):
     
     root = setup_logging()
 
     scene_name = '_'.join(in_scene.split('/')[-1].replace('.','_').split('_')[0:3])
+
+    published, s3_objects = s3_check_published(s3_bucket, s3_dir, scene_name)
+    if published:
+        return
+
     inter_dir = "/tmp/data/intermediate/"
     os.makedirs(inter_dir, exist_ok=True)
     down_path = os.path.join(inter_dir, in_scene)
@@ -175,12 +183,15 @@ def prepareMOD(in_scene,
     
     logging.info(f"scene: {in_scene}\ndownload: {down_path}\ncog_dir: {cog_dir}")
     root.info(f"{scene_name} Starting")
+    report = start_report('modis', scene_name)
 
     try:
         
         try:
             root.info(f"{scene_name} DOWNLOADING via LAADSDAAC")
-            download_modis(in_scene, down_path)
+            with timed_stage('download'):
+                download_modis(in_scene, down_path)
+            report.add_input(down_path)
             root.info(f"{scene_name} DOWNLOADED")
         except Exception as e:
             root.exception(f"{scene_name} CANNOT BE FOUND")
@@ -188,7 +199,8 @@ def prepareMOD(in_scene,
 
         try:
             root.info(f"{scene_name} Converting COGs")
-            modis_hdf2cogs(down_path, cog_dir)
+            with timed_stage('cog'):
+                modis_hdf2cogs(down_path, cog_dir, cog_profiles=cog_profile)
             root.info(f"{scene_name} COGGED")
         except Exception as e:
             root.exception(f"{scene_name} CANNOT BE COGGED")
@@ -196,7 +208,8 @@ def prepareMOD(in_scene,
 
         try:
             root.info(f"{scene_name} Creating yaml")
-            create_yaml(cog_dir, yaml_prep_MCD43A4(cog_dir))
+            with timed_stage('yaml'):
+                create_yaml(cog_dir, yaml_prep_MCD43A4(cog_dir))
             root.info(f"{scene_name} Created yaml")
         except Exception as e:
             root.exception(f"{scene_name} yaml not created {e}")
@@ -204,11 +217,13 @@ def prepareMOD(in_scene,
 
         try:
             root.info(f"{scene_name} Uploading to S3 Bucket")
-            s3_upload_cogs(glob.glob(cog_dir + '*'), s3_bucket, s3_dir)
+            with timed_stage('upload'):
+                s3_upload_cogs(glob.glob(cog_dir + '*'), s3_bucket, s3_dir, s3_objects)
             root.info(f"{scene_name} Uploaded to S3 Bucket")
         except Exception as e:
             root.exception(f"{scene_name} Upload to S3 Failed")
             raise Exception('S3  upload error', e)
+        s3_upload_run_report(cog_dir, s3_bucket, s3_dir, report)
 
         clean_up(inter_dir)
 
@@ -258,9 +258,10 @@ def band_name_s1(prod_path):
     return 'unknown layer'
 
 
-def conv_s1scene_cogs(noncog_scene_dir, cog_scene_dir, scene_name, overwrite=False):
+def conv_s1scene_cogs(noncog_scene_dir, cog_scene_dir, scene_name, overwrite=False, cog_profiles=None, done=None):
     """
     Convert S1 scene products to cogs [+ validate].
+    done(out_path) is called as each COG is finished, see cog_bands.
     """
 
     if not os.path.exists(noncog_scene_dir):
@@ -280,12 +281,15 @@ def conv_s1scene_cogs(noncog_scene_dir, cog_scene_dir, scene_name, overwrite=Fal
     prod_paths = [x for x in prod_paths if os.path.basename(x)[:-4] in des_prods]
 
     # iterate over prods to create parellel processing list
+    jobs = []
     for prod in prod_paths:
         out_filename = os.path.join(cog_scene_dir,
                                     scene_name + '_' + os.path.basename(prod)[:-4] + '.tif')  # - TO DO*****
         logging.info(f"converting {prod} to cog at {out_filename}")
         # ensure input file exists
-        to_cog(prod, out_filename, nodata=-9999)
+        jobs.append((to_cog, prod, out_filename, -9999, cog_profile(os.path.basename(prod)[:-4], cog_profiles)))
+
+    cog_bands(jobs, done)
 
 
 def copy_s1_metadata(out_s1_prod, cog_scene_dir, scene_name):
@@ -405,7 +409,8 @@ def prepareS1(
         s3_bucket='',
         s3_dir='common_sensing/sentinel_1/',
         inter_dir='/tmp/data/intermediate/',
-        source='asf'
+        source='asf',
+        cog_profile=None
 ):
     """
     Prepare IN_SCENE of Sentinel-1 satellite data into OUT_DIR for ODC indexing.
@@ -426,6 +431,11 @@ def prepareS1(
     # shorten scene name
     scene_name = in_scene[:32]
 
+    # COGs are uploaded to s3_dir/<in_scene>/
+    published, s3_objects = s3_check_published(s3_bucket, s3_dir, in_scene)
+    if published:
+        return
+
     # Unique inter_dir needed for clean-up
     inter_dir = inter_dir + scene_name + '_tmp/'
     # sub-dirs used only for accessing tmp files
@@ -457,13 +467,16 @@ def prepareS1(
 
     root = setup_logging()
     root.info('{} {} Starting'.format(in_scene, scene_name))
+    report = start_report('sentinel_1', in_scene)
+    report.tool('snap', snap_version())
 
     try:
 
         #  DOWNLOAD
         try:
             root.info(f"{in_scene} {scene_name} DOWNLOADING via ASF")
-            download_extract_s1_scene_asf(in_scene, inter_dir)
+            with timed_stage('download'):
+                download_extract_s1_scene_asf(in_scene, inter_dir)
             #             raise Exception('skipping asf for testing')
             root.info(f"{in_scene} {scene_name} DOWNLOADED via ASF")
         except Exception as e:
@@ -473,11 +486,13 @@ def prepareS1(
                 s1id = find_s1_uuid(in_scene)
                 logging.debug(s1id)
                 root.info(f"{in_scene} {scene_name} AVAILABLE via ESA")
-                download_extract_s1_esa(s1id, inter_dir, down_dir)
+                with timed_stage('download'):
+                    download_extract_s1_esa(s1id, inter_dir, down_dir)
                 root.info(f"{in_scene} {scene_name} DOWNLOADED via ESA")
             except Exception as e:
                 root.exception(f"{in_scene} {scene_name} UNAVAILABLE via ESA too")
                 raise Exception('Download Error ESA', e)
+        report.add_input(down_dir)
         # Figure out what bands are available.
         bands = available_bands(in_scene)
         cmd = [
@@ -538,7 +553,8 @@ def prepareS1(
         # CONVERT TO COGS TO TEMP COG DIRECTORY**
         try:
             root.info(f"{in_scene} {scene_name} Converting COGs")
-            conv_s1scene_cogs(inter_dir, cog_dir, scene_name)
+            with timed_stage('cog'):
+                conv_s1scene_cogs(inter_dir, cog_dir, scene_name, cog_profiles=cog_profile)
             root.info(f"{in_scene} {scene_name} COGGED")
         except Exception as e:
             root.exception(f"{in_scene} {scene_name} COG conversion FAILED")
@@ -557,7 +573,8 @@ def prepareS1(
         # GENERATE YAML WITHIN TEMP COG DIRECTORY**
         try:
             root.info(f"{in_scene} {scene_name} Creating dataset YAML")
-            create_yaml(cog_dir, yaml_prep_s1(cog_dir))
+            with timed_stage('yaml'):
+                create_yaml(cog_dir, yaml_prep_s1(cog_dir))
             root.info(f"{in_scene} {scene_name} Created original METADATA")
         except Exception as e:
             root.exception(f"{in_scene} {scene_name} Dataset YAML not created")
@@ -566,11 +583,13 @@ def prepareS1(
             # MOVE COG DIRECTORY TO OUTPUT DIRECTORY
         try:
             root.info(f"{in_scene} {scene_name} Uploading to S3 Bucket")
-            s3_upload_cogs(glob.glob(os.path.join(cog_dir, '*')), s3_bucket, s3_dir)
+            with timed_stage('upload'):
+                s3_upload_cogs(glob.glob(os.path.join(cog_dir, '*')), s3_bucket, s3_dir, s3_objects)
             root.info(f"{in_scene} {scene_name} Uploaded to S3 Bucket")
         except Exception as e:
             root.exception(f"{in_scene} {scene_name} Upload to S3 Failed")
             raise Exception('S3  upload error', e)
+        s3_upload_run_report(cog_dir, s3_bucket, s3_dir, report)
         print('not boo')
        # DELETE ANYTHING WITHIN THE TEMP DIRECTORY
 
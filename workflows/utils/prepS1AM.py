@@ -62,6 +62,7 @@ def download_extract_s1_esa(scene_uuid, down_dir, original_scene_dir):
             try:
                 esa_api = SentinelAPI(copernicus_username, copernicus_pwd)
                 esa_api.download(scene_uuid, down_dir, checksum=True)
+                count_bytes("downloaded", zip_file_path)
             except Exception as e:
                 raise DownloadError(f"Error downloading {scene_uuid} from ESA hub: {e}")
 
@@ -94,9 +95,10 @@ def band_name_s1(prod_path):
     return 'unknown layer'
 
 
-def conv_s1scene_cogs(noncog_scene_dir, cog_scene_dir, scene_name, fiji_AM=False, overwrite=False): # REMOVE fiji_AM=False IF THIS WORKS
+def conv_s1scene_cogs(noncog_scene_dir, cog_scene_dir, scene_name, fiji_AM=False, overwrite=False, cog_profiles=None, done=None): # REMOVE fiji_AM=False IF THIS WORKS
     """
     Convert S1 scene products to cogs [+ validate].
+    done(out_path) is called as each COG is finished, see cog_bands.
     """
 
     if not os.path.exists(noncog_scene_dir):
@@ -119,26 +121,30 @@ def conv_s1scene_cogs(noncog_scene_dir, cog_scene_dir, scene_name, fiji_AM=False
     logging.info(f"ALL PROD_PATHS: {prod_paths}")
 
     # iterate over prods to create parellel processing list
+    jobs = []
     for prod in prod_paths:
         logging.info(f'the prod is: {prod}')
+        profile = cog_profile(os.path.basename(prod)[:-4], cog_profiles)
         # if its an AM-crossing product and 'east' in prod
         if fiji_AM and 'east' in prod: 
             out_filename = os.path.join(cog_scene_dir,
                                     scene_name + '_' + os.path.basename(prod)[:-4] + '.tif')
             logging.info(f"converting {prod} to cog at {out_filename}")
-            to_cog(prod, out_filename, nodata=-9999)
+            jobs.append((to_cog, prod, out_filename, -9999, profile))
         # elif its an AM-crossing product and 'east' in prod
         elif fiji_AM and 'west' in prod:
             out_filename = os.path.join(cog_scene_dir,
                                     scene_name + '_' + os.path.basename(prod)[:-4] + '.tif')  # - TO DO*****
             logging.info(f"converting {prod} to cog at {out_filename}")
-            to_cog(prod, out_filename, nodata=-9999)
+            jobs.append((to_cog, prod, out_filename, -9999, profile))
         else:
             logging.info(f'prod: {prod} doesnt cross AM')
             out_filename = os.path.join(cog_scene_dir,
                                     scene_name + '_' + os.path.basename(prod)[:-4] + '.tif')  # - TO DO*****
             logging.info(f"converting {prod} to cog at {out_filename}")
-            to_cog(prod, out_filename, nodata=-9999)
+            jobs.append((to_cog, prod, out_filename, -9999, profile))
+
+    cog_bands(jobs, done)
 
 
 def copy_s1_metadata(out_s1_prod, cog_scene_dir, scene_name):
@@ -337,7 +343,7 @@ def yaml_prep_s1(scene_dir, down_dir, hemisphere=None):
     }
 
 
-def prepare_S1AM(title, region, chunks=24,s3_bucket='public-eo-data', s3_dir='common_sensing/sentinel_1/', inter_dir='/tmp/data/intermediate/', **kwargs):
+def prepare_S1AM(title, region, chunks=24,s3_bucket='public-eo-data', s3_dir='common_sensing/sentinel_1/', inter_dir='/tmp/data/intermediate/', cog_profile=None, **kwargs):
     """
     Prepare a Sentinel-1 scene (L1C or L2A) for indexing in ODC by converting it to COGs.
 
@@ -360,6 +366,21 @@ def prepare_S1AM(title, region, chunks=24,s3_bucket='public-eo-data', s3_dir='co
         in_scene += '.SAFE'
 
     scene_name = in_scene[:32]
+
+    # Whether the scene crosses the antimeridian (uploaded as <scene_name>_E and _W) is only
+    # known after SNAP, so either layout counts as published
+    published, s3_objects = s3_check_published(s3_bucket, s3_dir, scene_name)
+    if not published and all(scene_dirs_published(s3_objects, d, [scene_name]) or
+                             scene_dirs_published(s3_objects, d, [f'{scene_name}_E', f'{scene_name}_W'])
+                             for d in s3_dirs(s3_dir)):
+        logging.info(f"{scene_name} already published to {s3_bucket}/{s3_dir} as east/west halves, skipping")
+        published = True
+    if published:
+        return
+
+    report = start_report('sentinel_1', scene_name)
+    report.tool('snap', snap_version())
+
     inter_dir = f'{inter_dir}{scene_name}_tmp/'
 
     cog_dir = os.path.join(inter_dir, scene_name)
@@ -376,16 +397,20 @@ def prepare_S1AM(title, region, chunks=24,s3_bucket='public-eo-data', s3_dir='co
             s1id = find_s1_uuid(in_scene)
             logging.debug(s1id)
             logging.info(f"{in_scene} {scene_name}: Available for download from ESA")
-            download_extract_s1_esa(s1id, inter_dir, down_dir)
+            with timed_stage('download'):
+                download_extract_s1_esa(s1id, inter_dir, down_dir)
             logging.info(f"{in_scene} {scene_name}: Downloaded from ESA")
         except Exception as e:
             root.exception(f"{in_scene} {scene_name}: Failed to download from ESA")
             raise DownloadError(f"Failed to download {in_scene} from ESA") from e
 
         logging.info('DOWNLOADED SCENE')
+        report.add_input(down_zip)
+        report.add_input(down_dir)
 
         # Download external DEMs
-        ext_dem_path_list_local = download_external_dems(region, in_scene, scene_name, tmp_inter_dir, s3_bucket, root)
+        with timed_stage('dem'):
+            ext_dem_path_list_local = download_external_dems(region, in_scene, scene_name, tmp_inter_dir, s3_bucket, root)
         logging.info(f'EXT DEM PATH LIST: {ext_dem_path_list_local}')
 
         # Process for all S1 scenes (an if statement in raw2ard.py checks if its AM crossing or not)
@@ -424,15 +449,16 @@ def prepare_S1AM(title, region, chunks=24,s3_bucket='public-eo-data', s3_dir='co
         logging.info('COG CONVERTING')
         try:
             # cog converting depending on if its S1 or S1AM
-            if product_type == 'S1AM':
-                logging.info(f"Fiji-AM Converting COGs - with cog dir: {cog_dir}")
-                conv_s1scene_cogs(inter_dir, cog_dir_east, scene_name, fiji_AM=True)
-                conv_s1scene_cogs(inter_dir, cog_dir_west, scene_name, fiji_AM=True)
-                logging.info("Fiji-AM scene COGGED")
-            else:
-                logging.info(f"{in_scene} {scene_name} Converting COGs")
-                conv_s1scene_cogs(inter_dir, cog_dir, scene_name)
-                logging.info(f"{in_scene} {scene_name} COGGED")
+            with timed_stage('cog'):
+                if product_type == 'S1AM':
+                    logging.info(f"Fiji-AM Converting COGs - with cog dir: {cog_dir}")
+                    conv_s1scene_cogs(inter_dir, cog_dir_east, scene_name, fiji_AM=True, cog_profiles=cog_profile)
+                    conv_s1scene_cogs(inter_dir, cog_dir_west, scene_name, fiji_AM=True, cog_profiles=cog_profile)
+                    logging.info("Fiji-AM scene COGGED")
+                else:
+                    logging.info(f"{in_scene} {scene_name} Converting COGs")
+                    conv_s1scene_cogs(inter_dir, cog_dir, scene_name, cog_profiles=cog_profile)
+                    logging.info(f"{in_scene} {scene_name} COGGED")
 
         except Exception as e:
             root.exception(f"{in_scene} {scene_name} COG conversion FAILED")
@@ -460,15 +486,16 @@ def prepare_S1AM(title, region, chunks=24,s3_bucket='public-eo-data', s3_dir='co
         logging.info('GENERATE YAML WITHIN TEMP COG DIRECTORY')
         try:
             # yaml creation depending on if its S1 or S1AM
-            if product_type == 'S1AM':
-                logging.info('Creating yamls for fiji East and West')
-                create_yaml(cog_dir_east, yaml_prep_s1(cog_dir_east, down_dir, hemisphere='east'))  # east subset
-                create_yaml(cog_dir_west, yaml_prep_s1(cog_dir_west, down_dir, hemisphere='west'))  # west subset
-                logging.info('Yamls for fiji East and West have been created')
-            else:
-                logging.info(f"{in_scene} {scene_name} Creating dataset YAML")
-                create_yaml(cog_dir, yaml_prep_s1(cog_dir, down_dir))
-                logging.info(f"{in_scene} {scene_name} Created original METADATA")
+            with timed_stage('yaml'):
+                if product_type == 'S1AM':
+                    logging.info('Creating yamls for fiji East and West')
+                    create_yaml(cog_dir_east, yaml_prep_s1(cog_dir_east, down_dir, hemisphere='east'))  # east subset
+                    create_yaml(cog_dir_west, yaml_prep_s1(cog_dir_west, down_dir, hemisphere='west'))  # west subset
+                    logging.info('Yamls for fiji East and West have been created')
+                else:
+                    logging.info(f"{in_scene} {scene_name} Creating dataset YAML")
+                    create_yaml(cog_dir, yaml_prep_s1(cog_dir, down_dir))
+                    logging.info(f"{in_scene} {scene_name} Created original METADATA")
 
         except Exception as e:
             root.exception(f"{in_scene} {scene_name} Dataset YAML not created")
@@ -477,18 +504,21 @@ def prepare_S1AM(title, region, chunks=24,s3_bucket='public-eo-data', s3_dir='co
         logging.info('MOVE COG DIRECTORY TO OUTPUT DIRECTORY')
         try:
             logging.info(f"{in_scene} {scene_name} Uploading to S3 Bucket")
-            if product_type == 'S1AM':
-                logging.info('Uploading fiji AM EAST scene to S3 Bucket')
-                s3_upload_cogs(glob.glob(os.path.join(cog_dir_east, '*')), s3_bucket, s3_dir)
-                logging.info('Uploading fiji AM WEST scene to S3 Bucket')
-                s3_upload_cogs(glob.glob(os.path.join(cog_dir_west, '*')), s3_bucket, s3_dir)
-            else:
-                s3_upload_cogs(glob.glob(os.path.join(cog_dir, '*')), s3_bucket, s3_dir)
+            with timed_stage('upload'):
+                if product_type == 'S1AM':
+                    logging.info('Uploading fiji AM EAST scene to S3 Bucket')
+                    s3_upload_cogs(glob.glob(os.path.join(cog_dir_east, '*')), s3_bucket, s3_dir, s3_objects)
+                    logging.info('Uploading fiji AM WEST scene to S3 Bucket')
+                    s3_upload_cogs(glob.glob(os.path.join(cog_dir_west, '*')), s3_bucket, s3_dir, s3_objects)
+                else:
+                    s3_upload_cogs(glob.glob(os.path.join(cog_dir, '*')), s3_bucket, s3_dir, s3_objects)
 
             logging.info(f"{in_scene} {scene_name} Uploaded to S3 Bucket")
         except Exception as e:
             root.exception(f"{in_scene} {scene_name} Upload to S3 Failed")
             raise Exception('S3  upload error', e)
+        for scene_dir in ([cog_dir_east, cog_dir_west] if product_type == 'S1AM' else [cog_dir]):
+            s3_upload_run_report(scene_dir, s3_bucket, s3_dir, report)
 
     except Exception as e:
         logging.error(f"could not process {scene_name} {e}")
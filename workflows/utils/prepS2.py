@@ -7,9 +7,10 @@ import zipfile
 import uuid
 from subprocess import Popen, PIPE, STDOUT
 import shutil
-import rioxarray as rxr
 
 from workflows.utils.prep_utils import *
+from workflows.utils.scaling import scaler, window_stats
+from workflows.pipeline import Stage, run_stages
 
 
 def download_s2_granule_gcloud(s2_id, inter_dir, download_dir, safe_form=True, bands=False):
@@ -81,6 +82,7 @@ def download_s2_granule_gcloud(s2_id, inter_dir, download_dir, safe_form=True, b
                 name = os.path.join(dir_name + '/'.join(blob.name.split('/')[5:]))
 
             blob.download_to_filename(name)
+            count_bytes("downloaded", name)
 
 
 def band_name_s2(prod_path):
@@ -184,6 +186,7 @@ def download_extract_s2_esa(scene_uuid, down_dir, original_scene_dir):
             logging.debug(f"ESA username: {copernicus_username}")
             esa_api = SentinelAPI(copernicus_username, copernicus_pwd)
             esa_api.download(scene_uuid, down_dir, checksum=True)
+            count_bytes("downloaded", original_scene_dir.replace('.SAFE/', '.zip'))
 
         # extract downloaded .zip file
         logging.info('Extracting ESA scene: {}'.format(original_scene_dir))
@@ -200,7 +203,7 @@ def download_extract_s2_esa(scene_uuid, down_dir, original_scene_dir):
         os.remove(original_scene_dir.replace('.SAFE/', '.zip'))
 
 
-def conv_s2scene_cogs(original_scene_dir, cog_scene_dir, scene_name, overwrite=False):
+def conv_s2scene_cogs(original_scene_dir, cog_scene_dir, scene_name, overwrite=False, cog_profiles=None, done=None):
     """
     Convert S2 scene products to cogs [+ validate TBC].
     Works for both L1C and L2A .SAFE dir structures.
@@ -209,6 +212,8 @@ def conv_s2scene_cogs(original_scene_dir, cog_scene_dir, scene_name, overwrite=F
     :param cog_scene_dir: directory in which to create the output COGs
     :param scene_name: shortened S2 scene name (i.e. S2A_MSIL2A_20190124T221941_T60KYF from S2A_MSIL2A_20190124T221941_N0211_R029_T60KYF_20190124T234344)
     :param overwrite: Binary for whether to overwrite or skip existing COG files)
+    :param cog_profiles: job's cog_profile field, see prep_utils.cog_profile
+    :param done: called with each COG's path as it is finished, see cog_bands
     :return: 
     """
 
@@ -220,25 +225,110 @@ def conv_s2scene_cogs(original_scene_dir, cog_scene_dir, scene_name, overwrite=F
         logging.info('Creating scene cog directory: {}'.format(cog_scene_dir))
         os.mkdir(cog_scene_dir)
 
+    # iterate over prods to create parellel processing list
+    jobs = []
+    for prod in s2_prod_paths(original_scene_dir, scene_name):
+
+        out_filename = cog_scene_dir + scene_name + prod[-12:-4] + '.tif'
+
+        # ensure input file exists
+        jobs.append((to_cog, prod, out_filename, 0, cog_profile(prod[-11:-4], cog_profiles)))
+
+    cog_bands(jobs, done)
+
+
+def s2_prod_paths(original_scene_dir, scene_name):
+    """
+    The .jp2 products of a .SAFE scene that get converted to COGs (true colour
+    images (TCI) and, for L2A, resolutions other than the native are ignored).
+    """
     des_prods = ["AOT_10m", "B01_60m", "B02_10m", "B03_10m", "B04_10m", "B05_20m", "B06_20m",
                  "B07_20m", "B08_10m", "B8A_20m", "B09_60m", "B11_20m", "B12_20m", "SCL_20m",
                  "WVP_10m"]
 
-    # find all individual prods to convert to cog (ignore true colour images (TCI))
     if scene_name.split('_')[1] == 'MSIL1C':
-        prod_paths = glob.glob(original_scene_dir + 'GRANULE/*/IMG_DATA/*.jp2')
+        return glob.glob(original_scene_dir + 'GRANULE/*/IMG_DATA/*.jp2')
 
-    elif scene_name.split('_')[1] == 'MSIL2A':
-        prod_paths = glob.glob(original_scene_dir + 'GRANULE/*/IMG_DATA/*/*.jp2')
-        prod_paths = [x for x in prod_paths if x[-11:-4] in des_prods]
+    prod_paths = glob.glob(original_scene_dir + 'GRANULE/*/IMG_DATA/*/*.jp2')
+    return [x for x in prod_paths if x[-11:-4] in des_prods]
 
-    # iterate over prods to create parellel processing list
-    for prod in prod_paths:
 
-        out_filename = cog_scene_dir + scene_name + prod[-12:-4] + '.tif'
+def s2_l2a_scaling(prod):
+    """
+    (quantification value, offset, nodata) for an L2A product, e.g. "B02_10m",
+    or None for products that are not rescaled (SCL, WVP).
+    https://docs.sentinel-hub.com/api/latest/data/sentinel-2-l2a/
+    """
+    # surface reflectance bands
+    if prod.startswith('B'):
+        return 10000, 0, 0
+    if prod.startswith('AOT'):
+        return 1000, 0, 0
+    return None
 
-        # ensure input file exists
-        to_cog(prod, out_filename)
+
+def conv_s2scene_scaled_cogs(original_scene_dir, scale_dir, scene_name, new_dtype='float32', overwrite=False,
+                             cog_profiles=None, storage='float', done=None):
+    """
+    Convert S2 L2A scene products straight to scaled COGs, named as
+    conv_s2scene_cogs + scale_sentinel2_l2a would name them.
+
+    Each .jp2 is decoded once and the COG encoded once: the quantification
+    value is applied to each block between the two (see cog_translate), where
+    the two-step route wrote an unscaled COG and re-read and re-encoded it.
+
+    :param original_scene_dir: Downloaded S2 L2A .SAFE directory
+    :param scale_dir: directory in which to create the output COGs
+    :param scene_name: shortened S2 scene name (i.e. S2A_MSIL2A_20190124T221941_T60KYF)
+    :param new_dtype: data type of the scaled bands
+    :param overwrite: Binary for whether to overwrite or skip existing COG files
+    :param cog_profiles: job's cog_profile field, see prep_utils.cog_profile
+    :param storage: 'scaled-int' to keep the integer values and tag the COGs with the scaling
+    :param done: called with each COG's path as it is finished, see cog_bands
+    """
+    if not os.path.exists(original_scene_dir):
+        logging.warning('Cannot find original scene directory: {}'.format(original_scene_dir))
+    os.makedirs(scale_dir, exist_ok=True)
+
+    jobs = []
+    for prod in s2_prod_paths(original_scene_dir, scene_name):
+        out_filename = scale_dir + scene_name + prod[-12:-4] + '.tif'
+        if os.path.exists(out_filename) and not overwrite:
+            logging.info(f'cog already exists: {out_filename}')
+            continue
+
+        profile = cog_profile(prod[-11:-4], cog_profiles)
+        scaling = s2_l2a_scaling(prod[-11:-4])
+        if scaling is None:
+            jobs.append((conv_sgl_cog, prod, out_filename, 0, profile))
+            continue
+
+        quant_value, boa_offset, nodata = scaling
+        if storage == 'scaled-int':
+            jobs.append((conv_sgl_scale_tagged_cog, prod, out_filename, 1 / quant_value, boa_offset, nodata, profile))
+        else:
+            jobs.append((conv_s2_scaled_cog, prod, out_filename, quant_value, boa_offset, nodata, new_dtype,
+                         profile))
+        logging.info(f"Prod name {prod[-11:-4]} to scale with scale factor {quant_value}, offset {boa_offset}")
+
+    record_band_stats({job[2]: stats for job, stats in zip(jobs, cog_bands(jobs, done))})
+
+
+def conv_s2_scaled_cog(in_path, out_path, quant_value, boa_offset, nodata, new_dtype='float32', profile=None,
+                       threads=None):
+    """
+    COG a .jp2 product, dividing by its quantification value (through a lookup
+    table, see scaling.py) as it goes. Original nodata stays nodata and the
+    output is tagged with it.
+
+    Returns the scaled band's stats, gathered in the same pass.
+    """
+    stats = window_stats(add_offset=boa_offset, nodata=nodata, dtype=new_dtype, divisor=quant_value)
+    cog_translate(in_path, out_path, profile or COG_PROFILE, overview_level=5, overview_resampling='average',
+                  transform=scaler(add_offset=boa_offset, nodata=nodata, dtype=new_dtype, divisor=quant_value,
+                                   stats=stats),
+                  dtype=new_dtype, dst_nodata=nodata, threads=threads)
+    return stats.to_dict()
 
 
 def copy_s2_metadata(original_scene_dir, cog_scene_dir, scene_name):
@@ -352,7 +442,8 @@ def scale_sentinel2_l2a(cog_dir, scale_dir, new_dtype='float32'):
             quant_value = 10000
             boa_offset = 0
             nodata = 0
-            apply_scale_factor_sentinel(f, quant_value, boa_offset, nodata, out_path, new_dtype)
+            stats = apply_scale_factor_sentinel(f, quant_value, boa_offset, nodata, out_path, new_dtype)
+            record_band_stats({out_path: stats})
             logging.info(f"Prod name {prod_name} scaled with scale factor {quant_value}, offset {boa_offset}")
         
         # Apply scaling for AOT band
@@ -360,7 +451,8 @@ def scale_sentinel2_l2a(cog_dir, scale_dir, new_dtype='float32'):
             quant_value = 1000
             boa_offset = 0
             nodata = 0
-            apply_scale_factor_sentinel(f, quant_value, boa_offset, nodata, out_path, new_dtype)
+            stats = apply_scale_factor_sentinel(f, quant_value, boa_offset, nodata, out_path, new_dtype)
+            record_band_stats({out_path: stats})
             logging.info(f"Prod name {prod_name} scaled with scale factor {quant_value}, offset {boa_offset}")
         
         # For the remaining files (QA band, xml, etc.), just copy into new directory
@@ -370,31 +462,15 @@ def scale_sentinel2_l2a(cog_dir, scale_dir, new_dtype='float32'):
 def apply_scale_factor_sentinel(input_data, quant_value, boa_offset, nodata, out_path, new_dtype='float32'):
         """
         Apply the scale factor to a tif of a sentinel product.
-        """
-    
-        # Open the tif as xarray to apply scale factor + offset
-        logging.info(f"Opening {input_data} as xarray")
-        img_arr = rxr.open_rasterio(input_data)
-        logging.info(f"MIN, MAX BEFORE {img_arr.min()}, {img_arr.max()}")
-        
-        # Nodata mask (nodata value of 0 for Sentinel 2)
-        mask = img_arr.data == nodata
-
-        # Apply the scale factor and offset
-        img_arr_rescaled = img_arr / quant_value + boa_offset
-
-        # New datatype of float32 because new values are often less than 1 
-        img_arr_rescaled = img_arr_rescaled.astype(new_dtype)
 
-        # Making sure any original nodata is still nodata (I think?)
-        img_arr_rescaled.data[mask] = nodata
-
-        logging.info(f"MIN, MAX AFTER {img_arr_rescaled.min()}, {img_arr_rescaled.max()}")
-        logging.info(f"Data-type AFTER: {img_arr_rescaled.dtype}")
-
-        # Convert xarray to COG 
-        img_arr_rescaled.rio.to_raster(raster_path = out_path, driver="COG")
+        Scaled window by window through a lookup table, so memory doesn't grow
+        with the band (nodata value of 0 for Sentinel 2).
+        """
+        logging.info(f"Scaling {input_data}")
+        stats = conv_s2_scaled_cog(input_data, out_path, quant_value, boa_offset, nodata, new_dtype)
+        logging.info(f"MIN, MAX AFTER {stats['min']}, {stats['max']}")
         logging.info(f"Wrote data to {out_path}")
+        return stats
 
 def yaml_prep_s2(scene_dir):
     """
@@ -423,9 +499,9 @@ def yaml_prep_s2(scene_dir):
 
     # get polorisation from each image product (S2 band)
     images = {
-        band_name_s2(prod_path): {
-            'path': str(os.path.split(prod_path)[-1])
-        } for prod_path in prod_paths
+        band_name_s2(prod_path): dict(
+            path=str(os.path.split(prod_path)[-1]), **band_scaling(prod_path)
+        ) for prod_path in prod_paths
     }
 
     # trusting bands coaligned, use one to generate spatial bounds for all
@@ -474,26 +550,9 @@ def yaml_prep_s2(scene_dir):
 # @click.option("--prodlevel", default="L1C", help="Desired Sentinel-2 product level. Defaults to 'L1C'. Use 'L2A' for ARD equivalent")
 # @click.option("--source", default="gcloud", help="Api source to be used for downloading scenes.")
 
-def prepareS2(title, s3_bucket='public-eo-data', s3_dir='common_sensing/sentinel_2/', inter_dir='/tmp/data/intermediate/',
-              prodlevel='L2A', **kwargs):
-    in_scene = title
-    """
-    Prepare IN_SCENE of Sentinel-2 satellite data into OUT_DIR for ODC indexing. 
-
-    :param in_scene: input Sentinel-2 scene name (either L1C or L2A) i.e. "S2A_MSIL1C_20180820T223011_N0206_R072_T60KWE_20180821T013410[.SAFE]"
-    :param s3_bucket: name of the s3 bucket in which to upload preppared products
-    :param s3_dir: bucket dir in which to upload prepared products
-    :param inter_dir: dir in which to store intermeriary products - this will be nuked at the end of processing, error or not
-    :param prodlevel: Desired Sentinel-2 product level. Defaults to 'L1C'. Use 'L2A' for ARD equivalent
-    :return: None
-    
-    Assumptions:
-    - env set at SEN2COR_8: i.e. Sen2Cor-02.08.00-Linux64/bin/L2A_Process"
-    - env set COPERNICUS_USERNAME
-    - env set COPERNICUS_PWD
-    - env set AWS_ACCESS
-    - env set AWS_SECRET
-    """
+def s2_scene_dirs(job):
+    """Return (in_scene, scene_name, scene tmp dir) for a prepareS2 job."""
+    in_scene = job['title']
     # Need to handle inputs with and without .SAFE extension
     if not in_scene.endswith('.SAFE'):
         in_scene = in_scene + '.SAFE'
@@ -502,11 +561,24 @@ def prepareS2(title, s3_bucket='public-eo-data', s3_dir='common_sensing/sentinel
     scene_name = scene_name[:-17] + scene_name.split('_')[-1]
     if '_MSIL1C_' in in_scene:
         scene_name = scene_name.replace('_MSIL1C_','_MSIL2A_')
+    # Unique inter_dir needed for clean-up
+    inter_dir = job.get('inter_dir', '/tmp/data/intermediate/') + scene_name + '_tmp/'
+    return in_scene, scene_name, inter_dir
 
-        sen2cor8 = '/Sen2Cor-02.08.00-Linux64/bin/L2A_Process'
 
-    # Unique inter_dir needed for clean-up
-    inter_dir = inter_dir + scene_name + '_tmp/'
+def s2_download(job):
+    """
+    Pipeline stage: lay out the scene's working directories and download it,
+    from Google Cloud if possible, else from ESA.
+
+    Returns the job dict extended with the scene name and directories used by
+    the later stages, or None if the scene is already published.
+    """
+    in_scene, scene_name, inter_dir = s2_scene_dirs(job)
+    s3_dir = job.get('s3_dir', 'common_sensing/sentinel_2/')
+    done, published = s3_check_published(job.get('s3_bucket', 'public-eo-data'), s3_dir, scene_name)
+    if done:
+        return None
     os.makedirs(inter_dir, exist_ok=True)
     
     # sub-dirs used only for accessing tmp files
@@ -516,106 +588,182 @@ def prepareS2(title, s3_bucket='public-eo-data', s3_dir='common_sensing/sentinel
     # Used to be making inter_dir again - changed to create down_dir
     os.makedirs(down_dir, exist_ok=True) 
 
-    # Make cog directory (same as down_dir for Level 1C)
-    cog_dir = inter_dir + scene_name + '_cog/'
-    os.makedirs(cog_dir, exist_ok=True)
-
-    # Make directory for scaled images
+    # Make directory for scaled images (COGs are written straight into it)
     scale_dir = inter_dir + scene_name + '/'
     os.makedirs(scale_dir, exist_ok=True)
 
+    scene = dict(job, in_scene=in_scene, scene_name=scene_name, tmp_dir=inter_dir, scale_dir=scale_dir,
+                 published=published, report=start_report('sentinel_2', scene_name))
+
     root = setup_logging()
 
     root.info(f"{in_scene} {scene_name} Starting")
 
+    # DOWNLOAD
     try:
-
-        # DOWNLOAD
-        try:
-            root.info(f"{in_scene} {scene_name} DOWNLOADING via GCloud")
-#             raise Exception('skipping gcloud for testing')
+        root.info(f"{in_scene} {scene_name} DOWNLOADING via GCloud")
+#         raise Exception('skipping gcloud for testing')
+        with timed_stage('download'):
             download_s2_granule_gcloud(in_scene, inter_dir, down_dir)
+        if '_MSIL2A_' in in_scene:
+            down_dir = inter_dir + in_scene + '/' # now need explicit .SAFE dir
+            if not os.path.exists(down_dir): # don't do this for l1c from gcp, prevented by ESA LTA
+                raise Exception('L2A download from Google failed, will try ESA')
+        root.info(f"{in_scene} {scene_name} DOWNLOADED via GCloud")
+    except:
+        root.exception(f"{in_scene} {scene_name} UNAVAILABLE via GCloud, try ESA")
+        try:
+            s2id = find_s2_uuid(in_scene)
+            logging.debug(s2id)
+            root.info(f"{in_scene} {scene_name} AVAILABLE via ESA")
             if '_MSIL2A_' in in_scene:
                 down_dir = inter_dir + in_scene + '/' # now need explicit .SAFE dir
-                if not os.path.exists(down_dir): # don't do this for l1c from gcp, prevented by ESA LTA
-                    raise Exception('L2A download from Google failed, will try ESA')
-            root.info(f"{in_scene} {scene_name} DOWNLOADED via GCloud")
-        except:
-            root.exception(f"{in_scene} {scene_name} UNAVAILABLE via GCloud, try ESA")
-            try:
-                s2id = find_s2_uuid(in_scene)
-                logging.debug(s2id)
-                root.info(f"{in_scene} {scene_name} AVAILABLE via ESA")
-                if '_MSIL2A_' in in_scene:
-                    down_dir = inter_dir + in_scene + '/' # now need explicit .SAFE dir
+            with timed_stage('download'):
                 download_extract_s2_esa(s2id, inter_dir, down_dir)
-                root.info(f"{in_scene} {scene_name} DOWNLOADED via ESA")
-            except Exception as e:
-                root.exception(f"{in_scene} {scene_name} UNAVAILABLE via ESA too")
-                raise Exception('Download Error ESA', e)
-
-        # # [CREATE L2A WITHIN TEMP DIRECTORY]
-        if ('MSIL1C' in in_scene) & (prodlevel == 'L2A'):
-            root.info(f"{in_scene} {scene_name} Sen2Cor Processing")
-            try:
-                sen2cor_correction(sen2cor8, down_dir, inter_dir)
-                l2a_dir = glob.glob(inter_dir + '*L2A*.SAFE*')[0] + '/'
-                down_dir = l2a_dir
-                root.info(f"{in_scene} {scene_name} Sen2Cor COMPLETE")
-            except Exception as e:
-                root.exception(f"{in_scene} {scene_name} sen2cor FAILED")
-                raise Exception('Sen2Cor Error', e)
+            root.info(f"{in_scene} {scene_name} DOWNLOADED via ESA")
+        except Exception as e:
+            root.exception(f"{in_scene} {scene_name} UNAVAILABLE via ESA too")
+            raise Exception('Download Error ESA', e)
 
-        
-        # CONVERT TO COGS TO TEMP COG DIRECTORY**
+    scene['down_dir'] = down_dir
+    scene['report'].add_input(down_dir)
+    return scene
+
+
+def s2_process(scene):
+    """Pipeline stage: sen2cor (L1C only), COG, scale and write the scene's yaml."""
+    in_scene, scene_name = scene['in_scene'], scene['scene_name']
+    inter_dir, down_dir = scene['tmp_dir'], scene['down_dir']
+    scale_dir = scene['scale_dir']
+    root = setup_logging()
+
+    # # [CREATE L2A WITHIN TEMP DIRECTORY]
+    if ('MSIL1C' in in_scene) & (scene.get('prodlevel', 'L2A') == 'L2A'):
+        sen2cor8 = '/Sen2Cor-02.08.00-Linux64/bin/L2A_Process'
+        scene['report'].tool('sen2cor', sen2cor_version(sen2cor8))
+        root.info(f"{in_scene} {scene_name} Sen2Cor Processing")
         try:
-            root.info(f"{in_scene} {scene_name} Converting COGs")
-            conv_s2scene_cogs(down_dir, cog_dir, scene_name)
-            root.info(f"{in_scene} {scene_name} COGGED")
+            with timed_stage('sen2cor'):
+                sen2cor_correction(sen2cor8, down_dir, inter_dir)
+            l2a_dir = glob.glob(inter_dir + '*L2A*.SAFE*')[0] + '/'
+            down_dir = l2a_dir
+            root.info(f"{in_scene} {scene_name} Sen2Cor COMPLETE")
         except Exception as e:
-            root.exception(f"{in_scene} {scene_name} COG conversion FAILED")
-            raise Exception('COG Error', e)
+            root.exception(f"{in_scene} {scene_name} sen2cor FAILED")
+            raise Exception('Sen2Cor Error', e)
 
-        # SCALE THE COGS 
-        try:
-            root.info(f"{in_scene} {scene_name} Scaling images")
-            scale_sentinel2_l2a(cog_dir, scale_dir, new_dtype='float32')
-            root.info(f"{in_scene} {scene_name} ")
-        except:
-            root.exception(f"{in_scene} {scene_name} Not scaled properly")
+    
+    # each COG starts uploading as soon as it's written, while the rest are still being made
+    uploads = scene['uploads'] = S3UploadQueue(scene.get('s3_bucket', 'public-eo-data'),
+                                               scene.get('s3_dir', 'common_sensing/sentinel_2/'), scene['published'])
+
+    # CONVERT TO SCALED COGS IN TEMP SCALE DIRECTORY**
+    try:
+        root.info(f"{in_scene} {scene_name} Converting scaled COGs")
+        with timed_stage('scale_cog'):
+            conv_s2scene_scaled_cogs(down_dir, scale_dir, scene_name, new_dtype='float32',
+                                     cog_profiles=scene.get('cog_profile'),
+                                     storage=storage_mode(scene.get('storage')), done=uploads.put)
+        root.info(f"{in_scene} {scene_name} COGGED + SCALED")
+    except Exception as e:
+        root.exception(f"{in_scene} {scene_name} COG conversion FAILED")
+        raise Exception('COG Error', e)
 
 
-        # PARSE METADATA TO TEMP COG DIRECTORY**
-        try:
-            root.info(f"{in_scene} {scene_name} Copying original METADATA")
+    # PARSE METADATA TO TEMP COG DIRECTORY**
+    try:
+        root.info(f"{in_scene} {scene_name} Copying original METADATA")
+        with timed_stage('metadata'):
             copy_s2_metadata(down_dir, scale_dir, scene_name)
-            root.info(f"{in_scene} {scene_name} COPIED original METADATA")
-        except:
-            root.exception(f"{in_scene} {scene_name} MTD not coppied")
+        root.info(f"{in_scene} {scene_name} COPIED original METADATA")
+    except:
+        root.exception(f"{in_scene} {scene_name} MTD not coppied")
 
-        # GENERATE YAML WITHIN TEMP COG DIRECTORY**
-        try:
-            root.info(f"{in_scene} {scene_name} Creating dataset YAML")
+    # GENERATE YAML WITHIN TEMP COG DIRECTORY**
+    try:
+        root.info(f"{in_scene} {scene_name} Creating dataset YAML")
+        with timed_stage('yaml'):
             create_yaml(scale_dir, yaml_prep_s2(scale_dir))
-            root.info(f"{in_scene} {scene_name} Created original METADATA")
-        except Exception as e:
-            root.exception(f"{in_scene} {scene_name} Dataset YAML not created")
-            raise Exception('YAML creation error', e)
+        root.info(f"{in_scene} {scene_name} Created original METADATA")
+    except Exception as e:
+        root.exception(f"{in_scene} {scene_name} Dataset YAML not created")
+        raise Exception('YAML creation error', e)
 
-            # MOVE COG DIRECTORY TO OUTPUT DIRECTORY
-        try:
-            root.info(f"{in_scene} {scene_name} Uploading to S3 Bucket")
-            s3_upload_cogs(glob.glob(scale_dir + '*'), s3_bucket, s3_dir)
-            root.info(f"{in_scene} {scene_name} Uploaded to S3 Bucket")
-        except Exception as e:
-            root.exception(f"{in_scene} {scene_name} Upload to S3 Failed")
-            raise Exception('S3  upload error', e)
+    # the yaml was the last thing to read the COGs, so uploaded ones can go
+    uploads.release_local()
+    return scene
 
-        clean_up(inter_dir)
 
+def s2_upload(scene):
+    """Pipeline stage: wait for the scaled COGs' background uploads, then upload the metadata and yaml."""
+    in_scene, scene_name = scene['in_scene'], scene['scene_name']
+    root = setup_logging()
+
+    # MOVE COG DIRECTORY TO OUTPUT DIRECTORY
+    try:
+        root.info(f"{in_scene} {scene_name} Uploading to S3 Bucket")
+        with timed_stage('upload'):
+            scene['uploads'].commit(glob.glob(scene['scale_dir'] + '*'))
+        root.info(f"{in_scene} {scene_name} Uploaded to S3 Bucket")
+    except Exception as e:
+        root.exception(f"{in_scene} {scene_name} Upload to S3 Failed")
+        raise Exception('S3  upload error', e)
+    s3_upload_run_report(scene['scale_dir'], scene.get('s3_bucket', 'public-eo-data'),
+                         scene.get('s3_dir', 'common_sensing/sentinel_2/'), scene['report'])
+
+    return scene
+
+
+def s2_clean_up(scene):
+    """Remove a scene's working directory once it has left the last stage (or failed)."""
+    if scene.get('uploads') is not None:
+        scene['uploads'].close()
+    clean_up(s2_scene_dirs(scene)[2])
+
+
+# The worker's pipeline mode runs these concurrently across scenes (see workflows/pipeline.py)
+S2_STAGES = [
+    Stage('download', s2_download),
+    Stage('process', s2_process),
+    Stage('upload', s2_upload),
+]
+
+
+def prepareS2(title, s3_bucket='public-eo-data', s3_dir='common_sensing/sentinel_2/', inter_dir='/tmp/data/intermediate/',
+              prodlevel='L2A', cog_profile=None, storage=None, **kwargs):
+    """
+    Prepare IN_SCENE of Sentinel-2 satellite data into OUT_DIR for ODC indexing. 
+
+    :param in_scene: input Sentinel-2 scene name (either L1C or L2A) i.e. "S2A_MSIL1C_20180820T223011_N0206_R072_T60KWE_20180821T013410[.SAFE]"
+    :param s3_bucket: name of the s3 bucket in which to upload preppared products
+    :param s3_dir: bucket dir in which to upload prepared products
+    :param inter_dir: dir in which to store intermeriary products - this will be nuked at the end of processing, error or not
+    :param prodlevel: Desired Sentinel-2 product level. Defaults to 'L1C'. Use 'L2A' for ARD equivalent
+    :param cog_profile: COG compression profile name, or {band: name} (see prep_utils.cog_profile)
+    :param storage: 'float' (default) or 'scaled-int' (see prep_utils.storage_mode)
+    :return: None
+    
+    Assumptions:
+    - env set at SEN2COR_8: i.e. Sen2Cor-02.08.00-Linux64/bin/L2A_Process"
+    - env set COPERNICUS_USERNAME
+    - env set COPERNICUS_PWD
+    - env set AWS_ACCESS
+    - env set AWS_SECRET
+    """
+    scene = dict(title=title, s3_bucket=s3_bucket, s3_dir=s3_dir, inter_dir=inter_dir, prodlevel=prodlevel,
+                 cog_profile=cog_profile, storage=storage)
+    try:
+        # download returns a new dict, which process puts the upload queue in: clean up that one
+        downloaded = run_stages(S2_STAGES[:1], scene)
+        if downloaded is not None:
+            scene = downloaded
+            run_stages(S2_STAGES[1:], scene)
     except Exception as e:
-        logging.error(f"could not process {scene_name}, {e}", )
-        clean_up(inter_dir)
+        # raised on, so the worker leaves the job's lease to expire and it is retried
+        logging.error(f"could not process {title}, {e}", )
+        raise
+    finally:
+        s2_clean_up(scene)
 
         
 if __name__ == '__main__':
@@ -422,13 +422,15 @@ def prepareS3(in_scene, s3_bucket='', s3_dir='fiji/Sentinel_2_test/', inter_dir=
     root = setup_logging()
 
     root.info(f"{in_scene} {scene_name} Starting")
+    report = start_report('sentinel_2', scene_name)
 
     try:
 
         # DOWNLOAD
         try:
             root.info(f"{in_scene} {scene_name} DOWNLOADING via GCloud")
-            download_s2_granule_gcloud(in_scene, down_dir)
+            with timed_stage('download'):
+                download_s2_granule_gcloud(in_scene, down_dir)
 #             raise Exception('skipping gcloud for testing')
             root.info(f"{in_scene} {scene_name} DOWNLOADED via GCloud")
         except:
@@ -437,17 +439,22 @@ def prepareS3(in_scene, s3_bucket='', s3_dir='fiji/Sentinel_2_test/', inter_dir=
                 s2id = find_s2_uuid(in_scene)
                 logging.debug(s2id)
                 root.info(f"{in_scene} {scene_name} AVAILABLE via ESA")
-                download_extract_s2_esa(s2id, inter_dir, down_dir)
+                with timed_stage('download'):
+                    download_extract_s2_esa(s2id, inter_dir, down_dir)
                 root.info(f"{in_scene} {scene_name} DOWNLOADED via ESA")
             except Exception as e:
                 root.exception(f"{in_scene} {scene_name} UNAVAILABLE via ESA too")
                 raise Exception('Download Error ESA', e)
 
+        report.add_input(down_dir)
+
         # [CREATE L2A WITHIN TEMP DIRECTORY]
         if ('MSIL1C' in in_scene) & (prodlevel == 'L2A'):
             root.info(f"{in_scene} {scene_name} Sen2Cor Processing")
+            report.tool('sen2cor', sen2cor_version(sen2cor8 or ''))
             try:
-                sen2cor_correction(sen2cor8, down_dir, inter_dir)
+                with timed_stage('sen2cor'):
+                    sen2cor_correction(sen2cor8, down_dir, inter_dir)
                 l2a_dir = glob.glob(inter_dir + '*L2A*.SAFE*')[0] + '/'
                 down_dir = l2a_dir
                 root.info(f"{in_scene} {scene_name} Sen2Cor COMPLETE")
@@ -458,7 +465,8 @@ def prepareS3(in_scene, s3_bucket='', s3_dir='fiji/Sentinel_2_test/', inter_dir=
         # CONVERT TO COGS TO TEMP COG DIRECTORY**
         try:
             root.info(f"{in_scene} {scene_name} Converting COGs")
-            conv_s2scene_cogs(down_dir, cog_dir, scene_name)
+            with timed_stage('cog'):
+                conv_s2scene_cogs(down_dir, cog_dir, scene_name)
             root.info(f"{in_scene} {scene_name} COGGED")
         except Exception as e:
             root.exception(f"{in_scene} {scene_name} COG conversion FAILED")
@@ -475,7 +483,8 @@ def prepareS3(in_scene, s3_bucket='', s3_dir='fiji/Sentinel_2_test/', inter_dir=
         # GENERATE YAML WITHIN TEMP COG DIRECTORY**
         try:
             root.info(f"{in_scene} {scene_name} Creating dataset YAML")
-            create_yaml(cog_dir, yaml_prep_s2(cog_dir))
+            with timed_stage('yaml'):
+                create_yaml(cog_dir, yaml_prep_s2(cog_dir))
             root.info(f"{in_scene} {scene_name} Created original METADATA")
         except Exception as e:
             root.exception(f"{in_scene} {scene_name} Dataset YAML not created")
@@ -484,11 +493,13 @@ def prepareS3(in_scene, s3_bucket='', s3_dir='fiji/Sentinel_2_test/', inter_dir=
             # MOVE COG DIRECTORY TO OUTPUT DIRECTORY
         try:
             root.info(f"{in_scene} {scene_name} Uploading to S3 Bucket")
-            s3_upload_cogs(glob.glob(cog_dir + '*'), s3_bucket, s3_dir)
+            with timed_stage('upload'):
+                s3_upload_cogs(glob.glob(cog_dir + '*'), s3_bucket, s3_dir)
             root.info(f"{in_scene} {scene_name} Uploaded to S3 Bucket")
         except Exception as e:
             root.exception(f"{in_scene} {scene_name} Upload to S3 Failed")
             raise Exception('S3  upload error', e)
+        s3_upload_run_report(cog_dir, s3_bucket, s3_dir, report)
 
         clean_up(inter_dir)
 
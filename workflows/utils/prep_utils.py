@@ -1,6 +1,10 @@
+import contextlib
+import json
 import logging
 import os
+import re
 import shutil
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 from random import randint
 from time import sleep
@@ -10,23 +14,63 @@ import botocore
 from asynchronousfilereader import AsynchronousFileReader
 import boto3
 import botocore
-import click
+import botocore.config
 from osgeo import gdal
 import rasterio
 import requests
 import platform
 import subprocess
+import tempfile
+import threading
+import time
 import yaml
 from osgeo import osr
 from rasterio.enums import Resampling
 from rasterio.env import GDALVersion
 from rasterio.io import MemoryFile
-from rasterio.shutil import copy
+from rasterio.windows import Window
 import numpy as np
 import gc
 
 import shutil  # ONLY FOR COPYING VAN DEMS TO TPM FOLDER FOR TESTING
 
+from . import run_report, s3_listing
+from .bands import BandError, cog_bands, cog_memory_limit, cog_threads, raster_bytes
+from .run_report import sen2cor_version, snap_version, start_report
+
+try:
+    from workflows import metrics
+except ImportError:
+    # the older images ship this module as utils/ without the workflows package (or prometheus_client)
+    metrics = None
+
+
+@contextlib.contextmanager
+def timed_stage(name):
+    """Time a prepare stage into the worker's metrics (if any) and the scene's run report (if any)."""
+    report = run_report.current()
+    with contextlib.ExitStack() as stack:
+        if metrics is not None:
+            stack.enter_context(metrics.stage(name))
+        if report is not None:
+            stack.enter_context(report.stage(name))
+        yield
+
+
+def count_bytes(direction, path):
+    """Add the size of a file just downloaded or uploaded to the worker's metrics and run report."""
+    if not os.path.isfile(path):
+        return
+    count_size(direction, os.path.getsize(path))
+
+
+def count_size(direction, size):
+    """count_bytes for bytes that never were a local file (see s3_stream_cog)."""
+    if metrics is not None:
+        metrics.count_bytes(direction, size)
+    report = run_report.current()
+    if report is not None:
+        report.add_bytes(direction, size)
 
 
 class DownloadError(Exception):
@@ -37,11 +81,11 @@ class DownloadError(Exception):
         self.message = message
 
 
-def to_cog(input_file, output_file, nodata=0):
+def to_cog(input_file, output_file, nodata=0, profile=None, threads=None):
     if os.path.exists(input_file):
         # ensure output cog doesn't already exist
         if not os.path.exists(output_file):
-            conv_sgl_cog(input_file, output_file, nodata=nodata)
+            conv_sgl_cog(input_file, output_file, nodata=nodata, profile=profile, threads=threads)
         else:
             logging.info(f'cog already exists: {output_file}')
     else:
@@ -67,39 +111,106 @@ def discover_tiffs(in_dir, hemisphere=None):
     return prod_paths
 
 
-def conv_sgl_cog(in_path, out_path, nodata=0):
-    # set default cog profile (as recommended by alex leith)
-    logging.info('COG CREATING STAGE')
-    cog_profile = {
-        'driver': 'GTiff',
-        'interleave': 'pixel',
-        'tiled': True,
-        'blockxsize': 512,
-        'blockysize': 512,
-        'compress': 'DEFLATE',
-        'predictor': 2,
-        'zlevel': 9
-    }
+# default cog profile (as recommended by alex leith)
+COG_PROFILE = {
+    'driver': 'GTiff',
+    'interleave': 'pixel',
+    'tiled': True,
+    'blockxsize': 512,
+    'blockysize': 512,
+    'compress': 'DEFLATE',
+    'predictor': 2,
+    'zlevel': 9
+}
+
+_COG_LAYOUT = {k: COG_PROFILE[k] for k in ('driver', 'interleave', 'tiled', 'blockxsize', 'blockysize')}
+
+# named compression profiles, compared by workflows/cog_benchmark.py
+COG_PROFILES = {
+    'archive': COG_PROFILE,
+    'balanced': dict(_COG_LAYOUT, compress='ZSTD', predictor=2, zstd_level=9),
+    'fast': dict(_COG_LAYOUT, compress='ZSTD', predictor=2, zstd_level=1),
+    # lossless for integer bands, within 1e-4 (a tenth of the 1e-3 scaled reflectance step) for float ones
+    'lossy-float': dict(_COG_LAYOUT, compress='LERC_ZSTD', max_z_error=0.0001),
+}
+
+DEFAULT_COG_PROFILE = 'archive'
+
+
+def cog_profile(product=None, choice=None):
+    """
+    Creation options to COG 'product' (e.g. "B02_10m", "sr_b4") with.
+
+    'choice' is a job's cog_profile field: a COG_PROFILES name, or a
+    {product: name} dict with an optional "default" entry. Without one, the
+    COG_PROFILE env var is used the same way (a dict as JSON), then "archive".
+    """
+    if choice is None:
+        choice = os.getenv('COG_PROFILE') or DEFAULT_COG_PROFILE
+        if choice.startswith('{'):
+            choice = json.loads(choice)
+    if isinstance(choice, dict):
+        choice = choice.get(product) or choice.get('default') or DEFAULT_COG_PROFILE
+    if choice not in COG_PROFILES:
+        raise ValueError(f"Unknown COG profile {choice!r}, expected one of {sorted(COG_PROFILES)}")
+    return COG_PROFILES[choice]
+
+
+# how scaled bands are stored: 'float' applies the scale factor and writes float32;
+# 'scaled-int' keeps the integer values and tags the COG (and yaml) with the factor
+STORAGE_MODES = ('float', 'scaled-int')
+
+
+def storage_mode(choice=None):
+    """A job's storage field, else the COG_STORAGE env var, else 'float'."""
+    choice = choice or os.getenv('COG_STORAGE') or 'float'
+    if choice not in STORAGE_MODES:
+        raise ValueError(f"Unknown storage mode {choice!r}, expected one of {STORAGE_MODES}")
+    return choice
+
+
+def conv_sgl_scale_tagged_cog(in_path, out_path, scale_factor, add_offset, nodata, profile=None, threads=None):
+    """
+    COG in_path keeping its integer values, tagged with the scale_factor and
+    add_offset that give the physical value (value * scale_factor + add_offset),
+    for readers (and ODC, via the yaml) to apply at load time.
+    """
+    cog_translate(in_path, out_path, profile or COG_PROFILE, overview_level=5, overview_resampling='average',
+                  dst_nodata=nodata, scale_offset=(scale_factor, add_offset), threads=threads)
+
 
+def band_scaling(path):
+    """scale_factor/add_offset of a scale tagged COG, for its yaml band entry, or {} if it has none."""
+    with rasterio.open(path) as src:
+        scale, offset = src.scales[0], src.offsets[0]
+        nodata = src.nodata
+    if (scale, offset) == (1.0, 0.0):
+        return {}
+    return {'scale_factor': scale, 'add_offset': offset, 'nodata': nodata}
+
+
+def conv_sgl_cog(in_path, out_path, nodata=0, profile=None, threads=None):
+    """
+    Convert a single input file to COG format, tagged with nodata as it is
+    written; the input is left alone.
+
+    :param in_path: path to non-cog file
+    :param out_path: path to new cog file
+    :param nodata: nodata value to tag the COG with
+    :param profile: creation options (default: COG_PROFILE)
+    :param threads: GDAL threads, see cog_translate
+    """
+    logging.info('COG CREATING STAGE')
     cog_translate(
         in_path,
         out_path,
-        cog_profile,
+        profile or COG_PROFILE,
         overview_level=5,
-        overview_resampling='average'
+        overview_resampling='average',
+        dst_nodata=nodata,
+        threads=threads
     )
 
-    ds = gdal.Open(in_path, gdal.GA_Update)
-    if ds is not None:
-        b = ds.GetRasterBand(1)
-        b.SetNoDataValue(nodata)
-        b.FlushCache()
-        b = None
-        ds = None
-    else:
-        logging.info('not updated nodata')
-
-
 
 def clean_up(work_dir: str) -> None:
     # remove all contents in the work_dir
@@ -110,9 +221,7 @@ def clean_up(work_dir: str) -> None:
 def get_available_regions(region, s3_bucket):
     """Gets a list of the regions which we have external dems for"""
 
-    client = s3_create_client(s3_bucket)[0]
-    result = client.list_objects(Bucket=s3_bucket, Prefix='common_sensing/ancillary_products/SRTM1Sec/', Delimiter='/')
-    contents = result.get('Contents')
+    contents = s3_list(s3_bucket, 'common_sensing/ancillary_products/SRTM1Sec/', recursive=False)
     available_regions = []
     for dir in contents:
         dem = dir.get('Key').split('/')[-1]
@@ -165,7 +274,10 @@ def download_external_dems(region, in_scene, scene_name, tmp_inter_dir, s3_bucke
             for ext_dem_path, ext_dem_path_local in zip(ext_dem_path_list, ext_dem_path_local_list):
                 try:
                     root.debug(f"Downloading {ext_dem_path} to {ext_dem_path_local}")
-                    s3_download(s3_bucket, ext_dem_path, ext_dem_path_local)
+                    # other scene slots in this pod share the DEMs, so only ever expose a complete file
+                    partial_path = f"{ext_dem_path_local}.{os.getpid()}.part"
+                    s3_download(s3_bucket, ext_dem_path, partial_path)
+                    os.replace(partial_path, ext_dem_path_local)
                 except Exception as e:
                     root.exception(e)
                     root.exception(f"{ext_dem_path} unavailable or doesn't exist")
@@ -222,6 +334,13 @@ def run_snap_command(command, timeout =  60*45):
 
     logging.debug(f"running {full_command}")
 
+    # the S1 graphs are cs_s1_pt<N>_*.xml, time each part separately
+    graph = re.search(r'_pt(\d)', os.path.basename(command[1])) if len(command) > 1 else None
+    with timed_stage(f"snap_pt{graph.group(1)}" if graph else "snap"):
+        _run_snap_process(full_command, base_env, timeout)
+
+
+def _run_snap_process(full_command, base_env, timeout):
     process = subprocess.Popen(full_command, env=base_env, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
     process.timeout = timeout
     snap_logger_out = logging.getLogger("snap_stdout")
@@ -243,7 +362,7 @@ def run_snap_command(command, timeout =  60*45):
         std_out_reader.join()
         std_err_reader.join()
     except subprocess.TimeoutExpired as e :
-        logging.error(f"IGNORING subprocess timeout running {command}")
+        logging.error(f"IGNORING subprocess timeout running {full_command}")
         return
     if process.returncode != 0:
         raise Exception("Snap returned non zero exit status")
@@ -264,6 +383,7 @@ def get_file_via_stream(url:str, output_file_path:str) -> None:
         logging.debug(f"downloading {url} to {output_file_path} using stream")
         with open(output_file_path, 'wb') as f:
            shutil.copyfileobj(r.raw, f)
+    count_bytes("downloaded", output_file_path)
 
 
 def get_file(url, output_path, user=None, password=None):
@@ -272,6 +392,7 @@ def get_file(url, output_path, user=None, password=None):
     if request:
         with open(output_path, 'wb') as f:
             logging.info(f.write(request.content))
+        count_bytes("downloaded", output_path)
 
 
 def get_url(url, user=None, password=None):
@@ -392,51 +513,89 @@ def create_yaml(scene_dir, metadata):
     logging.debug('Created yaml: {}'.format(yaml_path))
 
 
-def s3_create_client(s3_bucket):
+_s3_lock = threading.Lock()
+_s3_clients = {}
+_s3_local = threading.local()
+
+
+def s3_config():
     """
-    Create and set up a connection to S3
-    :param s3_bucket:
-    :return: the s3 client object.
+    botocore Config shared by every S3 client: enough pooled connections for
+    the upload threads, TCP keep-alive, and retries with backoff (throttling
+    included). S3_MAX_POOL_CONNECTIONS and S3_MAX_ATTEMPTS override the defaults.
     """
+    return botocore.config.Config(
+        max_pool_connections=int(os.getenv("S3_MAX_POOL_CONNECTIONS") or 50),
+        retries={'max_attempts': int(os.getenv("S3_MAX_ATTEMPTS") or 10), 'mode': 'standard'},
+        tcp_keepalive=True,
+    )
 
+
+def _s3_settings():
     access = os.getenv("AWS_ACCESS_KEY_ID", 'none')
     secret = os.getenv("AWS_SECRET_ACCESS_KEY", 'none')
+    endpoint_url = os.getenv("S3_ENDPOINT", 'http://localhost:30003')
+    return access, secret, endpoint_url
 
-    session = boto3.Session(
-        access,
-        secret,
-    )
 
-    endpoint_url = os.getenv("S3_ENDPOINT", 'http://localhost:30003')
+def _s3_session_client(settings):
+    """The (session, client) for these settings, made once per process and shared by its threads."""
+    # a forked child must not share its parent's pooled connections
+    key = (os.getpid(),) + settings
+    with _s3_lock:
+        if key not in _s3_clients:
+            access, secret, endpoint_url = settings
+            logging.debug('Endpoint URL: {}'.format(endpoint_url))
+            session = boto3.Session(access, secret)
+            client = session.client('s3', endpoint_url=endpoint_url, config=s3_config())
+            _s3_clients[key] = session, client
+        return _s3_clients[key]
 
-    if endpoint_url is not None:
-        logging.debug('Endpoint URL: {}'.format(endpoint_url))
 
-    if endpoint_url is not None:
-        s3 = session.resource('s3', endpoint_url=endpoint_url)
-    else:
-        s3 = session.resource('s3', region_name='eu-west-2')
+def s3_create_client(s3_bucket):
+    """
+    Get the S3 connection for the current credentials and endpoint.
 
-    bucket = s3.Bucket(s3_bucket)
+    The client is cached and shared between threads (boto3 clients are
+    thread-safe), so its pooled connections are reused across calls; the
+    resource behind the bucket is per thread, as boto3 resources aren't.
+    :param s3_bucket:
+    :return: the s3 client object and the bucket.
+    """
+    settings = _s3_settings()
+    session, s3_client = _s3_session_client(settings)
 
-    if endpoint_url is not None:
-        s3_client = boto3.client(
-            's3',
-            aws_access_key_id=access,
-            aws_secret_access_key=secret,
-            endpoint_url=endpoint_url
-        )
-    else:
-        s3_client = boto3.client(
-            's3',
-            aws_access_key_id=access,
-            aws_secret_access_key=secret
-        )
+    resources = getattr(_s3_local, 'resources', None)
+    if resources is None or _s3_local.pid != os.getpid():
+        resources = _s3_local.resources = {}
+        _s3_local.pid = os.getpid()
+    if settings not in resources:
+        with _s3_lock:
+            resources[settings] = session.resource('s3', endpoint_url=settings[2], config=s3_config())
 
-    return s3_client, bucket
+    return s3_client, resources[settings].Bucket(s3_bucket)
 
 
 gb = 1024 ** 3
+mb = 1024 ** 2
+
+
+def s3_transfer_config():
+    """
+    TransferConfig for uploads: files over S3_MULTIPART_CHUNK_MB (8 to 64, default
+    16) go up in parts of that size, S3_UPLOAD_PART_THREADS at a time, so a large
+    band is parallel inside as well as alongside the scene's other files.
+    """
+    chunk = min(max(int(os.getenv("S3_MULTIPART_CHUNK_MB") or 16), 8), 64) * mb
+    return boto3.s3.transfer.TransferConfig(multipart_threshold=chunk,
+                                            multipart_chunksize=chunk,
+                                            max_concurrency=int(os.getenv("S3_UPLOAD_PART_THREADS") or 4),
+                                            use_threads=True)
+
+
+def s3_upload_workers():
+    """Files of a scene uploaded at once; each also uses S3_UPLOAD_PART_THREADS for its parts."""
+    return max(1, int(os.getenv("S3_UPLOAD_WORKERS") or 8))
 
 
 def s3_single_upload(in_path, s3_path, s3_bucket):
@@ -445,62 +604,357 @@ def s3_single_upload(in_path, s3_path, s3_bucket):
 
     :param in_path: a path to a file on the local file system
     :param s3_path: where in S3 to put the file.
-    :return: None
+    :return: the bytes uploaded
     """
     
     # prep session & creds
     s3_client, bucket = s3_create_client(s3_bucket)
 
-    # Ensure that multipart uploads only happen if the size of a transfer is larger than
-    # S3's size limit for non multipart uploads, which is 5 GB. we copy using multipart 
-    # at anything over 2GB
-    transfer_config = boto3.s3.transfer.TransferConfig(multipart_threshold=2 * gb,
-                                                       max_concurrency=10,
-                                                       multipart_chunksize=2 * gb,
-                                                       use_threads=True)
-
     logging.info(f"Local source file: {in_path}")
     logging.info(f"S3 target file: {s3_path}")
 
     logging.info(f"Start: {in_path} {str(datetime.today().strftime('%Y-%m-%d %H:%M:%S'))}")
 
-    s3_client.upload_file(in_path, bucket.name, s3_path)
+    s3_client.upload_file(in_path, bucket.name, s3_path, Config=s3_transfer_config())
+    _s3_listings.invalidate(s3_bucket, s3_path)
+    count_bytes("uploaded", in_path)
 
     logging.info(f"Finish: {in_path} {str(datetime.today().strftime('%Y-%m-%d %H:%M:%S'))}")
+    return os.path.getsize(in_path)
 
 
-def s3_upload_cogs(in_paths, s3_bucket, s3_dir):
-    # create upload lists for multi-threading
-    out_paths = [s3_dir + i.split('/')[-2] + '/' + i.split('/')[-1]
-                 for i in in_paths]
+def _upload_in_thread(report, in_path, s3_path, s3_bucket):
+    # the run report is per thread, so carry the scene's over to count the bytes in it
+    with run_report.activate(report):
+        return s3_single_upload(in_path, s3_path, s3_bucket)
+
+
+def s3_upload_files(upload_list):
+    """
+    Upload every (in_path, s3_path, s3_bucket) in upload_list, s3_upload_workers()
+    at a time. Every file is tried; if any failed, the first error is raised
+    once the rest are done. Returns the bytes uploaded.
+    """
+    if not upload_list:
+        return 0
+    report = run_report.current()
+    workers = min(s3_upload_workers(), len(upload_list))
+    uploaded, errors = 0, []
+    with ThreadPoolExecutor(workers) as pool:
+        futures = {pool.submit(_upload_in_thread, report, *i): i for i in upload_list}
+        for future in as_completed(futures):
+            try:
+                uploaded += future.result()
+            except Exception as e:
+                logging.error(f"Could not upload {futures[future][0]} to {futures[future][1]}: {e}")
+                errors.append(e)
+    if errors:
+        raise errors[0]
+    return uploaded
+
+
+def s3_dirs(s3_dir):
+    """A job's s3_dir as a list: coalesced jobs (see RedisWQ.enqueue) carry several targets."""
+    return [s3_dir] if isinstance(s3_dir, str) else list(s3_dir)
+
+
+def s3_keys(in_path, s3_dir):
+    """Where s3_upload_cogs puts in_path: s3_dir/<scene dir>/<file name>, for each s3_dir."""
+    return [d + in_path.split('/')[-2] + '/' + in_path.split('/')[-1] for d in s3_dirs(s3_dir)]
+
+
+def s3_stream_cog(src_path, out_path, s3_bucket, s3_dir, profile=None, temp_dir=None, **cog_kwargs):
+    """
+    Write src_path as a COG and upload it where s3_upload_cogs would put
+    out_path, without it passing through the scene's directory.
+
+    A raster up to COG_MEMORY_LIMIT_MB is built, intermediate and COG, in
+    memory (there's no COG driver in GDAL 3.0, so the layout still needs
+    the copy from an intermediate); a bigger one in a temporary directory
+    in temp_dir, as cog_translate would. The finished COG is checked, then
+    read from the start into a multipart upload (see s3_transfer_config);
+    an invalid COG raises InvalidCOGError before anything is uploaded.
+    src_path can itself be a MemoryFile's name, e.g. a GeoTIFF just
+    exported from xarray.
+
+    :param out_path: local path the COG would have had; only its scene dir and file name are used
+    :param profile: COG creation options (default: cog_profile())
+    :param temp_dir: where a COG too big for memory is built (default: the system's temp dir)
+    :param cog_kwargs: passed on to cog_translate, e.g. dst_nodata
+    :return: size of the COG in bytes
+    """
+    with rasterio.open(src_path) as src:
+        in_memory = raster_bytes(src.width, src.height, src.count,
+                                 cog_kwargs.get('dtype') or src.dtypes[0]) <= cog_memory_limit()
+
+    with contextlib.ExitStack() as stack:
+        if in_memory:
+            cog = stack.enter_context(MemoryFile(filename=os.path.basename(out_path)))
+            cog_path = cog.name
+        else:
+            tmp = stack.enter_context(tempfile.TemporaryDirectory(dir=temp_dir))
+            cog_path = os.path.join(tmp, os.path.basename(out_path))
+            temp_dir = tmp
+        cog_translate(src_path, cog_path, profile or cog_profile(), in_memory=in_memory, temp_dir=temp_dir,
+                      **cog_kwargs)
+        size = gdal.VSIStatL(cog_path).size
+        s3_client, bucket = s3_create_client(s3_bucket)
+        for s3_path in s3_keys(out_path, s3_dir):
+            logging.info(f"Streaming COG to S3: {s3_path}")
+            with (contextlib.nullcontext(cog) if in_memory else open(cog_path, 'rb')) as f:
+                f.seek(0)
+                s3_client.upload_fileobj(f, bucket.name, s3_path, Config=s3_transfer_config())
+            _s3_listings.invalidate(s3_bucket, s3_path)
+            count_size("uploaded", size)
+    return size
+
+
+def s3_upload_cogs(in_paths, s3_bucket, s3_dir, published=None):
+    """
+    Upload a scene's files to s3_dir/<scene dir>/, for each s3_dir if given a list.
+
+    The other files go up concurrently (see s3_upload_files), and the
+    datacube-metadata.yaml only once they all have, so a published yaml means the
+    whole scene is there (see s3_check_published). Pass the 'published'
+    {key: size} listing from s3_check_published to skip files that a previous
+    attempt already uploaded.
+    """
+    todo = _s3_upload_list(in_paths, s3_bucket, s3_dir, published)
+
+    # everything else goes up concurrently; the yaml only once all of it is there
+    yamls = [i for i in todo if i[0].endswith('datacube-metadata.yaml')]
+    files = [i for i in todo if i not in yamls]
+    start = time.monotonic()
+    uploaded = s3_upload_files(files)
+    uploaded += s3_upload_files(yamls)
+    seconds = time.monotonic() - start
+    if todo:
+        logging.info(f"Uploaded {len(todo)} files, {uploaded / mb:.1f} MB in {seconds:.1f} s "
+                     f"({uploaded / mb / max(seconds, 1e-6):.1f} MB/s)")
+
+
+def _s3_upload_list(in_paths, s3_bucket, s3_dir, published=None):
+    """(in_path, s3_path, s3_bucket) for each file and s3_dir, less those already in 'published'."""
+    # the yaml marks the scene complete, so upload it after everything else
+    in_paths = sorted(in_paths, key=lambda i: i.endswith('datacube-metadata.yaml'))
 
+    # create upload lists for multi-threading
     upload_list = [(in_path, out_path, s3_bucket)
-                   for in_path, out_path in zip(in_paths, out_paths)]
+                   for in_path in in_paths for out_path in s3_keys(in_path, s3_dir)]
+
+    report = run_report.current()
+    invalid = report.invalid_cogs([i[0] for i in upload_list]) if report else []
+    if invalid:
+        raise InvalidCOGError(f"Refusing to upload invalid COGs: {invalid}")
 
+    todo = []
     for i in upload_list:
-        s3_single_upload(i[0], i[1], i[2])
+        if published and published.get(i[1]) == os.path.getsize(i[0]):
+            logging.info(f"Already uploaded, skipping: {i[1]}")
+            continue
+        todo.append(i)
+    return todo
 
 
-def s3_list_objects(s3_bucket, prefix):
-    # prep session & creds
+class S3UploadQueue(object):
+    """
+    Upload a scene's files in the background as they are finished, rather
+    than all of them once the scene is done.
+
+        uploads = S3UploadQueue(s3_bucket, s3_dir, published)
+        scale_cog_landsat_l2(untar_dir, cog_dir, done=uploads.put)
+        create_yaml(cog_dir, yaml_prep_landsat(cog_dir))
+        uploads.release_local()
+        uploads.commit(glob.glob(cog_dir + '*'))
+
+    A file's local copy is removed once its upload is acknowledged, but not
+    before release_local(), as the yaml is built from the COGs. commit()
+    waits for every queued upload, then uploads the files not queued, with
+    the yaml last as in s3_upload_cogs, so the yaml is never published
+    ahead of a band. close() stops the queue without committing, e.g. when
+    the scene failed.
+    """
+
+    def __init__(self, s3_bucket, s3_dir, published=None):
+        self.s3_bucket = s3_bucket
+        self.s3_dir = s3_dir
+        self.published = published
+        self.report = run_report.current()
+        self.uploaded = 0
+        self._pool = ThreadPoolExecutor(s3_upload_workers())
+        self._futures = {}
+        self._acknowledged = set()
+        self._released = False
+        self._lock = threading.Lock()
+        self._start = time.monotonic()
+
+    def put(self, in_path):
+        """Start uploading in_path (to every s3_dir) in the background."""
+        if in_path.endswith('datacube-metadata.yaml'):
+            raise ValueError('The yaml goes up in commit(), after everything else')
+        with run_report.activate(self.report):
+            upload_list = _s3_upload_list([in_path], self.s3_bucket, self.s3_dir, self.published)
+        futures = [self._pool.submit(_upload_in_thread, self.report, *i) for i in upload_list]
+        with self._lock:
+            self._futures[in_path] = futures
+        if not futures:
+            self._acknowledge(in_path, futures)
+        for future in futures:
+            future.add_done_callback(lambda _, p=in_path, f=futures: self._acknowledge(p, f))
+
+    def _acknowledge(self, in_path, futures):
+        if not all(f.done() for f in futures) or any(f.cancelled() or f.exception() for f in futures):
+            return
+        with self._lock:
+            if in_path in self._acknowledged:
+                return
+            self._acknowledged.add(in_path)
+            self.uploaded += sum(f.result() for f in futures)
+            remove = self._released
+        if remove:
+            _remove_local(in_path)
+
+    def release_local(self):
+        """Local copies are no longer needed: remove those uploaded, and the rest as they are."""
+        with self._lock:
+            self._released = True
+            acknowledged = list(self._acknowledged)
+        for in_path in acknowledged:
+            _remove_local(in_path)
+
+    def commit(self, in_paths):
+        """Wait for the queued uploads, then upload in_paths not queued, yaml last. Raises if any failed."""
+        try:
+            errors = []
+            for in_path, futures in list(self._futures.items()):
+                for future in futures:
+                    try:
+                        future.result()
+                    except Exception as e:
+                        logging.error(f"Could not upload {in_path}: {e}")
+                        errors.append(e)
+            if errors:
+                raise errors[0]
+            rest = [i for i in in_paths if i not in self._futures and os.path.exists(i)]
+            with run_report.activate(self.report):
+                s3_upload_cogs(rest, self.s3_bucket, self.s3_dir, self.published)
+            seconds = time.monotonic() - self._start
+            logging.info(f"Uploaded {len(self._futures)} files in the background, {self.uploaded / mb:.1f} MB "
+                         f"over {seconds:.1f} s")
+        finally:
+            self.close()
+
+    def close(self):
+        """Cancel the uploads not yet started and wait for the rest."""
+        for futures in list(self._futures.values()):
+            for future in futures:
+                future.cancel()
+        self._pool.shutdown(wait=True)
+
+
+def _remove_local(path):
+    if os.path.exists(path):
+        os.remove(path)
+        logging.debug(f"Uploaded, removed local copy: {path}")
+
+
+def record_band_stats(stats_by_path):
+    """Put the stats gathered while scaling bands in the current run report, by output file name."""
+    report = run_report.current()
+    if report is None:
+        return
+    for path, stats in stats_by_path.items():
+        if stats:
+            report.add_band_stats(os.path.basename(path), stats)
+
+
+def s3_upload_run_report(scene_dir, s3_bucket, s3_dir, report=None):
+    """
+    Write the scene's run report into scene_dir and upload it next to its
+    yaml. Called once the scene is uploaded, so the report covers the upload
+    too; failing to write it doesn't fail the scene.
+    """
+    report = report or run_report.current()
+    if report is None:
+        return
+    try:
+        s3_upload_cogs([report.write(scene_dir)], s3_bucket, s3_dir)
+    except Exception:
+        logging.exception(f"Could not upload run report for {scene_dir}")
+
+
+def s3_list_scene_objects(s3_bucket, s3_dir, scene_name):
+    """
+    {key: size} of every object under s3_dir whose name starts with scene_name,
+    from one listing per s3_dir. The prefix has no trailing slash so that
+    sibling dirs such as <scene_name>_E / <scene_name>_W come back too.
+    """
+    return {e['Key']: e['Size'] for d in s3_dirs(s3_dir) for e in s3_list(s3_bucket, d + scene_name)}
+
+
+def scene_dirs_published(objects, s3_dir, scene_dirs):
+    """True if every one of scene_dirs under (each) s3_dir has its datacube-metadata.yaml in objects."""
+    return all(f'{d}{sd}/datacube-metadata.yaml' in objects for d in s3_dirs(s3_dir) for sd in scene_dirs)
+
+
+def s3_check_published(s3_bucket, s3_dir, scene_name, scene_dirs=None):
+    """
+    Pre-flight check run by the prepare* functions before any scene work.
+
+    :param scene_name: listing prefix under s3_dir
+    :param scene_dirs: dirs the scene is uploaded to (default [scene_name])
+    :return: (published, objects) - published is True if every scene dir
+        already has its yaml; objects ({key: size}) is what is already there,
+        for s3_upload_cogs to resume a partial upload. A failed listing is
+        logged and treated as nothing published.
+    """
+    try:
+        objects = s3_list_scene_objects(s3_bucket, s3_dir, scene_name)
+    except Exception:
+        logging.exception(f"Could not list {s3_dir}{scene_name} in {s3_bucket}, processing anyway")
+        return False, {}
+
+    published = scene_dirs_published(objects, s3_dir, scene_dirs or [scene_name])
+    if published:
+        logging.info(f"{scene_name} already published to {s3_bucket}/{s3_dir}, skipping")
+    elif objects:
+        logging.info(f"{scene_name} partially published ({len(objects)} objects), will upload the rest")
+    return published, objects
+
+
+# listings kept for S3_LIST_CACHE_SECONDS (off by default); our own uploads drop the ones they change
+_s3_listings = s3_listing.ListingCache(float(os.getenv("S3_LIST_CACHE_SECONDS") or 0))
+
+
+def s3_list(s3_bucket, prefix, recursive=True, depth=1):
+    """
+    Generator of every object ({Key, Size, ETag, LastModified}) under prefix,
+    listed in concurrent shards, one per sub-prefix (see s3_listing). Use
+    depth 2 or more for trees with few top level dirs, e.g. common_sensing/.
+    """
     client, bucket = s3_create_client(s3_bucket)
-    response = client.list_objects_v2(Bucket=s3_bucket, Prefix=prefix)
+    return s3_listing.list_objects(client, s3_bucket, prefix, depth=depth, recursive=recursive,
+                                   cache=_s3_listings)
 
-    return response
+
+def s3_list_objects(s3_bucket, prefix):
+    """
+    A list_objects_v2 style response for everything under prefix (all of
+    it, where a single list_objects_v2 call stops at 1,000 keys).
+    """
+    contents = list(s3_list(s3_bucket, prefix))
+    return {'Name': s3_bucket, 'Prefix': prefix, 'IsTruncated': False, 'KeyCount': len(contents),
+            'Contents': contents}
 
 
 def s3_list_objects_paths(s3_bucket, prefix):
     """List of paths only returned, not full object responses"""
-    client, bucket = s3_create_client(s3_bucket)
-    
-    return [e['Key'] for p in client.get_paginator("list_objects_v2").paginate(Bucket=s3_bucket, Prefix=prefix) for e in p['Contents']]
+    return [e['Key'] for e in s3_list(s3_bucket, prefix)]
 
 
 def s3_list_objects_pathssize(s3_bucket, prefix):
     """List of tuples paths + sizes only returned, not full object responses"""
-    client, bucket = s3_create_client(s3_bucket)
-    
-    return [(e['Key'], e['Size']) for p in client.get_paginator("list_objects_v2").paginate(Bucket=s3_bucket, Prefix=prefix) for e in p['Contents']]
+    return [(e['Key'], e['Size']) for e in s3_list(s3_bucket, prefix)]
 
 
 def s3_calc_scene_size(scene_name, s3_bucket, prefix):
@@ -519,6 +973,7 @@ def s3_download(s3_bucket, s3_obj_path, dest_path):
     
     try:
         bucket.download_file(s3_obj_path, dest_path)
+        count_bytes("downloaded", dest_path)
     except botocore.exceptions.ClientError as e:
         if e.response['Error']['Code'] == "404":
             logging.info("The object does not exist.")
@@ -538,9 +993,35 @@ def cog_translate(
         overview_level=5,
         overview_resampling=None,
         config=None,
+        transform=None,
+        dtype=None,
+        dst_nodata=None,
+        in_memory=None,
+        temp_dir=None,
+        threads=None,
+        scale_offset=None,
 ):
     """
     Create Cloud Optimized Geotiff.
+
+    The tiled GTiff and overviews the COG is copied from are built in memory
+    for rasters up to COG_MEMORY_LIMIT_MB, and in a temporary file beside
+    dst_path (or in temp_dir) for bigger ones, so memory is then bounded by
+    GDAL's block cache (GDAL_CACHEMAX) instead of growing with the raster.
+    Both go through the same GTiff driver, so the COG's layout is the same.
+
+    The COG's header (IFD and block order, tiling, overviews, mask) is
+    checked (see cog_structure) on the dataset GDAL's copy leaves open, so
+    the file isn't opened again and no pixels are read back; the result goes
+    in the current run report, and InvalidCOGError is raised for a broken COG.
+
+    The source is read in strips of whole block rows, and GDAL decodes
+    (JPEG2000) and compresses tiles with 'threads' threads; tiles are
+    compressed independently, so the output doesn't depend on the count.
+
+    With 'transform', each block is passed through transform(array) as it is
+    read, so rescaling a band and writing it as a COG is one read and one
+    encode (see prepLS.conv_sgl_scaled_cog and prepS2.conv_s2_scaled_cog).
     Parameters
     ----------
     src_path : str or PathLike object
@@ -560,8 +1041,26 @@ def cog_translate(
         COGEO overview (decimation) level
     config : dict
         Rasterio Env options.
+    transform : callable, optional
+        Applied to every (bands, rows, cols) block read, returning the block to write.
+    dtype : str, optional
+        Output data type, if 'transform' changes it.
+    dst_nodata : int or float, optional
+        nodata value to tag the output with.
+    in_memory : bool, optional
+        Force the intermediate into memory (True) or a temporary file (False).
+    temp_dir : str, optional
+        Where to put the temporary file (default: dst_path's directory).
+    threads : int, optional
+        GDAL threads to decode and compress with (default: bands.cog_threads()).
+    scale_offset : (float, float), optional
+        scale factor and offset to tag every band with (see conv_sgl_scale_tagged_cog).
     """
-    config = config or {}
+    threads = threads or cog_threads()
+    # a GDAL_NUM_THREADS in the caller's config wins
+    config = {'GDAL_NUM_THREADS': threads, **(config or {})}
+    # keep the mask inside the COG rather than in a .msk beside it
+    config.setdefault("GDAL_TIFF_INTERNAL_MASK", True)
 
     with rasterio.Env(**config):
         with rasterio.open(src_path) as src:
@@ -575,189 +1074,122 @@ def cog_translate(
             meta.update(**dst_kwargs)
             meta.pop("compress", None)
             meta.pop("photometric", None)
+            if dtype is not None:
+                meta["dtype"] = dtype
+            if dst_nodata is not None:
+                meta["nodata"] = dst_nodata
+
+            if in_memory is None:
+                in_memory = raster_bytes(meta["width"], meta["height"], meta["count"],
+                                         meta["dtype"]) <= cog_memory_limit()
+
+            with contextlib.ExitStack() as stack:
+                if in_memory:
+                    memfile = stack.enter_context(MemoryFile())
+                    mem = stack.enter_context(memfile.open(**meta))
+                else:
+                    tmp = stack.enter_context(tempfile.TemporaryDirectory(
+                        dir=temp_dir or os.path.dirname(os.path.abspath(dst_path))))
+                    logging.debug(f"Building {dst_path} in {tmp}")
+                    mem = stack.enter_context(rasterio.open(os.path.join(tmp, "cog.tif"), "w", **meta))
+
+                if scale_offset is not None:
+                    scale, offset = scale_offset
+                    mem.scales = [scale] * meta["count"]
+                    mem.offsets = [offset] * meta["count"]
+                    mem.update_tags(scale_factor=scale, add_offset=offset)
+
+                for w in _strip_windows(mem):
+                    matrix = src.read(window=w, indexes=indexes)
+                    if transform is not None:
+                        matrix = transform(matrix)
+                    mem.write(matrix, window=w)
+
+                    if nodata is not None:
+                        mask_value = np.all(matrix != nodata, axis=0).astype(np.uint8) * 255
+                    elif alpha is not None:
+                        mask_value = src.read(alpha, window=w)
+                    else:
+                        mask_value = None
+                    if mask_value is not None:
+                        mem.write_mask(mask_value, window=w)
 
-            with MemoryFile() as memfile:
-                with memfile.open(**meta) as mem:
-                    wind = list(mem.block_windows(1))
-                    for ij, w in wind:
-                        matrix = src.read(window=w, indexes=indexes)
-                        mem.write(matrix, window=w)
-
-                        if nodata is not None:
-                            mask_value = (
-                                    np.all(matrix != nodata, axis=0).astype(
-                                        np.uint8
-                                    )
-                                    * 255
-                            )
-                        elif alpha is not None:
-                            mask_value = src.read(alpha, window=w)
-                        else:
-                            mask_value = None
-                        if mask_value is not None:
-                            mem.write_mask(mask_value, window=w)
-
-                    if overview_resampling is not None:
-                        overviews = [2 ** j for j in range(1, overview_level + 1)]
-
-                        mem.build_overviews(overviews, Resampling[overview_resampling])
-                        mem.update_tags(
-                            OVR_RESAMPLING_ALG=Resampling[overview_resampling].name.upper()
-                        )
-
-                    copy(mem, dst_path, copy_src_overviews=True, **dst_kwargs)
-
-
-def cog_validate_old(ds, check_tiled=True):
-    """Check if a file is a (Geo)TIFF with cloud optimized compatible structure.
-
-    Args:
-      ds: GDAL Dataset for the file to inspect.
-      check_tiled: Set to False to ignore missing tiling.
-
-    Returns:
-      A tuple, whose first element is an array of error messages
-      (empty if there is no error), and the second element, a dictionary
-      with the structure of the GeoTIFF file.
-
-    Raises:
-      ValidateCloudOptimizedGeoTIFFException: Unable to open the file or the
-        file is not a Tiff.
-    """
-
-    if int(gdal.VersionInfo('VERSION_NUM')) < 2020000:
-        raise ValidateCloudOptimizedGeoTIFFException(
-            'GDAL 2.2 or above required')
-
-    unicode_type = type(''.encode('utf-8').decode('utf-8'))
-    if isinstance(ds, str) or isinstance(ds, unicode_type):
-        gdal.PushErrorHandler()
-        ds = gdal.Open(ds)
-        gdal.PopErrorHandler()
-        if ds is None:
-            raise ValidateCloudOptimizedGeoTIFFException(
-                'Invalid file : %s' % gdal.GetLastErrorMsg())
-        if ds.GetDriver().ShortName != 'GTiff':
-            raise ValidateCloudOptimizedGeoTIFFException(
-                'The file is not a GeoTIFF')
+                if overview_resampling is not None:
+                    overviews = [2 ** j for j in range(1, overview_level + 1)]
 
-    details = {}
-    errors = []
-    filename = ds.GetDescription()
-    main_band = ds.GetRasterBand(1)
-    ovr_count = main_band.GetOverviewCount()
-    filelist = ds.GetFileList()
-    if filelist is not None and filename + '.ovr' in filelist:
-        errors += [
-            'Overviews found in external .ovr file. They should be internal']
-
-    if main_band.XSize >= 512 or main_band.YSize >= 512:
-        if check_tiled:
-            block_size = main_band.GetBlockSize()
-            if block_size[0] == main_band.XSize and block_size[0] > 1024:
-                errors += [
-                    'The file is greater than 512xH or Wx512, but is not tiled']
-
-        if ovr_count == 0:
-            errors += [
-                'The file is greater than 512xH or Wx512, but has no overviews']
-
-    ifd_offset = int(main_band.GetMetadataItem('IFD_OFFSET', 'TIFF'))
-    ifd_offsets = [ifd_offset]
-    if ifd_offset not in (8, 16):
-        errors += [
-            'The offset of the main IFD should be 8 for ClassicTIFF '
-            'or 16 for BigTIFF. It is %d instead' % ifd_offsets[0]]
-    details['ifd_offsets'] = {}
-    details['ifd_offsets']['main'] = ifd_offset
-
-    for i in range(ovr_count):
-        # Check that overviews are by descending sizes
-        ovr_band = ds.GetRasterBand(1).GetOverview(i)
-        if i == 0:
-            if (ovr_band.XSize > main_band.XSize or
-                    ovr_band.YSize > main_band.YSize):
-                errors += [
-                    'First overview has larger dimension than main band']
-        else:
-            prev_ovr_band = ds.GetRasterBand(1).GetOverview(i - 1)
-            if (ovr_band.XSize > prev_ovr_band.XSize or
-                    ovr_band.YSize > prev_ovr_band.YSize):
-                errors += [
-                    'Overview of index %d has larger dimension than '
-                    'overview of index %d' % (i, i - 1)]
-
-        if check_tiled:
-            block_size = ovr_band.GetBlockSize()
-            if block_size[0] == ovr_band.XSize and block_size[0] > 1024:
-                errors += [
-                    'Overview of index %d is not tiled' % i]
-
-        # Check that the IFD of descending overviews are sorted by increasing offsets
-        ifd_offset = int(ovr_band.GetMetadataItem('IFD_OFFSET', 'TIFF'))
-        ifd_offsets.append(ifd_offset)
-        details['ifd_offsets']['overview_%d' % i] = ifd_offset
-        if ifd_offsets[-1] < ifd_offsets[-2]:
-            if i == 0:
-                errors += [
-                    'The offset of the IFD for overview of index %d is %d, '
-                    'whereas it should be greater than the one of the main '
-                    'image, which is at byte %d' %
-                    (i, ifd_offsets[-1], ifd_offsets[-2])]
-            else:
-                errors += [
-                    'The offset of the IFD for overview of index %d is %d, '
-                    'whereas it should be greater than the one of index %d, '
-                    'which is at byte %d' %
-                    (i, ifd_offsets[-1], i - 1, ifd_offsets[-2])]
-
-    # Check that the imagery starts by the smallest overview and ends with the main resolution dataset
-    block_offset = main_band.GetMetadataItem('BLOCK_OFFSET_0_0', 'TIFF')
-    if not block_offset:
-        errors += ['Missing BLOCK_OFFSET_0_0']
-    data_offset = int(block_offset) if block_offset else None
-    data_offsets = [data_offset]
-    details['data_offsets'] = {}
-    details['data_offsets']['main'] = data_offset
-    for i in range(ovr_count):
-        ovr_band = ds.GetRasterBand(1).GetOverview(i)
-        data_offset = int(ovr_band.GetMetadataItem('BLOCK_OFFSET_0_0', 'TIFF'))
-        data_offsets.append(data_offset)
-        details['data_offsets']['overview_%d' % i] = data_offset
+                    mem.build_overviews(overviews, Resampling[overview_resampling])
+                    mem.update_tags(
+                        OVR_RESAMPLING_ALG=Resampling[overview_resampling].name.upper()
+                    )
+
+                # flushed, for GDAL to copy from
+                mem.close()
+                cog = _copy_cog(mem.name, dst_path, dst_kwargs, threads)
+                try:
+                    check_cog(dst_path, cog)
+                finally:
+                    cog = None
 
-    if data_offsets[-1] < ifd_offsets[-1]:
-        if ovr_count > 0:
-            errors += [
-                'The offset of the first block of the smallest overview '
-                'should be after its IFD']
-        else:
-            errors += [
-                'The offset of the first block of the image should '
-                'be after its IFD']
-    for i in range(len(data_offsets) - 2, 0, -1):
-        if data_offsets[i] < data_offsets[i + 1]:
-            errors += [
-                'The offset of the first block of overview of index %d should '
-                'be after the one of the overview of index %d' %
-                (i - 1, i)]
-    if len(data_offsets) >= 2 and data_offsets[0] < data_offsets[1]:
-        errors += [
-            'The offset of the first block of the main resolution image'
-            'should be after the one of the overview of index %d' %
-            (ovr_count - 1)]
 
-    return errors, details
+class InvalidCOGError(Exception):
+    """A COG failed the structural checks made after writing it."""
 
 
-def cog_validate(src_path):
+def _gdal_option(value):
+    return ("YES" if value else "NO") if isinstance(value, bool) else str(value)
+
+
+def _copy_cog(src_path, dst_path, dst_kwargs, threads):
     """
-    Validate Cloud Optimized Geotiff.
-    Parameters
-    ----------
-    src_path : str or PathLike object
-        A dataset path or URL. Will be opened in "r" mode.
-    This script is the rasterio equivalent of
-    https://svn.osgeo.org/gdal/trunk/gdal/swig/python/samples/validate_cloud_optimized_geotiff.py
+    Copy the tiled GTiff at src_path, with its overviews, to dst_path laid
+    out as a COG. Returns the GDAL dataset the copy leaves open on dst_path.
+    """
+    options = dict(dst_kwargs, copy_src_overviews=True, num_threads=threads)
+    driver = gdal.GetDriverByName(options.pop("driver", "GTiff"))
+    cog = driver.CreateCopy(dst_path, gdal.Open(src_path),
+                            options=[f"{k.upper()}={_gdal_option(v)}" for k, v in options.items()])
+    if cog is None:
+        raise IOError(f"Could not write {dst_path}: {gdal.GetLastErrorMsg()}")
+    return cog
+
+
+def check_cog(path, cog):
+    """
+    Check the structure of the COG just written to 'path' (see cog_structure),
+    on the dataset 'cog' its copy left open, and record it in the run report.
+    """
+    errors, warnings, _ = cog_structure(cog)
+    for warning in warnings:
+        logging.warning(f"{path}: {warning}")
+    report = run_report.current()
+    if report is not None:
+        report.add_cog(os.path.basename(path), errors, warnings)
+    if errors:
+        raise InvalidCOGError(f"{path} is not a valid COG: {'; '.join(errors)}")
+
+
+# bytes of source cog_translate reads at a time
+STRIP_BYTES = 64 * 1024 ** 2
+
+
+def _strip_windows(dst):
+    """Full-width windows of whole block rows of 'dst', about STRIP_BYTES each."""
+    block_rows = dst.block_shapes[0][0]
+    row_bytes = dst.width * dst.count * np.dtype(dst.dtypes[0]).itemsize
+    rows = block_rows * max(1, STRIP_BYTES // (row_bytes * block_rows))
+    for row_off in range(0, dst.height, rows):
+        yield Window(0, row_off, dst.width, min(rows, dst.height - row_off))
+
+
+def cog_structure(src):
+    """
+    Check the structure of a (Cloud Optimized) GeoTIFF from its header alone:
+    IFD ordering, tiling, overviews and an internal mask. No pixel data is read.
+
+    'src' is a path, or an open GDAL dataset such as the one cog_translate's
+    copy leaves open, which is checked without opening the file again.
+
+    Returns (errors, warnings, details).
     """
     errors = []
     warnings = []
@@ -766,140 +1198,138 @@ def cog_validate(src_path):
     if not GDALVersion.runtime().at_least("2.2"):
         raise Exception("GDAL 2.2 or above required")
 
-    config = dict(GDAL_DISABLE_READDIR_ON_OPEN="FALSE")
-    with rasterio.Env(**config):
-        with rasterio.open(src_path) as src:
-            if not src.driver == "GTiff":
-                raise Exception("The file is not a GeoTIFF")
+    # list the files beside it, to find an external .ovr or .msk
+    with rasterio.Env(GDAL_DISABLE_READDIR_ON_OPEN="FALSE"):
+        ds = src if isinstance(src, gdal.Dataset) else gdal.OpenEx(str(src), gdal.OF_RASTER)
+        if ds is None:
+            raise Exception(f"Could not open {src}")
+        if ds.GetDriver().ShortName != "GTiff":
+            raise Exception("The file is not a GeoTIFF")
+        filelist = [os.path.basename(f) for f in ds.GetFileList() or []]
+
+    src_bname = os.path.basename(ds.GetDescription())
+    if len(filelist) > 1 and src_bname + ".ovr" in filelist:
+        errors.append(
+            "Overviews found in external .ovr file. They should be internal"
+        )
+    if len(filelist) > 1 and src_bname + ".msk" in filelist:
+        errors.append(
+            "Mask found in external .msk file. It should be internal"
+        )
 
-            filelist = [os.path.basename(f) for f in src.files]
-            src_bname = os.path.basename(src_path)
-            if len(filelist) > 1 and src_bname + ".ovr" in filelist:
-                errors.append(
-                    "Overviews found in external .ovr file. They should be internal"
-                )
+    main_band = ds.GetRasterBand(1)
+    mask_flags = main_band.GetMaskFlags()
+    details["mask"] = [name for name, flag in (("all_valid", gdal.GMF_ALL_VALID), ("per_dataset", gdal.GMF_PER_DATASET),
+                                               ("alpha", gdal.GMF_ALPHA), ("nodata", gdal.GMF_NODATA))
+                       if mask_flags & flag]
+
+    ovr_bands = [main_band.GetOverview(ix) for ix in range(main_band.GetOverviewCount())]
+    overviews = [int(round(ds.RasterXSize / ovr.XSize)) for ovr in ovr_bands]
+    if ds.RasterXSize > 512 or ds.RasterYSize > 512:
+        if _untiled(main_band):
+            errors.append(
+                "The file is greater than 512xH or 512xW, but is not tiled"
+            )
+
+        if not overviews:
+            warnings.append(
+                "The file is greater than 512xH or 512xW, it is recommended "
+                "to include internal overviews"
+            )
+
+    ifd_offset = int(main_band.GetMetadataItem("IFD_OFFSET", "TIFF"))
+    ifd_offsets = [ifd_offset]
+    if ifd_offset not in (8, 16):
+        errors.append(
+            "The offset of the main IFD should be 8 for ClassicTIFF "
+            "or 16 for BigTIFF. It is {} instead".format(ifd_offset)
+        )
 
-            overviews = src.overviews(1)
-            if src.width > 512 or src.height > 512:
-                if not src.is_tiled:
-                    errors.append(
-                        "The file is greater than 512xH or 512xW, but is not tiled"
-                    )
+    details["ifd_offsets"] = {}
+    details["ifd_offsets"]["main"] = ifd_offset
 
-                if not overviews:
-                    warnings.append(
-                        "The file is greater than 512xH or 512xW, it is recommended "
-                        "to include internal overviews"
-                    )
+    if overviews and overviews != sorted(overviews):
+        errors.append("Overviews should be sorted")
 
-            ifd_offset = int(src.get_tag_item("IFD_OFFSET", "TIFF", bidx=1))
-            ifd_offsets = [ifd_offset]
-            if ifd_offset not in (8, 16):
-                errors.append(
-                    "The offset of the main IFD should be 8 for ClassicTIFF "
-                    "or 16 for BigTIFF. It is {} instead".format(ifd_offset)
-                )
-
-            details["ifd_offsets"] = {}
-            details["ifd_offsets"]["main"] = ifd_offset
+    for ix, (dec, ovr) in enumerate(zip(overviews, ovr_bands)):
 
-            if overviews and overviews != sorted(overviews):
-                errors.append("Overviews should be sorted")
+        # We just need to make sure the decimation level is > 1
+        if not dec > 1:
+            errors.append(
+                "Invalid Decimation {} for overview level {}".format(dec, ix)
+            )
 
-            for ix, dec in enumerate(overviews):
+        # Check that the IFD of descending overviews are sorted by increasing
+        # offsets
+        ifd_offset = int(ovr.GetMetadataItem("IFD_OFFSET", "TIFF"))
+        ifd_offsets.append(ifd_offset)
 
-                # NOTE: Size check is handled in rasterio `src.overviews` methods
-                # https://github.com/mapbox/rasterio/blob/4ebdaa08cdcc65b141ed3fe95cf8bbdd9117bc0b/rasterio/_base.pyx
-                # We just need to make sure the decimation level is > 1
-                if not dec > 1:
-                    errors.append(
-                        "Invalid Decimation {} for overview level {}".format(dec, ix)
+        details["ifd_offsets"]["overview_{}".format(ix)] = ifd_offset
+        if ifd_offsets[-1] < ifd_offsets[-2]:
+            if ix == 0:
+                errors.append(
+                    "The offset of the IFD for overview of index {} is {}, "
+                    "whereas it should be greater than the one of the main "
+                    "image, which is at byte {}".format(
+                        ix, ifd_offsets[-1], ifd_offsets[-2]
                     )
-
-                # Check that the IFD of descending overviews are sorted by increasing
-                # offsets
-                ifd_offset = int(src.get_tag_item("IFD_OFFSET", "TIFF", bidx=1, ovr=ix))
-                ifd_offsets.append(ifd_offset)
-
-                details["ifd_offsets"]["overview_{}".format(ix)] = ifd_offset
-                if ifd_offsets[-1] < ifd_offsets[-2]:
-                    if ix == 0:
-                        errors.append(
-                            "The offset of the IFD for overview of index {} is {}, "
-                            "whereas it should be greater than the one of the main "
-                            "image, which is at byte {}".format(
-                                ix, ifd_offsets[-1], ifd_offsets[-2]
-                            )
-                        )
-                    else:
-                        errors.append(
-                            "The offset of the IFD for overview of index {} is {}, "
-                            "whereas it should be greater than the one of index {}, "
-                            "which is at byte {}".format(
-                                ix, ifd_offsets[-1], ix - 1, ifd_offsets[-2]
-                            )
-                        )
-
-            block_offset = int(src.get_tag_item("BLOCK_OFFSET_0_0", "TIFF", bidx=1))
-            if not block_offset:
-                errors.append("Missing BLOCK_OFFSET_0_0")
-
-            data_offset = int(block_offset) if block_offset else None
-            data_offsets = [data_offset]
-            details["data_offsets"] = {}
-            details["data_offsets"]["main"] = data_offset
-
-            for ix, dec in enumerate(overviews):
-                data_offset = int(
-                    src.get_tag_item("BLOCK_OFFSET_0_0", "TIFF", bidx=1, ovr=ix)
                 )
-                data_offsets.append(data_offset)
-                details["data_offsets"]["overview_{}".format(ix)] = data_offset
-
-            if data_offsets[-1] < ifd_offsets[-1]:
-                if len(overviews) > 0:
-                    errors.append(
-                        "The offset of the first block of the smallest overview "
-                        "should be after its IFD"
-                    )
-                else:
-                    errors.append(
-                        "The offset of the first block of the image should "
-                        "be after its IFD"
-                    )
-
-            for i in range(len(data_offsets) - 2, 0, -1):
-                if data_offsets[i] < data_offsets[i + 1]:
-                    errors.append(
-                        "The offset of the first block of overview of index {} should "
-                        "be after the one of the overview of index {}".format(i - 1, i)
-                    )
-
-            if len(data_offsets) >= 2 and data_offsets[0] < data_offsets[1]:
+            else:
                 errors.append(
-                    "The offset of the first block of the main resolution image "
-                    "should be after the one of the overview of index {}".format(
-                        len(overviews) - 1
+                    "The offset of the IFD for overview of index {} is {}, "
+                    "whereas it should be greater than the one of index {}, "
+                    "which is at byte {}".format(
+                        ix, ifd_offsets[-1], ix - 1, ifd_offsets[-2]
                     )
                 )
 
-        for ix, dec in enumerate(overviews):
-            with rasterio.open(src_path, OVERVIEW_LEVEL=ix) as ovr_dst:
-                if ovr_dst.width >= 512 or ovr_dst.height >= 512:
-                    if not ovr_dst.is_tiled:
-                        errors.append("Overview of index {} is not tiled".format(ix))
+        if _untiled(ovr):
+            errors.append("Overview of index {} is not tiled".format(ix))
 
-    if warnings:
-        click.secho("The following warnings were found:", fg="yellow", err=True)
-        for w in warnings:
-            click.echo("- " + w, err=True)
-        click.echo(err=True)
+    block_offset = int(main_band.GetMetadataItem("BLOCK_OFFSET_0_0", "TIFF") or 0)
+    if not block_offset:
+        errors.append("Missing BLOCK_OFFSET_0_0")
 
-    if errors:
-        click.secho("The following errors were found:", fg="red", err=True)
-        for e in errors:
-            click.echo("- " + e, err=True)
+    data_offset = block_offset or None
+    data_offsets = [data_offset]
+    details["data_offsets"] = {}
+    details["data_offsets"]["main"] = data_offset
+
+    for ix, ovr in enumerate(ovr_bands):
+        data_offset = int(ovr.GetMetadataItem("BLOCK_OFFSET_0_0", "TIFF") or 0)
+        data_offsets.append(data_offset)
+        details["data_offsets"]["overview_{}".format(ix)] = data_offset
+
+    if (data_offsets[-1] or 0) < ifd_offsets[-1]:
+        if len(overviews) > 0:
+            errors.append(
+                "The offset of the first block of the smallest overview "
+                "should be after its IFD"
+            )
+        else:
+            errors.append(
+                "The offset of the first block of the image should "
+                "be after its IFD"
+            )
+
+    for i in range(len(data_offsets) - 2, 0, -1):
+        if data_offsets[i] < data_offsets[i + 1]:
+            errors.append(
+                "The offset of the first block of overview of index {} should "
+                "be after the one of the overview of index {}".format(i - 1, i)
+            )
+
+    if len(data_offsets) >= 2 and (data_offsets[0] or 0) < data_offsets[1]:
+        errors.append(
+            "The offset of the first block of the main resolution image "
+            "should be after the one of the overview of index {}".format(
+                len(overviews) - 1
+            )
+        )
+
+    return errors, warnings, details
 
-        return False
 
-    return True
+def _untiled(band):
+    """Whether a band wider than 512 is stored in strips (blocks of whole rows)."""
+    return band.XSize > 512 and band.GetBlockSize()[0] == band.XSize
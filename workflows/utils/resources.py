@@ -0,0 +1,142 @@
+"""
+Size work to what the pod was given rather than what the node has.
+
+os.cpu_count() and /proc/meminfo report the whole node inside a container, so
+these helpers read the cgroup (v2 first, then v1) limits where they exist.
+"""
+
+import contextlib
+import logging
+import os
+import shutil
+import threading
+
+gb = 1024 ** 3
+
+_local = threading.local()
+
+
+def _read_first_line(path):
+    try:
+        with open(path) as f:
+            return f.readline().strip()
+    except OSError:
+        return None
+
+
+def cpu_count():
+    """Number of CPUs this process may use, honouring the cgroup CPU quota."""
+    if hasattr(os, 'sched_getaffinity'):
+        cpus = len(os.sched_getaffinity(0))
+    else:
+        cpus = os.cpu_count() or 1
+
+    quota = None
+    cpu_max = _read_first_line('/sys/fs/cgroup/cpu.max')  # cgroup v2: "<quota|max> <period>"
+    if cpu_max:
+        limit, period = cpu_max.split()
+        if limit != 'max':
+            quota = int(limit) / int(period)
+    else:
+        limit = _read_first_line('/sys/fs/cgroup/cpu/cpu.cfs_quota_us')
+        period = _read_first_line('/sys/fs/cgroup/cpu/cpu.cfs_period_us')
+        if limit and period and int(limit) > 0:
+            quota = int(limit) / int(period)
+
+    if quota is not None:
+        cpus = min(cpus, max(1, int(quota)))
+
+    return cpus
+
+
+@contextlib.contextmanager
+def scene_cpus(cpus):
+    """
+    Give the scene this thread runs 'cpus' CPUs for the duration of the block,
+    when a worker runs other scenes beside it (see bands.band_cpus).
+    """
+    previous = getattr(_local, 'cpus', None)
+    _local.cpus = cpus
+    try:
+        yield
+    finally:
+        _local.cpus = previous
+
+
+def scene_cpu_budget():
+    """CPUs given to the scene this thread runs (see scene_cpus), or None."""
+    return getattr(_local, 'cpus', None)
+
+
+def _meminfo():
+    info = {}
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                key, value = line.split(':', 1)
+                info[key] = int(value.split()[0]) * 1024
+    except OSError:
+        pass
+    return info
+
+
+def _cgroup_memory():
+    """Return (limit, usage) in bytes from the cgroup, or (None, None)."""
+    limit = _read_first_line('/sys/fs/cgroup/memory.max')
+    if limit is not None:
+        usage = _read_first_line('/sys/fs/cgroup/memory.current')
+    else:
+        limit = _read_first_line('/sys/fs/cgroup/memory/memory.limit_in_bytes')
+        usage = _read_first_line('/sys/fs/cgroup/memory/memory.usage_in_bytes')
+
+    if limit is None or limit == 'max':
+        return None, None
+    limit = int(limit)
+    # cgroup v1 reports "unlimited" as a huge page-aligned number
+    if limit >= 2 ** 60:
+        return None, None
+    return limit, int(usage) if usage else 0
+
+
+def memory_limit():
+    """Memory in bytes this process may use (cgroup limit, else total RAM)."""
+    limit, _ = _cgroup_memory()
+    if limit is not None:
+        return limit
+    return _meminfo().get('MemTotal', 0)
+
+
+def memory_available():
+    """Memory in bytes that can still be allocated before hitting the limit."""
+    limit, usage = _cgroup_memory()
+    if limit is not None:
+        return max(limit - usage, 0)
+    return _meminfo().get('MemAvailable', 0)
+
+
+def disk_free(path):
+    """Free bytes on the filesystem holding path (or its nearest existing parent)."""
+    path = os.path.abspath(path)
+    while not os.path.exists(path):
+        parent = os.path.dirname(path)
+        if parent == path:
+            break
+        path = parent
+    try:
+        return shutil.disk_usage(path).free
+    except OSError:
+        logging.warning(f"Could not stat free disk space for {path}")
+        return 0
+
+
+def dir_size(path):
+    """Bytes used by the files under path."""
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                # removed while we were walking
+                pass
+    return total
@@ -0,0 +1,228 @@
+"""
+Per-scene run reports.
+
+Every prepare function uploads a run-report.json next to the scene's
+datacube-metadata.yaml with where the time went: wall and CPU seconds per
+stage, peak memory, bytes moved, the GDAL block cache, tool versions,
+input sizes, the value stats of the bands scaled on the way and the outcome
+of each COG's structural check. workflows/report_summary.py turns a bucket prefix of them into
+throughput and percentile tables.
+
+A report is "current" for the thread running the scene, so timed_stage() and
+the download/upload helpers in prep_utils fill it in without being handed it:
+
+    report = start_report("landsat")
+    ...
+    with timed_stage("scale_cog"):
+        scale_cog_landsat_l2(untar_dir, cog_dir)
+
+In the worker's pipeline mode a scene moves between threads, so it carries
+its report in its context and the pipeline makes it current around each
+stage (see activate()).
+"""
+
+import contextlib
+import glob
+import json
+import logging
+import os
+import platform
+import re
+import resource
+import threading
+import time
+from datetime import datetime
+
+from . import resources
+
+REPORT_NAME = 'run-report.json'
+
+# bumped when fields change meaning, so report_summary can tell old reports apart
+REPORT_VERSION = 1
+
+_local = threading.local()
+
+
+def current():
+    """The report of the scene this thread is working on, or None."""
+    return getattr(_local, 'report', None)
+
+
+def start_report(sensor, scene=None):
+    """Start a report and make it current for this thread."""
+    report = RunReport(sensor, scene)
+    _local.report = report
+    return report
+
+
+@contextlib.contextmanager
+def activate(report):
+    """Make 'report' (which may be None) current for the duration of the block."""
+    previous = current()
+    _local.report = report
+    try:
+        yield report
+    finally:
+        _local.report = previous
+
+
+def _cpu_seconds():
+    """User + system CPU of this process and the children (SNAP, sen2cor) it has waited for."""
+    t = os.times()
+    return t.user + t.system + t.children_user + t.children_system
+
+
+def _gdal_cache_used():
+    try:
+        from osgeo import gdal
+        return gdal.GetCacheUsed()
+    except ImportError:
+        return None
+
+
+def gdal_versions():
+    versions = {}
+    try:
+        from osgeo import gdal
+        versions['gdal'] = gdal.VersionInfo('RELEASE_NAME')
+    except ImportError:
+        pass
+    try:
+        import rasterio
+        versions['rasterio'] = rasterio.__version__
+    except ImportError:
+        pass
+    return versions
+
+
+def snap_version(snap_home=None):
+    """SNAP release from its install's VERSION.txt, or None if SNAP isn't installed here."""
+    snap_home = snap_home or os.getenv('SNAP_HOME', '/usr/local/snap')
+    try:
+        with open(os.path.join(snap_home, 'VERSION.txt')) as f:
+            match = re.search(r'\d+\.\d+(\.\d+)?', f.read())
+    except OSError:
+        return None
+    return match.group(0) if match else None
+
+
+def sen2cor_version(sen2cor):
+    """Version from the sen2cor install path, e.g. ~/Sen2Cor-02.08.00-Linux64/bin/L2A_Process -> 02.08.00."""
+    match = re.search(r'Sen2Cor-(\d+\.\d+\.\d+)', sen2cor)
+    return match.group(1) if match else None
+
+
+class RunReport(object):
+    """
+    Timings and sizes for one scene.
+
+    Stage CPU time is the whole process's (plus finished children's): exact in
+    the worker's process mode, where a scene has the process to itself, but
+    shared between the scenes in flight in pipeline mode.
+    """
+
+    def __init__(self, sensor, scene=None):
+        self.sensor = sensor
+        self.scene = scene
+        self.started = datetime.utcnow()
+        self.stages = {}
+        self.bytes = {'downloaded': 0, 'uploaded': 0}
+        self.inputs = {}
+        self.band_stats = {}
+        self.cogs = {}
+        self.tools = gdal_versions()
+        self._start = time.monotonic()
+        self._cpu_start = _cpu_seconds()
+        self._gdal_cache_peak = 0
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Add the wall and CPU time of the block to stage 'name' (stages can run more than once)."""
+        wall, cpu = time.monotonic(), _cpu_seconds()
+        try:
+            yield
+        finally:
+            wall, cpu = time.monotonic() - wall, _cpu_seconds() - cpu
+            with self._lock:
+                totals = self.stages.setdefault(name, {'wall_seconds': 0.0, 'cpu_seconds': 0.0, 'runs': 0})
+                totals['wall_seconds'] += wall
+                totals['cpu_seconds'] += cpu
+                totals['runs'] += 1
+            self._sample_gdal_cache()
+
+    def _sample_gdal_cache(self):
+        used = _gdal_cache_used()
+        if used is not None and used > self._gdal_cache_peak:
+            self._gdal_cache_peak = used
+
+    def add_bytes(self, direction, n):
+        with self._lock:
+            self.bytes[direction] = self.bytes.get(direction, 0) + n
+
+    def add_input(self, path, name=None):
+        """Record the size of an input file or directory (e.g. the downloaded tarball or .SAFE)."""
+        if not os.path.exists(path):
+            logging.debug(f'No input at {path} to size')
+            return
+        size = resources.dir_size(path) if os.path.isdir(path) else os.path.getsize(path)
+        self.inputs[name or os.path.basename(path.rstrip('/'))] = size
+
+    def add_inputs(self, pattern):
+        for path in glob.glob(pattern):
+            self.add_input(path)
+
+    def add_band_stats(self, band, stats):
+        """Value stats of an output band, gathered while it was scaled (see scaling.WindowStats)."""
+        with self._lock:
+            self.band_stats[band] = stats
+
+    def add_cog(self, name, errors, warnings):
+        """Outcome of the structural check of an output COG (see prep_utils.check_cog)."""
+        with self._lock:
+            self.cogs[name] = {'valid': not errors, 'errors': list(errors), 'warnings': list(warnings)}
+
+    def invalid_cogs(self, paths):
+        """Those of 'paths' whose COG failed its check."""
+        return [p for p in paths if not self.cogs.get(os.path.basename(p), {}).get('valid', True)]
+
+    def tool(self, name, version):
+        if version:
+            self.tools[name] = version
+
+    def to_dict(self):
+        own = resource.getrusage(resource.RUSAGE_SELF)
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        try:
+            from osgeo import gdal
+            cache_max = gdal.GetCacheMax()
+        except ImportError:
+            cache_max = None
+        return {
+            'report_version': REPORT_VERSION,
+            'sensor': self.sensor,
+            'scene': self.scene,
+            'host': platform.node(),
+            'started': self.started.isoformat() + 'Z',
+            'finished': datetime.utcnow().isoformat() + 'Z',
+            'wall_seconds': time.monotonic() - self._start,
+            'cpu_seconds': _cpu_seconds() - self._cpu_start,
+            'stages': self.stages,
+            # ru_maxrss is in KiB on Linux
+            'peak_rss_bytes': own.ru_maxrss * 1024,
+            'peak_child_rss_bytes': children.ru_maxrss * 1024,
+            'bytes': self.bytes,
+            'inputs': self.inputs,
+            'band_stats': self.band_stats,
+            'cogs': self.cogs,
+            'gdal_cache': {'max_bytes': cache_max, 'peak_used_bytes': self._gdal_cache_peak},
+            'tools': self.tools,
+        }
+
+    def write(self, scene_dir):
+        """Write run-report.json into scene_dir and return its path."""
+        path = os.path.join(scene_dir, REPORT_NAME)
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
+        logging.debug(f'Wrote run report {path}')
+        return path
@@ -199,7 +199,8 @@ class Raw2Ard:
 
                     # executing PT1 processing for subset
                     logging.info( f'PROCESSING PT1 {hemisphere} SUBSET: {subset_name}' )
-                    out, err, code = utility.execute( self._gpt, [ cfg_pathname ] ) # status code of 0 => successful run
+                    with timed_stage('snap_pt1'):
+                        out, err, code = utility.execute( self._gpt, [ cfg_pathname ] ) # status code of 0 => successful run
                     
                     logging.info('----------------------------------------------')
                     err_str = err.decode("utf-8")
@@ -0,0 +1,197 @@
+"""
+List S3 prefixes quickly.
+
+list_objects_v2 returns at most 1,000 keys a call, and paginating one prefix
+is one request after another, so listing a tree like common_sensing/ takes
+minutes. list_objects() splits the prefix into its sub-prefixes ("folders",
+by delimiter) and lists those shards concurrently, each one paginated,
+yielding objects as pages arrive:
+
+    for obj in list_objects(client, "public-eo-data", "common_sensing/sentinel_2/"):
+        print(obj["Key"], obj["Size"], obj["ETag"], obj["LastModified"])
+
+Objects come back in S3's order within a shard but shards interleave, so
+callers that need an order sort the keys themselves.
+
+Given a ListingCache, a complete recursive listing is kept for its TTL (see
+S3_LIST_CACHE_SECONDS) and dropped early when we write under the prefix
+ourselves (invalidate()). Before it is served it is checked against the
+level directly under the prefix, which list_objects lists first anyway:
+the same sub-prefixes, and the same objects with the same ETag and
+LastModified. A new scene dir, or a file rewritten in a scene dir's own
+listing, is seen at once; a change deeper down only once the TTL runs out.
+
+Only boto3 is needed here, so the indexer script can use it without the
+GDAL stack that prep_utils imports.
+"""
+
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+_DONE = object()
+
+# what an object in a listing keeps
+FIELDS = ("Key", "Size", "ETag", "LastModified")
+
+
+def list_threads():
+    """Shards listed at once, unless told: S3_LIST_THREADS."""
+    return int(os.getenv("S3_LIST_THREADS") or 16)
+
+
+class ListingCache(object):
+    """
+    Complete listings by (bucket, prefix), each kept for 'ttl' seconds.
+
+    An entry is stored with the marker (see level_marker) of its prefix's
+    top level, and only served while the caller's fresh marker matches it.
+    S3 has no ETag or LastModified for a whole prefix, so changes below the
+    top level are missed until the entry expires, unless this process made
+    them (invalidate()).
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, bucket, prefix, marker):
+        with self._lock:
+            entry = self._entries.get((bucket, prefix))
+            if entry is None:
+                return None
+            expires, cached_marker, objects = entry
+            if time.monotonic() >= expires or cached_marker != marker:
+                del self._entries[(bucket, prefix)]
+                return None
+            return objects
+
+    def put(self, bucket, prefix, objects, marker):
+        if self.ttl <= 0:
+            return
+        with self._lock:
+            self._entries[(bucket, prefix)] = (time.monotonic() + self.ttl, marker, list(objects))
+
+    def invalidate(self, bucket, key):
+        """Drop every listing that 'key' (just written or deleted) could be in."""
+        with self._lock:
+            for entry in [e for e in self._entries if e[0] == bucket and key.startswith(e[1])]:
+                del self._entries[entry]
+
+
+def _objects(page):
+    return [{f: obj[f] for f in FIELDS if f in obj} for obj in page.get("Contents", [])]
+
+
+def level_marker(objects, prefixes):
+    """What a cached listing is checked against: a level's objects (with ETag and LastModified) and sub-prefixes."""
+    return (sorted((obj["Key"], obj.get("ETag"), obj.get("LastModified")) for obj in objects), sorted(prefixes))
+
+
+def _level(client, bucket, prefix, delimiter):
+    """(objects, sub-prefixes) directly under prefix."""
+    objects, prefixes = [], []
+    for page in client.get_paginator("list_objects_v2").paginate(Bucket=bucket, Prefix=prefix, Delimiter=delimiter):
+        objects.extend(_objects(page))
+        prefixes.extend(p["Prefix"] for p in page.get("CommonPrefixes", []))
+    return objects, prefixes
+
+
+def _put(results, item, stop):
+    # give up once the consumer has gone, rather than block on a full queue
+    while not stop.is_set():
+        try:
+            results.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _list_shard(client, bucket, prefix, results, stop):
+    try:
+        for page in client.get_paginator("list_objects_v2").paginate(Bucket=bucket, Prefix=prefix):
+            if not _put(results, _objects(page), stop):
+                return
+    except Exception as e:
+        _put(results, e, stop)
+    finally:
+        _put(results, _DONE, stop)
+
+
+def _list(client, bucket, prefix, delimiter, depth, recursive, threads, level=None):
+    objects, shards = level or _level(client, bucket, prefix, delimiter)
+    yield from objects
+    if not recursive:
+        return
+    # split further where a level has few sub-prefixes, e.g. common_sensing/ -> sensors -> scenes
+    for _ in range(depth - 1):
+        if len(shards) >= threads:
+            break
+        deeper = []
+        for shard in shards:
+            shard_objects, sub_shards = _level(client, bucket, shard, delimiter)
+            yield from shard_objects
+            deeper.extend(sub_shards)
+        shards = deeper
+    if not shards:
+        return
+
+    logging.debug(f"Listing {bucket}/{prefix} in {len(shards)} shards")
+    results = queue.Queue(maxsize=threads * 4)
+    stop = threading.Event()
+    pool = ThreadPoolExecutor(min(threads, len(shards)))
+    try:
+        for shard in shards:
+            pool.submit(_list_shard, client, bucket, shard, results, stop)
+        pending = len(shards)
+        while pending:
+            item = results.get()
+            if item is _DONE:
+                pending -= 1
+            elif isinstance(item, Exception):
+                raise item
+            else:
+                yield from item
+    finally:
+        stop.set()
+        pool.shutdown(wait=True)
+
+
+def list_objects(client, bucket, prefix, delimiter="/", depth=1, recursive=True, threads=None, cache=None):
+    """
+    Yield every object ({Key, Size, ETag, LastModified}) under bucket/prefix.
+
+    :param client: boto3 S3 client (clients are thread-safe, so the shards share it)
+    :param delimiter: what splits the prefix into shards
+    :param depth: levels of sub-prefixes to split into before listing shards concurrently
+    :param recursive: False for only the objects directly under prefix, as with Delimiter
+    :param threads: shards listed at once (default: list_threads())
+    :param cache: a ListingCache to answer from and fill (recursive listings only: one level
+        costs as much as the check of a cached one)
+    """
+    depth, threads = max(1, depth), threads or list_threads()
+    if cache is None or not recursive:
+        yield from _list(client, bucket, prefix, delimiter, depth, recursive, threads)
+        return
+
+    # the top level is listed first either way, and is what a cached listing is checked against
+    level = _level(client, bucket, prefix, delimiter)
+    marker = level_marker(*level)
+    cached = cache.get(bucket, prefix, marker)
+    if cached is not None:
+        logging.debug(f"Listing {bucket}/{prefix} from cache")
+        yield from cached
+        return
+
+    listed = []
+    for obj in _list(client, bucket, prefix, delimiter, depth, recursive, threads, level):
+        listed.append(obj)
+        yield obj
+
+    # only a listing that ran to the end is complete enough to answer from
+    cache.put(bucket, prefix, listed, marker)
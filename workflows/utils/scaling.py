@@ -0,0 +1,117 @@
+"""
+Lookup-table scaling of 16-bit bands.
+
+Every band we rescale (Landsat Collection 2 SR, ST and the ST auxiliaries,
+Sentinel-2 L2A BOA and AOT) comes as uint16, so value * scale + offset, with
+nodata kept as nodata, is a 65,536 entry table. Applying it is one np.take
+per block, where the arithmetic needs float64 temporaries and a mask pass
+over the whole band. The tables give the same float32 values as the
+arithmetic, as they are computed the same way.
+
+    cog_translate(in_path, out_path, profile, transform=scaler(0.0000275, -0.2, 0),
+                  dtype="float32", dst_nodata=0)
+
+Given a WindowStats, the scaler also gathers the band's min, max, mean and
+(with BAND_STATS_BINS set) histogram as it goes, so they cost no extra pass
+over the band; the prepare functions put them in the scene's run report.
+"""
+
+import functools
+import os
+
+import numpy as np
+
+LUT_SIZE = 2 ** 16
+
+
+@functools.lru_cache(maxsize=None)
+def lut(scale_factor=1.0, add_offset=0.0, nodata=None, dtype="float32", divisor=None):
+    """
+    Table of (value * scale_factor + add_offset) as dtype for every uint16
+    value, or (value / divisor + add_offset) if divisor is given, with nodata
+    mapping to itself. Read-only, as tables are shared between callers.
+    """
+    values = np.arange(LUT_SIZE, dtype=np.float64)
+    values = values / divisor if divisor else values * scale_factor
+    table = (values + add_offset).astype(dtype)
+    if nodata is not None and 0 <= nodata < LUT_SIZE:
+        table[int(nodata)] = nodata
+    table.flags.writeable = False
+    return table
+
+
+class WindowStats(object):
+    """
+    Running stats of a band's valid (not nodata) values, one window at a time.
+
+    :param histogram: (bins, low, high) to also count values into, or None
+    """
+
+    def __init__(self, histogram=None):
+        self.count = 0
+        self.nodata = 0
+        self.min = None
+        self.max = None
+        self.sum = 0.0
+        self.histogram = histogram
+        self.counts = np.zeros(histogram[0], dtype=np.int64) if histogram else None
+
+    def update(self, values, valid=None):
+        if valid is not None:
+            self.nodata += int(valid.size - np.count_nonzero(valid))
+            values = values[valid]
+        if values.size == 0:
+            return
+        self.count += int(values.size)
+        low, high = float(values.min()), float(values.max())
+        self.min = low if self.min is None else min(self.min, low)
+        self.max = high if self.max is None else max(self.max, high)
+        self.sum += float(values.sum(dtype=np.float64))
+        if self.counts is not None:
+            bins, range_low, range_high = self.histogram
+            self.counts += np.histogram(values, bins=bins, range=(range_low, range_high))[0]
+
+    def to_dict(self):
+        stats = {'count': self.count, 'nodata': self.nodata, 'min': self.min, 'max': self.max,
+                 'mean': self.sum / self.count if self.count else None}
+        if self.counts is not None:
+            stats['histogram'] = {'range': list(self.histogram[1:]), 'counts': self.counts.tolist()}
+        return stats
+
+
+def window_stats(scale_factor=1.0, add_offset=0.0, nodata=None, dtype="float32", divisor=None):
+    """
+    A WindowStats for a band scaled by scaler(...) with the same arguments,
+    with a BAND_STATS_BINS bin histogram over every value the scaling can
+    produce from uint16 input if that env var is set.
+    """
+    bins = int(os.getenv("BAND_STATS_BINS") or 0)
+    if not bins:
+        return WindowStats()
+    table = lut(scale_factor, add_offset, nodata, dtype, divisor)
+    if nodata is not None and 0 <= nodata < LUT_SIZE:
+        table = np.delete(table, int(nodata))
+    return WindowStats((bins, float(table.min()), float(table.max())))
+
+
+def scaler(scale_factor=1.0, add_offset=0.0, nodata=None, dtype="float32", divisor=None, stats=None):
+    """
+    Block transform (for cog_translate) applying lut(...) to uint16 blocks,
+    and falling back to the arithmetic for any other input type. Values
+    other than nodata are added to 'stats' (a WindowStats) if given.
+    """
+    table = lut(scale_factor, add_offset, nodata, dtype, divisor)
+
+    def rescale(block):
+        if block.dtype == np.uint16:
+            scaled = np.take(table, block)
+        else:
+            values = block / divisor if divisor else block * scale_factor
+            scaled = (values + add_offset).astype(dtype)
+            if nodata is not None:
+                scaled[block == nodata] = nodata
+        if stats is not None:
+            stats.update(scaled, None if nodata is None else block != nodata)
+        return scaled
+
+    return rescale
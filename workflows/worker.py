@@ -0,0 +1,496 @@
+#!/usr/bin/env python
+
+"""
+Shared job loop for the ARD workers.
+
+Each sensor's worker-*.py only names its queue and prepare function:
+
+    run_worker("jobLS", prepareLS, log_name="landsat_ard", scene_mem_gb=4)
+
+Jobs are leased from a RedisWQ and run in their own child process, up to
+"slots" scenes at a time. The number of slots is the smallest of the
+requested concurrency and what the pod's CPU, memory and intermediate disk
+budgets allow for one scene each. A scene that fails (its prepare function
+raises, or its child crashes or is OOM-killed) is not acked, so its lease
+expires and the scene is retried elsewhere, in either mode.
+The worker runs threads (lease heartbeats, the reaper, the metrics server),
+so the children are started by a forkserver rather than forked from it.
+
+Sensors whose prepare function is split into stages (download, process,
+upload) can instead run in pipeline mode (WORKER_MODE=pipeline), where scene
+N+1 downloads while scene N is processed and scene N-1 uploads; see
+workflows/pipeline.py.
+
+Per-stage latencies, scene times, queue wait, bytes moved and intermediate
+disk use are served for Prometheus on WORKER_METRICS_PORT (see
+workflows/metrics.py), along with the queue's depth and the replica count
+workflows/autoscale.py estimates from it.
+
+Short jobs can lease WORKER_PREFETCH jobs per redis round trip, held ready
+(their leases renewed) until a slot frees up, and ack WORKER_ACK_BATCH
+finished jobs at a time. Jobs still waiting to start when the worker stops
+go straight back to the queue.
+
+With WORKER_IDLE_EXIT_SECS set, a worker that finds no work for that long
+exits cleanly, for deployments scaled as jobs (e.g. a KEDA ScaledJob).
+
+Can also be run directly for any prepare function:
+
+    python -m workflows.worker --queue jobS2 --handler workflows.utils.prepS2:prepareS2 --concurrency 2
+"""
+
+import argparse
+import collections
+import datetime
+import importlib
+import json
+import logging
+import multiprocessing
+import os
+import queue as queue_
+import signal
+import time
+
+from workflows import autoscale, metrics
+from workflows.pipeline import ScenePipeline, Stage
+from workflows.rediswq import RedisWQ, LeaseHeartbeat
+from workflows.utils import resources
+
+logger = logging.getLogger("worker")
+
+gb = resources.gb
+
+# seconds between samples of the intermediate disk in use, and of the queue
+DISK_SAMPLE_SECS = 30
+QUEUE_SAMPLE_SECS = 60
+# longest a finished job waits for the rest of its ack batch
+ACK_FLUSH_SECS = 5
+
+# forking a process with other threads running can copy a lock some thread holds (see utils/bands.py)
+_scene_context = multiprocessing.get_context("forkserver")
+
+
+def _log_to_stdout():
+    level = os.getenv("LOGLEVEL", "INFO").upper()
+    logging.basicConfig(format="%(asctime)s %(levelname)-8s %(name)s %(message)s", datefmt="%Y-%m-%d %H:%M:%S",
+                        level=level)
+
+
+def setup_worker_logging(log_name):
+    """Log to stdout and to a per-run file in /tmp. Returns the file handler."""
+    log_file_path = f"/tmp/{log_name}_{datetime.datetime.now()}.log"
+    _log_to_stdout()
+    logging_file_handler = logging.FileHandler(log_file_path)
+    logging.getLogger().addHandler(logging_file_handler)
+    return logging_file_handler
+
+
+def _run_job(handler, payload, scene_cpus, metrics_settings):
+    """Child process entry point: decode one job and hand it to the prepare function."""
+    # a forkserver child inherits none of the worker's set-up
+    _log_to_stdout()
+    metrics.attach(*metrics_settings)
+    with resources.scene_cpus(scene_cpus):
+        handler(**json.loads(payload))
+
+
+def _with_scene_cpus(func, scene_cpus):
+    """'func' run with the scene's CPU budget, for pipeline stages (see resources.scene_cpus)."""
+    def run(ctx):
+        with resources.scene_cpus(scene_cpus):
+            return func(ctx)
+    return run
+
+
+class _Slot(object):
+    """A scene in flight: its child process, lease heartbeat and start time."""
+
+    def __init__(self, item, process, heartbeat):
+        self.item = item
+        self.process = process
+        self.heartbeat = heartbeat
+        self.start = datetime.datetime.now().replace(microsecond=0)
+
+
+class Worker(object):
+    """
+    Run a prepare function for every job on a redis queue, several scenes at once.
+
+    :param queue: redis list name, e.g. "jobLS"
+    :param handler: callable taking the job's JSON fields as keyword arguments
+    :param concurrency: upper bound on scenes in flight (None = as many as the budgets allow)
+    :param scene_cpus: CPUs one scene keeps busy
+    :param scene_mem_gb: peak memory of one scene
+    :param scene_disk_gb: peak intermediate disk of one scene
+    :param work_dir: where the prepare functions put their intermediate files
+    :param lease_secs: lease length, renewed by a heartbeat while a scene runs
+    :param poll_timeout: seconds to wait for work before logging that the queue is empty
+    :param stages: pipeline.Stage list; if given, scenes run through a ScenePipeline in this process
+    :param cleanup: called with each scene's context once it leaves the pipeline
+    :param lanes: (lane, weight) pairs to take jobs from, see RedisWQ
+    :param rate_limit: max leases per minute across every worker on the queue (0 = no cap)
+    :param metrics_port: port to serve Prometheus metrics on (None = don't)
+    :param idle_exit_secs: exit after finding no work for this long (0 = keep polling)
+    :param prefetch: jobs to lease per round trip, held ready until a slot is free
+    :param ack_batch: finished jobs to ack per round trip
+    """
+
+    def __init__(self, queue, handler, concurrency=None, scene_cpus=1, scene_mem_gb=4, scene_disk_gb=20,
+                 work_dir='/tmp/data/intermediate/', lease_secs=600, poll_timeout=60, host='localhost', port=6379,
+                 stages=None, cleanup=None, lanes=RedisWQ.DEFAULT_LANES, rate_limit=0, metrics_port=None,
+                 idle_exit_secs=0, prefetch=1, ack_batch=1):
+        self.queue = queue
+        self.lanes = lanes
+        self.rate_limit = rate_limit
+        self.handler = handler
+        # the scenes' band pools (utils/bands.py) share the CPUs between them
+        self.stages = stages and [Stage(s.name, _with_scene_cpus(s.func, scene_cpus), s.workers, s.buffer)
+                                  for s in stages]
+        self.cleanup = cleanup
+        self.concurrency = concurrency
+        self.scene_cpus = scene_cpus
+        self.scene_mem = scene_mem_gb * gb
+        self.scene_disk = scene_disk_gb * gb
+        self.work_dir = work_dir
+        self.lease_secs = lease_secs
+        self.poll_timeout = poll_timeout
+        self.host = host
+        self.port = port
+        self.metrics_port = metrics_port
+        self.idle_exit_secs = idle_exit_secs
+        self.prefetch = max(1, prefetch)
+        self.ack_batch = max(1, ack_batch)
+
+        self._running = []
+        self._stopping = False
+        self._disk_sampled = 0
+        self._queue_sampled = 0
+        self._idle_since = None
+        # leased jobs not started yet, with their heartbeats, and finished jobs not acked yet
+        self._ready = collections.deque()
+        self._acks = []
+        self._acks_since = 0
+
+    def slots(self):
+        """Number of scenes to run at once given the pod's CPU, memory and disk budgets."""
+        budgets = {
+            'cpu': resources.cpu_count() // self.scene_cpus,
+            'memory': resources.memory_limit() // self.scene_mem,
+            'disk': (resources.disk_free(self.work_dir) + self.scene_disk * len(self._running)) // self.scene_disk,
+        }
+        if self.concurrency:
+            budgets['concurrency'] = self.concurrency
+        slots = max(1, int(min(budgets.values())))
+        logger.debug(f"Scene slot budgets {budgets} -> {slots}")
+        return slots
+
+    def _has_headroom(self, busy):
+        """Whether one more scene fits in the memory and disk that is free right now."""
+        if not busy:
+            return True
+        return (resources.memory_available() >= self.scene_mem and
+                resources.disk_free(self.work_dir) >= self.scene_disk)
+
+    def _sample_disk(self):
+        """Record the intermediate disk in use, at most every DISK_SAMPLE_SECS."""
+        now = time.monotonic()
+        if now - self._disk_sampled < DISK_SAMPLE_SECS:
+            return
+        self._disk_sampled = now
+        metrics.tmp_disk_used(resources.dir_size(self.work_dir))
+
+    def _sample_queue(self, q):
+        """Publish the queue's stats and the replica estimate, at most every QUEUE_SAMPLE_SECS."""
+        now = time.monotonic()
+        if not self.metrics_port or now - self._queue_sampled < QUEUE_SAMPLE_SECS:
+            return
+        self._queue_sampled = now
+        try:
+            stats = q.stats()
+            metrics.queue_stats(stats, autoscale.desired_replicas(stats, **autoscale.estimator_settings()))
+        except Exception:
+            logger.exception("Could not sample queue stats")
+
+    def _idle(self, found_work):
+        """Track how long the worker has found nothing to do; stop it once that passes idle_exit_secs."""
+        if found_work:
+            self._idle_since = None
+            return
+        now = time.monotonic()
+        if self._idle_since is None:
+            self._idle_since = now
+        elif self.idle_exit_secs and now - self._idle_since >= self.idle_exit_secs:
+            logger.info(f"No work for {self.idle_exit_secs}s, draining")
+            self._stopping = True
+
+    def _lease(self, q, block):
+        """
+        Next leased item and its lease heartbeat, or (None, None). Leases up to
+        'prefetch' items in one round trip when nothing is ready.
+        """
+        if not self._ready:
+            items = q.lease_many(self.prefetch, self.lease_secs)
+            if not items and block:
+                item = q.lease(lease_secs=self.lease_secs, block=True, timeout=self.poll_timeout)
+                items = [item] if item is not None else []
+            self._ready.extend((item, LeaseHeartbeat(q, item, self.lease_secs).start()) for item in items)
+        return self._ready.popleft() if self._ready else (None, None)
+
+    def _release_ready(self, q):
+        """Hand leased jobs that never started back to the queue."""
+        if not self._ready:
+            return
+        items = []
+        while self._ready:
+            item, heartbeat = self._ready.popleft()
+            heartbeat.stop()
+            items.append(item)
+        logger.info(f"Returned {q.release(items)} unstarted job(s) to the queue")
+
+    def _ack(self, q, item):
+        if not self._acks:
+            self._acks_since = time.monotonic()
+        self._acks.append(item)
+        self._flush_acks(q)
+
+    def _flush_acks(self, q, force=False):
+        """Ack finished jobs once there are ack_batch of them, the oldest has waited ACK_FLUSH_SECS, or on 'force'."""
+        if not self._acks:
+            return
+        if force or len(self._acks) >= self.ack_batch or time.monotonic() - self._acks_since >= ACK_FLUSH_SECS:
+            q.complete_many(self._acks)
+            self._acks = []
+
+    def _leased(self, q, item):
+        """Log and record a freshly leased item, returning its decoded payload."""
+        payload = item.decode("utf=8")
+        logger.info(f"Working on {payload}")
+        wait = q.queue_wait(item)
+        if wait is not None:
+            metrics.queue_wait(wait)
+        return payload
+
+    def _finished(self, slot, outcome):
+        end = datetime.datetime.now().replace(microsecond=0)
+        metrics.scene_done((end - slot.start).total_seconds(), outcome)
+        return end
+
+    def _stop(self, signum, frame):
+        logger.info(f"Received signal {signum}, finishing {len(self._running)} scene(s) in flight then exiting")
+        self._stopping = True
+
+    def _start(self, q, item, heartbeat):
+        payload = self._leased(q, item)
+        process = _scene_context.Process(target=_run_job, args=(self.handler, payload, self.scene_cpus,
+                                                                metrics.child_settings()))
+        process.start()
+        self._running.append(_Slot(item, process, heartbeat))
+        metrics.in_flight(len(self._running))
+
+    def _reap(self, q):
+        for slot in [s for s in self._running if not s.process.is_alive()]:
+            slot.process.join()
+            metrics.process_dead(slot.process.pid)
+            slot.heartbeat.stop()
+            self._running.remove(slot)
+            metrics.in_flight(len(self._running))
+            if slot.process.exitcode == 0:
+                self._ack(q, slot.item)
+                end = self._finished(slot, "ok")
+                logger.info(f"Total processing time {end - slot.start}")
+            else:
+                end = self._finished(slot, "failed")
+                # leave the lease to expire so the reaper retries the scene (up to max_attempts)
+                logger.error(f"Job exited with code {slot.process.exitcode} after {end - slot.start}, "
+                             f"not acked: {slot.item.decode('utf=8')}")
+
+    def run(self):
+        q = RedisWQ(name=self.queue, lanes=self.lanes, rate_limit=self.rate_limit, host=self.host, port=self.port)
+        q.start_reaper()
+        logger.info(f"Worker with sessionID: {q.sessionID()} on queue {self.queue}, lanes {self.lanes}")
+        signal.signal(signal.SIGTERM, self._stop)
+        if self.metrics_port:
+            # before the first scene starts the forkserver, which then inherits the directory
+            metrics.init()
+            metrics.start_metrics_server(self.queue, self.metrics_port)
+            logger.info(f"Serving metrics on :{self.metrics_port}/metrics")
+
+        if self.stages:
+            self._run_pipeline(q)
+            return
+
+        while self._running or not self._stopping:
+            self._reap(q)
+            self._flush_acks(q)
+            self._sample_disk()
+            self._sample_queue(q)
+
+            if self._stopping:
+                self._release_ready(q)
+            if self._stopping or len(self._running) >= self.slots() or not self._has_headroom(self._running):
+                time.sleep(1)
+                continue
+
+            if self._running:
+                # scenes in flight need reaping, so only peek at the queue
+                item, heartbeat = self._lease(q, block=False)
+                if item is None:
+                    time.sleep(1)
+            else:
+                item, heartbeat = self._lease(q, block=True)
+                if item is None:
+                    logger.info("No work found in queue")
+                self._idle(item is not None)
+
+            if item is not None:
+                self._start(q, item, heartbeat)
+
+        self._release_ready(q)
+        self._flush_acks(q, force=True)
+        logger.info("Worker stopped, exiting")
+
+    def _run_pipeline(self, q):
+        """
+        Feed leased scenes into a ScenePipeline while its first stage has room.
+
+        A failed scene is not acked, as in process mode: its lease is left
+        to expire, so the reaper retries it (up to max_attempts).
+        """
+        done = queue_.Queue()
+        pipeline = ScenePipeline(self.stages, on_done=lambda item, error: done.put((item, error)),
+                                 cleanup=self.cleanup)
+        logger.info("Pipeline mode: " + ", ".join(f"{s.name} x{s.workers} (buffer {s.buffer})" for s in self.stages))
+        in_flight = {}
+
+        while in_flight or not self._stopping:
+            while not done.empty():
+                item, error = done.get()
+                slot = in_flight.pop(item)
+                slot.heartbeat.stop()
+                metrics.in_flight(len(in_flight))
+                if error is None:
+                    self._ack(q, item)
+                    end = self._finished(slot, "ok")
+                    logger.info(f"Total processing time {end - slot.start}")
+                else:
+                    end = self._finished(slot, "failed")
+                    logger.error(f"Scene failed after {end - slot.start}, not acked: {item.decode('utf=8')}")
+            self._flush_acks(q)
+            self._sample_disk()
+            self._sample_queue(q)
+
+            if self._stopping:
+                self._release_ready(q)
+            if self._stopping or not pipeline.has_room() or not self._has_headroom(in_flight):
+                time.sleep(1)
+                continue
+
+            item, heartbeat = self._lease(q, block=not in_flight)
+            self._idle(item is not None or bool(in_flight))
+            if item is None:
+                if in_flight:
+                    time.sleep(1)
+                else:
+                    logger.info("No work found in queue")
+                continue
+
+            payload = self._leased(q, item)
+            in_flight[item] = _Slot(item, None, heartbeat)
+            metrics.in_flight(len(in_flight))
+            pipeline.submit(item, json.loads(payload))
+
+        pipeline.close()
+        self._release_ready(q)
+        self._flush_acks(q, force=True)
+        logger.info("Worker stopped, exiting")
+
+
+def _env_number(name, default, cast=int):
+    value = os.getenv(name)
+    return cast(value) if value else default
+
+
+def _env_pairs(name):
+    """Parse a "name=number,name=number" env var into [(name, number)], in order."""
+    pairs = []
+    for knob in filter(None, os.getenv(name, "").split(",")):
+        key, value = knob.split("=")
+        pairs.append((key.strip(), int(value)))
+    return pairs
+
+
+def _stage_settings(stages):
+    """
+    Apply WORKER_STAGE_WORKERS ("download=2,upload=2") and WORKER_STAGE_BUFFER
+    to the sensor's default stages.
+    """
+    workers = dict(_env_pairs("WORKER_STAGE_WORKERS"))
+    buffer = _env_number("WORKER_STAGE_BUFFER", None)
+    return [stage.configured(workers.get(stage.name), buffer) for stage in stages]
+
+
+def run_worker(queue, handler, log_name="ard", stages=None, **settings):
+    """
+    Entry point for the worker-*.py scripts. Settings can be overridden per
+    deployment through the environment:
+
+    REDIS_HOST, REDIS_PORT, REDIS_LEASE_SECS, WORKER_CONCURRENCY,
+    WORKER_SCENE_CPUS, WORKER_SCENE_MEM_GB, WORKER_SCENE_DISK_GB,
+    WORKER_LANES ("high=6,normal=3,bulk=1"), WORKER_RATE_LIMIT,
+    WORKER_METRICS_PORT (default 8000, 0 = off), WORKER_IDLE_EXIT_SECS,
+    WORKER_PREFETCH, WORKER_ACK_BATCH,
+    AUTOSCALE_DRAIN_SECS, AUTOSCALE_MIN_REPLICAS, AUTOSCALE_MAX_REPLICAS
+
+    WORKER_MODE=pipeline runs 'stages' (if the sensor has them) instead of
+    one handler process per scene, tuned by WORKER_STAGE_WORKERS and
+    WORKER_STAGE_BUFFER.
+    """
+    logging_file_handler = setup_worker_logging(log_name)
+
+    if os.getenv("WORKER_MODE", "process") == "pipeline":
+        if stages:
+            settings['stages'] = _stage_settings(stages)
+        else:
+            logger.warning(f"{queue} has no pipeline stages, running one process per scene")
+
+    settings.setdefault('host', os.getenv("REDIS_HOST", "localhost"))
+    settings['port'] = _env_number("REDIS_PORT", settings.get('port', 6379))
+    settings['lease_secs'] = _env_number("REDIS_LEASE_SECS", settings.get('lease_secs', 600))
+    settings['concurrency'] = _env_number("WORKER_CONCURRENCY", settings.get('concurrency'))
+    settings['scene_cpus'] = _env_number("WORKER_SCENE_CPUS", settings.get('scene_cpus', 1))
+    settings['scene_mem_gb'] = _env_number("WORKER_SCENE_MEM_GB", settings.get('scene_mem_gb', 4), float)
+    settings['scene_disk_gb'] = _env_number("WORKER_SCENE_DISK_GB", settings.get('scene_disk_gb', 20), float)
+    settings['lanes'] = _env_pairs("WORKER_LANES") or settings.get('lanes', RedisWQ.DEFAULT_LANES)
+    settings['rate_limit'] = _env_number("WORKER_RATE_LIMIT", settings.get('rate_limit', 0))
+    settings['metrics_port'] = _env_number("WORKER_METRICS_PORT", settings.get('metrics_port', 8000))
+    settings['idle_exit_secs'] = _env_number("WORKER_IDLE_EXIT_SECS", settings.get('idle_exit_secs', 0))
+    settings['prefetch'] = _env_number("WORKER_PREFETCH", settings.get('prefetch', 1))
+    settings['ack_batch'] = _env_number("WORKER_ACK_BATCH", settings.get('ack_batch', 1))
+
+    try:
+        logger.info(f"Connecting to Redis at {settings['host']}:{settings['port']}")
+        Worker(queue, handler, **settings).run()
+    except Exception as e:
+        logger.exception(e)
+    finally:
+        logging.getLogger().removeHandler(logging_file_handler)
+        logging_file_handler.close()
+
+
+def import_handler(path):
+    """Resolve "package.module:function" to the function."""
+    module_name, func_name = path.split(':')
+    return getattr(importlib.import_module(module_name), func_name)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run an ARD prepare function for every job on a redis queue.")
+    parser.add_argument("--queue", required=True, help="redis list to take jobs from, e.g. jobLS")
+    parser.add_argument("--handler", required=True, help="prepare function, e.g. workflows.utils.prepLS:prepareLS")
+    parser.add_argument("--concurrency", type=int, default=None, help="max scenes in flight (default: fit to budgets)")
+    parser.add_argument("--scene-mem-gb", type=float, default=4)
+    parser.add_argument("--scene-disk-gb", type=float, default=20)
+    args = parser.parse_args()
+
+    run_worker(args.queue, import_handler(args.handler), log_name=args.queue,
+               concurrency=args.concurrency, scene_mem_gb=args.scene_mem_gb, scene_disk_gb=args.scene_disk_gb)